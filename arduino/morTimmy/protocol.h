@@ -0,0 +1,72 @@
+/**
+  * @file protocol.h
+  * @brief Protocol definition for the morTimmy robot
+  *
+  * Generated by raspberrypi/morTimmy/protocol.py, do not edit
+  */
+
+#ifndef MORTIMMY_PROTOCOL_H
+#define MORTIMMY_PROTOCOL_H
+
+namespace morTimmy {
+
+  // Frames
+  const byte FRAME_FLAG = 0x0C;
+  const byte FRAME_ESC = 0x1B;
+
+  // Telemetry frames, see telemetry.py
+  const byte TELEMETRY_MARKER = 0xFE;
+  const byte TELEMETRY_MAX_SAMPLES = 32;
+
+  // Arduino
+  const byte MODULE_ARDUINO = 0x30;
+  const byte CMD_ARDUINO_START = 0x64;
+  const byte CMD_ARDUINO_START_NACK = 0x65;
+  const byte CMD_ARDUINO_STOP = 0x66;
+  const byte CMD_ARDUINO_STOP_NACK = 0x67;
+  const byte CMD_ARDUINO_RESTART = 0x68;
+  const byte CMD_ARDUINO_RESTART_NACK = 0x69;
+  const byte CMD_ARDUINO_TELEMETRY = 0x6A;
+  const byte CMD_ARDUINO_TELEMETRY_NACK = 0x6B;
+
+  // Distance Sensor
+  const byte MODULE_DISTANCE_SENSOR = 0x31;
+  const byte CMD_DISTANCE_SENSOR_START = 0x64;
+  const byte CMD_DISTANCE_SENSOR_NACK = 0x65;
+  const byte CMD_DISTANCE_SENSOR_STOP = 0x66;
+  const byte CMD_DISTANCE_SENSOR_STOP_NACK = 0x67;
+
+  // Motor
+  const byte MODULE_MOTOR = 0x32;
+  const byte CMD_MOTOR_FORWARD = 0x64;
+  const byte CMD_MOTOR_FORWARD_NACK = 0x65;
+  const byte CMD_MOTOR_BACK = 0x66;
+  const byte CMD_MOTOR_BACK_NACK = 0x67;
+  const byte CMD_MOTOR_LEFT = 0x68;
+  const byte CMD_MOTOR_LEFT_NACK = 0x69;
+  const byte CMD_MOTOR_RIGHT = 0x6A;
+  const byte CMD_MOTOR_RIGHT_NACK = 0x6B;
+  const byte CMD_MOTOR_STOP = 0x6C;
+  const byte CMD_MOTOR_STOP_NACK = 0x6D;
+  const byte CMD_MOTOR_DRIVE = 0x6E;
+  const byte CMD_MOTOR_DRIVE_NACK = 0x6F;
+
+  // Servo
+  const byte MODULE_SERVO = 0x33;
+  const byte CMD_SERVO_PAN = 0x64;
+  const byte CMD_SERVO_PAN_NACK = 0x65;
+  const byte CMD_SERVO_TILT = 0x66;
+  const byte CMD_SERVO_TILT_NACK = 0x67;
+
+  struct message_t {
+    unsigned long messageID;
+    unsigned long acknowledgeID;
+    byte module;
+    byte commandType;
+    unsigned long data;
+    unsigned long checksum;
+  };
+
+};
+
+#endif
@@ -5,51 +5,12 @@
   */
   
 #include "crc32.h"
+#include "protocol.h"
  
 namespace morTimmy {
 
-  // Definitions
-  // Frames
-  byte FRAME_FLAG = 0x0C;       // Marks the start and end of a frame
-  byte FRAME_ESC = 0x1B;        // Escape char for frame
-
-  // Arduino
-  byte MODULE_ARDUINO = 0x30;
-  byte CMD_ARDUINO_START = 0x64;
-  byte CMD_ARDUINO_START_NACK = 0x65;
-  byte CMD_ARDUINO_STOP = 0x66;
-  byte CMD_ARDUINO_STOP_NACK = 0x67;
-  byte CMD_ARDUINO_RESTART = 0x68;
-  byte CMD_ARDUINO_RESTART_NACK = 0x69;
-
-  // Distance Sensor
-  byte MODULE_DISTANCE_SENSOR = 0x31;
-  byte CMD_DISTANCE_SENSOR_START = 0x64;
-  byte CMD_DISTANCE_SENSOR_NACK = 0x65;
-  byte CMD_DISTANCE_SENSOR_STOP = 0x66;
-  byte CMD_DISTANCE_SENSOR_STOP_NACK = 0x67;
-
-  // Motor
-  byte MODULE_MOTOR = 0x32;
-  byte CMD_MOTOR_FORWARD = 0x64;
-  byte CMD_MOTOR_FORWARD_NACK = 0x65;
-  byte CMD_MOTOR_BACK = 0x66;
-  byte CMD_MOTOR_BACK_NACK = 0x67;
-  byte CMD_MOTOR_LEFT = 0x68;
-  byte CMD_MOTOR_LEFT_NACK = 0x69;
-  byte CMD_MOTOR_RIGHT = 0x6A;
-  byte CMD_MOTOR_RIGHT_NACK = 0x6B;
-  byte CMD_MOTOR_STOP = 0x6C;
-  byte CMD_MOTOR_STOP_NACK = 0x6D;
-
-  struct message_t {
-        unsigned long messageID;
-        unsigned long acknowledgeID;
-        byte module;        // 2 bytes, corresponds to unsigned short on Pi
-        byte commandType;
-        unsigned long data;        // 4 bytes, corresponds to unsigned int on Pi
-        unsigned long checksum;
-  };   
+  // The modules, commands and message_t are defined in protocol.h,
+  // which is generated by raspberrypi/morTimmy/protocol.py
 
   class RaspberryController {
     public:
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import heapq
+import io
+import logging
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import tty
+from time import monotonic, sleep
+from hardware_controller import *
+from telemetry import TELEMETRY_MAX_SAMPLES, packTelemetry
+
+
+class ArduinoSimulator():
+
+    """ Stand-in for the Arduino on a pseudo terminal
+
+    Opens a pty pair and speaks the same FRAME_FLAG/CRC32 protocol as
+    the Arduino on the master side. The slave side is a regular serial
+    device so HardwareController.initialize(serialPort=simulator.port)
+    works without changes.
+
+    The simulator answers MODULE_ARDUINO, MODULE_MOTOR, MODULE_SERVO
+    and MODULE_DISTANCE_SENSOR commands with an ACK (same commandType) or
+    a NACK and streams MODULE_DISTANCE_SENSOR readings at distanceRate
+    Hz while the distance sensor is started. After the Pi negotiated
+    telemetry batches with CMD_ARDUINO_TELEMETRY the readings are sent
+    in telemetry frames instead, unless supportsTelemetry is False.
+
+    The distance readings can depend on the angle of the pan servo,
+    see distanceProfile, to try the ObstaclePlanner.
+
+    Faults can be injected by changing the attributes at any time:
+        distanceNoise   standard deviation added to every reading
+        corruptionRate  chance a sent frame gets one byte flipped
+        nackRate        chance a command is answered with its NACK
+        latency         seconds before a reply is sent
+    """
+
+    def __init__(self, distanceRate=20.0, distance=100, distanceNoise=0.0,
+                 corruptionRate=0.0, nackRate=0.0, latency=0.0, seed=None,
+                 supportsTelemetry=True, distanceProfile=None):
+        """ Opens the pseudo terminal
+
+        Args:
+            distanceRate (float): Distance readings per second, 0 to
+                                  disable streaming
+            distance (int): The simulated distance to the nearest object
+            distanceNoise (float): Standard deviation of the noise
+            corruptionRate (float): Chance between 0 and 1 that a frame
+                                    is corrupted
+            nackRate (float): Chance between 0 and 1 that a command
+                              is answered with a NACK
+            latency (float): Seconds before a reply is sent
+            seed (int): Seed for the random generator to make a
+                        run reproducible
+            supportsTelemetry (bool): Accept CMD_ARDUINO_TELEMETRY
+            distanceProfile (function): Called with the pan angle,
+                                        returns the distance to the
+                                        nearest object in that
+                                        direction instead of distance
+        """
+
+        self.distanceRate = distanceRate
+        self.distance = distance
+        self.distanceNoise = distanceNoise
+        self.corruptionRate = corruptionRate
+        self.nackRate = nackRate
+        self.latency = latency
+        self.supportsTelemetry = supportsTelemetry
+        self.distanceProfile = distanceProfile
+        self.telemetryBatchSize = 0
+
+        self.distanceSensorRunning = True
+        self.motorCommand = CMD_MOTOR_STOP
+        self.motorSpeed = 0
+        self.motorSpeeds = (0, 0)   # (left, right) the motors turn at
+        self.panAngle = 90
+        self.tiltAngle = 90
+
+        self.receivedCount = 0      # valid messages received
+        self.invalidCount = 0       # frames failing the checksum
+        self.sentCount = 0          # frames sent
+        self.corruptedCount = 0     # frames corrupted on purpose
+        self.nackCount = 0          # commands answered with a NACK
+
+        self.__random = random.Random(seed)
+        self.__lastMessageID = 0
+        self.__messageBuffer = bytearray(MESSAGE_SIZE)
+        self.__receiveBuffer = ReceiveBuffer()
+        self.__replies = []         # heap of (sendTime, sequence, frame)
+        self.__sequence = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__stop = threading.Event()
+
+        self.__startTime = monotonic()
+        self.__samples = []         # (module, timestamp, value) to batch
+
+        self.__master, self.__slave = pty.openpty()
+        tty.setraw(self.__master)
+        tty.setraw(self.__slave)
+        self.port = os.ttyname(self.__slave)
+        # Lets the ReceiveBuffer read from the master side directly
+        self.__masterFile = io.FileIO(self.__master, 'r+b', closefd=False)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """ Start answering in a background thread """
+
+        if self.__thread is not None:
+            return
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='morTimmy-arduino-simulator',
+                                         daemon=True)
+        self.__thread.start()
+        logging.info("Arduino simulator running on %s", self.port)
+
+    def stop(self):
+        """ Stop the background thread """
+
+        if self.__thread is None:
+            return
+
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def close(self):
+        """ Stop the simulator and close the pseudo terminal """
+
+        self.stop()
+        for fd in (self.__master, self.__slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def sendMessage(self, module, commandType, data=0, acknowledgeID=0,
+                    delay=0.0):
+        """ Queue a message towards the Pi
+
+        Args:
+            delay (float): Seconds to wait before sending
+        """
+
+        with self.__lock:
+            self.__lastMessageID += 1
+            packMessageInto(self.__messageBuffer, self.__lastMessageID,
+                            module, commandType, data, acknowledgeID)
+            self.__queueFrame(packFrame(self.__messageBuffer), delay)
+
+    def sendTelemetry(self, samples):
+        """ Send samples in one telemetry frame
+
+        Args:
+            samples (list): (module, timestamp, value) tuples, the
+                            timestamp in ms since the simulator started
+        """
+
+        baseTimestamp = samples[0][1]
+        batch = packTelemetry(baseTimestamp & 0xffffffff,
+                              [(module, timestamp - baseTimestamp, value)
+                               for module, timestamp, value in samples])
+        with self.__lock:
+            self.__queueFrame(packFrame(batch), 0.0)
+
+    def __queueFrame(self, frame, delay):
+        """ Add a frame to the send heap, must hold the lock """
+
+        frame = bytearray(frame)
+        if self.__random.random() < self.corruptionRate:
+            # Flip a bit of a byte between the frame flags
+            position = self.__random.randrange(1, len(frame) - 1)
+            frame[position] ^= 1 << self.__random.randrange(8)
+            self.corruptedCount += 1
+
+        self.__sequence += 1
+        heapq.heappush(self.__replies, (monotonic() + delay,
+                                        self.__sequence, bytes(frame)))
+
+    def __run(self):
+        """ Main loop of the simulator thread """
+
+        nextReading = monotonic()
+
+        while not self.__stop.is_set():
+            now = monotonic()
+
+            streaming = self.distanceSensorRunning and self.distanceRate > 0
+            if streaming and now >= nextReading:
+                self.__sendReading(MODULE_DISTANCE_SENSOR,
+                                   self.__readDistance(), now)
+                nextReading = max(nextReading + 1.0 / self.distanceRate, now)
+
+            output = bytearray()
+            with self.__lock:
+                while self.__replies and self.__replies[0][0] <= now:
+                    output += heapq.heappop(self.__replies)[2]
+                    self.sentCount += 1
+                nextReply = self.__replies[0][0] if self.__replies else None
+            if output:
+                try:
+                    os.write(self.__master, output)
+                except OSError:
+                    # The other side of the pty was closed
+                    pass
+
+            # Sleep until there is data or something has to be sent
+            timeout = 0.1
+            if streaming:
+                timeout = min(timeout, nextReading - now)
+            if nextReply is not None:
+                timeout = min(timeout, nextReply - now)
+
+            readable, _, _ = select.select([self.__master], [], [],
+                                           max(timeout, 0))
+            if readable:
+                try:
+                    self.__receiveBuffer.readFrom(self.__masterFile,
+                                                  self.__receiveBuffer.capacity)
+                except OSError:
+                    sleep(0.01)
+                    continue
+                for frame in self.__receiveBuffer.frames():
+                    self.__handleFrame(frame)
+
+    def __sendReading(self, module, value, now):
+        """ Send a sensor reading or add it to the telemetry batch """
+
+        if not self.telemetryBatchSize:
+            self.sendMessage(module, CMD_DISTANCE_SENSOR_START, value)
+            return
+
+        timestamp = int((now - self.__startTime) * 1000)
+        self.__samples.append((module, timestamp, min(value, 0xffff)))
+        if len(self.__samples) >= self.telemetryBatchSize:
+            self.sendTelemetry(self.__samples)
+            self.__samples = []
+
+    def __readDistance(self):
+        """ Returns a (noisy) distance reading """
+
+        distance = self.distance
+        if self.distanceProfile is not None:
+            distance = self.distanceProfile(self.panAngle)
+        if self.distanceNoise:
+            distance = self.__random.gauss(distance, self.distanceNoise)
+        return max(0, int(round(distance)))
+
+    def __motorSpeeds(self, commandType, data):
+        """ Returns the (left, right) speeds a motor command sets """
+
+        if commandType == CMD_MOTOR_DRIVE:
+            return unpackSpeeds(data)
+        return {CMD_MOTOR_FORWARD: (data, data),
+                CMD_MOTOR_BACK: (-data, -data),
+                CMD_MOTOR_LEFT: (-data, data),
+                CMD_MOTOR_RIGHT: (data, -data)}.get(commandType, (0, 0))
+
+    def __handleFrame(self, frame):
+        """ Answer a message received from the Pi """
+
+        try:
+            message = unpackMessage(frame)
+        except struct.error:
+            message = None
+
+        if message is None:
+            self.invalidCount += 1
+            return
+
+        self.receivedCount += 1
+        key = (message.module, message.commandType)
+        if key not in NACK_COMMANDS:
+            logging.debug("Simulator ignoring unknown command %s", key)
+            return
+
+        unsupported = key == (MODULE_ARDUINO, CMD_ARDUINO_TELEMETRY) and \
+            not self.supportsTelemetry
+        if unsupported or self.__random.random() < self.nackRate:
+            self.nackCount += 1
+            self.sendMessage(message.module, NACK_COMMANDS[key], 0,
+                             message.messageID, self.latency)
+            return
+
+        if message.module == MODULE_MOTOR:
+            self.motorCommand = message.commandType
+            self.motorSpeed = message.data
+            self.motorSpeeds = self.__motorSpeeds(message.commandType,
+                                                  message.data)
+        elif message.module == MODULE_DISTANCE_SENSOR:
+            self.distanceSensorRunning = \
+                message.commandType == CMD_DISTANCE_SENSOR_START
+        elif key == (MODULE_SERVO, CMD_SERVO_PAN):
+            self.panAngle = message.data
+        elif key == (MODULE_SERVO, CMD_SERVO_TILT):
+            self.tiltAngle = message.data
+        elif key == (MODULE_ARDUINO, CMD_ARDUINO_TELEMETRY):
+            self.__samples = []
+            self.telemetryBatchSize = min(message.data, TELEMETRY_MAX_SAMPLES)
+
+        self.sendMessage(message.module, message.commandType, message.data,
+                         message.messageID, self.latency)
+
+
+def main():
+    """ Run the simulator until interrupted
+
+    Point the robot at the printed port to use it instead
+    of the Arduino.
+    """
+
+    logging.basicConfig(level=logging.INFO)
+
+    with ArduinoSimulator(distanceNoise=2.0) as simulator:
+        print("Arduino simulator listening on %s" % simulator.port)
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import os
+import serial               # pyserial library for serial communications
+import struct
+from hardware_controller import *
+
+
+class AsyncHardwareController():
+
+    """ asyncio interface into the Arduino microcontroller
+
+    Speaks the same framed protocol as HardwareController but is driven
+    by an asyncio event loop instead of blocking reads. The serial port
+    is opened non-blocking and its file descriptor is watched with
+    loop.add_reader, so the serial link, remote control input and
+    timers can all share a single event loop without polling.
+
+    Received messages are available through async iteration:
+
+        async for message in arduino:
+            ...
+
+    Replies to a request are matched on their acknowledgeID and
+    returned by request() instead of being put on the receive queue.
+    """
+
+    def __init__(self, recvQueueSize=256):
+        """ Initializes the AsyncHardwareController
+
+        Args:
+            recvQueueSize (int): Maximum number of received messages
+                                 waiting to be iterated. The oldest
+                                 message is dropped when full.
+        """
+
+        self.serialPort = None
+        self.isConnected = False
+        self.invalidMessageCount = 0
+        self.droppedMessages = 0
+
+        self.__lastMessageID = 0
+        self.__receiveBuffer = ReceiveBuffer()
+        self.__recvMessageQueue = asyncio.Queue(recvQueueSize)
+        self.__pendingRequests = {}     # messageID: future waiting for reply
+        self.__messageBuffer = bytearray(MESSAGE_SIZE)
+        self.__writeBuffer = bytearray()
+        self.__drainWaiters = []
+        self.__loop = None
+        self.__fd = None
+
+    async def initialize(self, serialPort='/dev/ttyACM0', baudrate=9600,
+                         resetArduino=True):
+        """ Open the serial connection towards the Arduino
+
+        Args:
+            serialPort (str): The port used to communicate with the Arduino
+            baudrate (int): The baudrate of the serial connection
+            resetArduino (bool): Reset the Arduino using the DTR pin
+        """
+
+        self.__loop = asyncio.get_running_loop()
+
+        logging.info("Opening serial connection to arduino on "
+                     "port %s with baudrate %d", serialPort, baudrate)
+        self.serialPort = serial.Serial(serialPort, baudrate,
+                                        timeout=0, write_timeout=0)
+
+        if resetArduino:
+            try:
+                self.serialPort.dtr = False
+                await asyncio.sleep(0.5)
+                self.serialPort.reset_input_buffer()
+                self.serialPort.dtr = True
+            except OSError:
+                # e.g. a pseudo terminal has no DTR line
+                logging.info("Serial port does not support DTR reset")
+
+        self.__receiveBuffer.reset()
+        self.__fd = self.serialPort.fileno()
+        self.__loop.add_reader(self.__fd, self.__onReadable)
+        self.isConnected = True
+        logging.info("Connected to Arduino")
+
+    def close(self):
+        """ Close the serial connection
+
+        Pending requests fail with ConnectionError and running
+        async iterations over received messages finish.
+        """
+
+        if not self.isConnected:
+            return
+
+        self.isConnected = False
+        self.__loop.remove_reader(self.__fd)
+        self.__loop.remove_writer(self.__fd)
+        self.__writeBuffer.clear()
+        self.serialPort.close()
+
+        for future in self.__pendingRequests.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
+        self.__pendingRequests.clear()
+        self.__wakeDrainWaiters(ConnectionError("Connection closed"))
+
+        # None marks the end of the received messages for __anext__
+        if self.__recvMessageQueue.full():
+            self.__recvMessageQueue.get_nowait()
+        self.__recvMessageQueue.put_nowait(None)
+
+    async def sendMessage(self, module, commandType, data=0, acknowledgeID=0):
+        """ Send a message to the Arduino
+
+        Waits until the frame has been handed to the serial port.
+
+        Args:
+            module (byte):      The module to address
+            commandType (byte): The command to send to the specified module
+            data (int):         The data that goes with the command (if any)
+            acknowledgeID (int): The messageID this message replies to
+
+        Returns:
+            The messageID of the sent message
+        """
+
+        messageID = self.__nextMessageID()
+        await self.__send(messageID, module, commandType, data, acknowledgeID)
+        return messageID
+
+    async def request(self, module, commandType, data=0, timeout=1.0):
+        """ Send a message and wait for the Arduino to reply to it
+
+        Args:
+            module (byte):      The module to address
+            commandType (byte): The command to send to the specified module
+            data (int):         The data that goes with the command (if any)
+            timeout (float):    Seconds to wait for the reply
+
+        Returns:
+            The reply Message
+
+        Raises:
+            asyncio.TimeoutError: No reply received within timeout
+        """
+
+        messageID = self.__nextMessageID()
+        future = self.__loop.create_future()
+        self.__pendingRequests[messageID] = future
+
+        try:
+            await self.__send(messageID, module, commandType, data, 0)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.__pendingRequests.pop(messageID, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.__recvMessageQueue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def __nextMessageID(self):
+        self.__lastMessageID += 1
+        return self.__lastMessageID
+
+    async def __send(self, messageID, module, commandType, data,
+                     acknowledgeID):
+        """ Frame a message and write it without blocking the loop """
+
+        if not self.isConnected:
+            raise ConnectionError("Not connected to Arduino")
+
+        packMessageInto(self.__messageBuffer, messageID, module,
+                        commandType, data, acknowledgeID)
+        frame = packFrame(self.__messageBuffer)
+
+        if not self.__writeBuffer:
+            try:
+                written = os.write(self.__fd, frame)
+            except BlockingIOError:
+                written = 0
+            if written == len(frame):
+                return
+            frame = frame[written:]
+            self.__loop.add_writer(self.__fd, self.__onWritable)
+
+        self.__writeBuffer.extend(frame)
+        waiter = self.__loop.create_future()
+        self.__drainWaiters.append(waiter)
+        await waiter
+
+    def __onWritable(self):
+        """ Called by the loop when the serial port accepts more data """
+
+        try:
+            written = os.write(self.__fd, self.__writeBuffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.error("Writing to serial port failed: %s", e)
+            self.close()
+            return
+
+        del self.__writeBuffer[:written]
+        if not self.__writeBuffer:
+            self.__loop.remove_writer(self.__fd)
+            self.__wakeDrainWaiters()
+
+    def __wakeDrainWaiters(self, exception=None):
+        for waiter in self.__drainWaiters:
+            if waiter.done():
+                continue
+            if exception is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exception)
+        self.__drainWaiters = []
+
+    def __onReadable(self):
+        """ Called by the loop when the serial port has data waiting """
+
+        try:
+            self.__receiveBuffer.readFrom(self.serialPort,
+                                          self.serialPort.in_waiting)
+        except (OSError, serial.SerialException) as e:
+            logging.error("Reading from serial port failed: %s", e)
+            self.close()
+            return
+
+        for frame in self.__receiveBuffer.frames():
+            try:
+                message = unpackMessage(frame)
+            except struct.error:
+                message = None
+
+            if message is None:
+                self.invalidMessageCount += 1
+                logging.warning("Invalid message received")
+                continue
+
+            future = self.__pendingRequests.get(message.acknowledgeID)
+            if future is not None and not future.done():
+                future.set_result(message)
+                continue
+
+            if self.__recvMessageQueue.full():
+                self.__recvMessageQueue.get_nowait()
+                self.droppedMessages += 1
+            self.__recvMessageQueue.put_nowait(message)
+
+
+def main():
+    """ This function will only be called when the library is
+    run directly. Only to be used to do quick tests on the library.
+    """
+
+    async def run():
+        arduino = AsyncHardwareController()
+        await arduino.initialize()
+        await arduino.sendMessage(MODULE_MOTOR, CMD_MOTOR_FORWARD, 255)
+        async for message in arduino:
+            print(message)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import logging
+import platform
+import queue
+from datetime import datetime
+from time import perf_counter, process_time, sleep
+from hardware_controller import *
+from arduino_simulator import ArduinoSimulator
+from obstacle_planner import ObstaclePlanner, SERVO_CENTER
+
+BAUDRATES = (9600, 19200, 38400, 57600, 115200)
+
+
+def percentiles(samples):
+    """ Returns a summary of the samples (in seconds) in ms """
+
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+    last = len(samples) - 1
+
+    def percentile(percent):
+        return samples[int(round(last * percent / 100.0))] * 1000
+
+    return {'count': len(samples),
+            'mean': sum(samples) / len(samples) * 1000,
+            'min': samples[0] * 1000,
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': samples[-1] * 1000}
+
+
+def timeIt(function, count):
+    """ Call function count times
+
+    Returns:
+        A dictionary with the calls per second and the wall clock
+        and CPU time per call in microseconds
+    """
+
+    startCpu = process_time()
+    start = perf_counter()
+    for i in range(count):
+        function(i)
+    elapsed = perf_counter() - start
+    cpu = process_time() - startCpu
+
+    return {'count': count,
+            'perSecond': count / elapsed if elapsed else None,
+            'usPerCall': elapsed / count * 1e6,
+            'cpuUsPerCall': cpu / count * 1e6}
+
+
+def benchmarkCodec(count=20000):
+    """ Measure pack, frame, decode and unpack throughput """
+
+    buffer = bytearray(MESSAGE_SIZE)
+    messages = [packMessage(i, MODULE_MOTOR, CMD_MOTOR_FORWARD, i & 0xff)
+                for i in range(count)]
+    frames = [packFrame(message) for message in messages]
+    stream = bytes(packFrames(messages))
+
+    results = {}
+    results['pack'] = timeIt(
+        lambda i: packMessageInto(buffer, i, MODULE_MOTOR,
+                                  CMD_MOTOR_FORWARD, i & 0xff), count)
+    results['frame'] = timeIt(lambda i: packFrame(messages[i]), count)
+    results['unpack'] = timeIt(lambda i: unpackMessage(messages[i]), count)
+
+    # Decoding is done on whole chunks, report it per message
+    for chunkSize in (MESSAGE_SIZE + 2, 64, 4096):
+        # Read from memory into the ReceiveBuffer and decode
+        chunkCount = -(-len(stream) // chunkSize)
+        scale = float(chunkCount) / count
+        port = io.BytesIO(stream)
+        receiveBuffer = ReceiveBuffer()
+
+        def receive(i):
+            receiveBuffer.readFrom(port, chunkSize)
+            receiveBuffer.frames()
+
+        result = timeIt(receive, chunkCount)
+        results['receive_%d' % chunkSize] = {
+            'count': count,
+            'perSecond': result['perSecond'] / scale,
+            'usPerCall': result['usPerCall'] * scale,
+            'cpuUsPerCall': result['cpuUsPerCall'] * scale}
+
+    results['frameBytes'] = sum(len(frame) for frame in frames) / count
+    return results
+
+
+def corridor(angle):
+    """ Distance profile of a corridor with an opening to the left """
+
+    if 105 <= angle <= 135:
+        return 180
+    return 40 if abs(angle - SERVO_CENTER) < 45 else 15
+
+
+def benchmarkPlanner(count=5000, tickInterval=0.02):
+    """ Measure the cost of a planner tick
+
+    The planner is fed a reading of the corridor profile every tick
+    at its current pan angle, like the ArduinoSimulator would.
+    """
+
+    planner = ObstaclePlanner()
+    headings = {}
+
+    def tick(i):
+        now = i * tickInterval
+        angle = planner.panAngle
+        reading = corridor(angle) if angle is not None else None
+        planner.step(now, reading, now)
+        headings[planner.heading] = headings.get(planner.heading, 0) + 1
+
+    results = {'step': timeIt(tick, count)}
+    results['overBudget'] = planner.overBudgetCount
+    results['gridUpdates'] = planner.grid.updateCount
+    results['headings'] = {str(heading): ticks
+                           for heading, ticks in headings.items()}
+    return results
+
+
+def waitForReply(arduino, messageID, timeout):
+    """ Wait for the reply to messageID
+
+    The Arduino and the ArduinoSimulator acknowledge a message with
+    its messageID in the acknowledgeID. A loopback device echoes the
+    message itself, which has the messageID and acknowledgeID 0.
+
+    Returns:
+        True if the reply arrived within timeout
+    """
+
+    deadline = perf_counter() + timeout
+    while True:
+        remaining = deadline - perf_counter()
+        if remaining <= 0:
+            return False
+        try:
+            message = arduino.recvMessageQueue.get(timeout=remaining)
+        except queue.Empty:
+            return False
+        if message.acknowledgeID == messageID or \
+                (message.acknowledgeID == 0 and
+                 message.messageID == messageID):
+            return True
+
+
+def benchmarkLink(port, baudrate, count=200, timeout=1.0,
+                  handshakeTimeout=HardwareController.HANDSHAKE_TIMEOUT,
+                  baudLimited=True):
+    """ Measure round trip latency and throughput over a serial link
+
+    The round trip is measured by sending one message at a time and
+    waiting for its reply. Throughput is measured by sending all
+    messages back to back and waiting for the last reply. A loopback
+    device does not answer the handshake, use a handshakeTimeout of 0.
+
+    A pseudo terminal, like the one of the ArduinoSimulator, ignores
+    the baudrate. Its results are labelled with baudLimited False and
+    are the same for every baudrate.
+    """
+
+    arduino = HardwareController(recvQueueSize=count * 2)
+    arduino.initialize(serialPort=port, baudrate=baudrate,
+                       handshakeTimeout=handshakeTimeout)
+    if not arduino.isConnected:
+        return {'error': 'could not connect to %s' % port}
+    arduino.startReader()
+
+    lost = 0
+    roundTrips = []
+
+    startCpu = process_time()
+    for i in range(count):
+        start = perf_counter()
+        messageID = arduino.sendMessage(MODULE_MOTOR, CMD_MOTOR_FORWARD,
+                                        i & 0xff)
+        if waitForReply(arduino, messageID, timeout):
+            roundTrips.append(perf_counter() - start)
+        else:
+            lost += 1
+    roundTripCpu = process_time() - startCpu
+
+    start = perf_counter()
+    startCpu = process_time()
+    messageIDs = arduino.sendMessages(
+        [(MODULE_MOTOR, CMD_MOTOR_FORWARD, i & 0xff)
+         for i in range(count)])
+    burstComplete = waitForReply(arduino, messageIDs[-1],
+                                 timeout + count * 0.01)
+    elapsed = perf_counter() - start
+    burstCpu = process_time() - startCpu
+
+    arduino.stopReader()
+    arduino.serialPort.close()
+
+    return {'baudrate': baudrate,
+            'baudLimited': baudLimited,
+            'roundTrip': percentiles(roundTrips),
+            'lost': lost,
+            'cpuUsPerRoundTrip': roundTripCpu / count * 1e6,
+            'burstMessagesPerSecond': count / elapsed if burstComplete
+            else None,
+            'burstCpuUsPerMessage': burstCpu / count * 1e6,
+            'invalidMessages': arduino.invalidMessageCount,
+            'connectTime': arduino.connectTime}
+
+
+def main():
+    """ Run the benchmarks and write the results as JSON
+
+    Benchmarks the message codec, the obstacle planner and the serial
+    link. By default the link is tested against the ArduinoSimulator,
+    use --port to test a real Arduino or a loopback device. The results
+    are written as JSON so runs on e.g. a Pi 3 and a Pi Zero can be
+    compared:
+
+        ./benchmark.py --output pi3.json
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Throughput and latency benchmarks for the "
+                    "Pi <-> Arduino protocol")
+    parser.add_argument('--port', help='serial port of an Arduino or '
+                        'loopback device, default is the ArduinoSimulator')
+    parser.add_argument('--baudrates', type=int, nargs='+',
+                        default=BAUDRATES)
+    parser.add_argument('--messages', type=int, default=200,
+                        help='number of messages per link benchmark')
+    parser.add_argument('--codec-messages', type=int, default=20000)
+    parser.add_argument('--skip-link', action='store_true')
+    parser.add_argument('--no-handshake', action='store_true',
+                        help='skip the handshake, e.g. for a loopback device')
+    parser.add_argument('--output', help='JSON file, default stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {'timestamp': datetime.now().isoformat(),
+               'platform': {'python': platform.python_version(),
+                            'implementation':
+                                platform.python_implementation(),
+                            'machine': platform.machine(),
+                            'processor': platform.processor(),
+                            'system': platform.platform()},
+               'device': args.port or 'simulator',
+               'codec': benchmarkCodec(args.codec_messages),
+               'planner': benchmarkPlanner(),
+               'link': {}}
+
+    if not args.skip_link:
+        simulator = None
+        port = args.port
+        if port is None:
+            # A pty does not limit the data rate to the baudrate
+            simulator = ArduinoSimulator(distanceRate=0)
+            simulator.start()
+            port = simulator.port
+        try:
+            for baudrate in args.baudrates:
+                results['link'][str(baudrate)] = benchmarkLink(
+                    port, baudrate, args.messages,
+                    handshakeTimeout=0 if args.no_handshake
+                    else HardwareController.HANDSHAKE_TIMEOUT,
+                    baudLimited=simulator is None)
+                sleep(0.1)
+        finally:
+            if simulator is not None:
+                simulator.close()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
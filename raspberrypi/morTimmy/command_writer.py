@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import threading
+from collections import OrderedDict
+from hardware_controller import MESSAGE_SIZE
+
+# Typical size of a framed message on the wire, escaping not counted
+FRAME_SIZE = MESSAGE_SIZE + 2
+
+
+class CommandWriter():
+
+    """ Coalescing send queue for commands towards the Arduino
+
+    Commands are not written to the serial port right away but kept
+    per (module, commandType). Queueing a command that is already
+    pending only replaces its data, so e.g. a burst of joystick updates
+    results in a single CMD_MOTOR_* message with the latest speed.
+
+    The pending commands are sent in the order they were last updated
+    with a single write when flush is called, normally once per control
+    loop tick, or as soon as they would take more than maxBytes.
+    """
+
+    def __init__(self, hardwareController, maxBytes=128, track=False):
+        """ Sets up the send queue
+
+        Args:
+            hardwareController (HardwareController): Used to send the
+                                                     messages
+            maxBytes (int): Flush when the pending frames would
+                            exceed this many bytes
+            track (bool): Track the sent messages for acknowledgement,
+                          see HardwareController.sendMessage
+        """
+
+        self.hardwareController = hardwareController
+        self.maxBytes = maxBytes
+        self.track = track
+
+        self.queuedCount = 0        # commands queued
+        self.coalescedCount = 0     # commands replaced by a newer one
+        self.sentCount = 0          # messages written to the serial port
+        self.flushCount = 0         # writes to the serial port
+
+        self.__pending = OrderedDict()  # (module, commandType): data
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def queueCommand(self, module, commandType, data=0):
+        """ Queue a command, replacing a pending one of the same type
+
+        Args:
+            module (byte):      The module to address
+            commandType (byte): The command to send to the specified module
+            data (int):         The data that goes with the command (if any)
+        """
+
+        key = (module, commandType)
+
+        with self.__lock:
+            self.queuedCount += 1
+            if key in self.__pending:
+                self.coalescedCount += 1
+                self.__pending.move_to_end(key)
+            self.__pending[key] = data
+            budgetReached = len(self.__pending) * FRAME_SIZE >= self.maxBytes
+
+        if budgetReached:
+            self.flush()
+
+    def discard(self, module=None):
+        """ Drop pending commands without sending them
+
+        Args:
+            module (byte): Only drop the commands for this module
+        """
+
+        with self.__lock:
+            if module is None:
+                self.__pending.clear()
+                return
+            for key in [key for key in self.__pending if key[0] == module]:
+                del self.__pending[key]
+
+    def flush(self):
+        """ Send all pending commands with a single write
+
+        Returns:
+            The messageIDs of the sent messages, an empty list if
+            nothing was pending or None if not connected
+        """
+
+        with self.__lock:
+            if not self.__pending:
+                return []
+            commands = [(module, commandType, data) for
+                        (module, commandType), data in self.__pending.items()]
+            self.__pending.clear()
+
+        messageIDs = self.hardwareController.sendMessages(commands,
+                                                          track=self.track)
+        if messageIDs:
+            self.sentCount += len(messageIDs)
+            self.flushCount += 1
+
+        return messageIDs
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import queue
+import selectors
+import threading
+from collections import OrderedDict
+from time import monotonic
+from hardware_controller import *
+from metrics import Metrics
+from reconnect import Backoff
+
+
+class ControllerPool():
+
+    """ Several Arduino links served by one I/O thread
+
+    Boards with e.g. separate motor and sensor microcontrollers have a
+    HardwareController per serial port. Instead of a reader thread per
+    port, a single thread waits on all ports with a selector and reads
+    whichever port has data. The messages of all links end up in one
+    recvMessageQueue in the order they were read, so the robot drains
+    and dispatches them exactly like those of a single controller.
+
+    Commands are routed to a link by their module using moduleMap.
+    Modules that are not in the map go to the defaultLink.
+
+    The pool has the connection, send and receive interface of a
+    HardwareController, so Robot can use it in place of one. Links
+    that drop are reconnected one by one by reconnect, each with its
+    own Backoff, while the other links keep running.
+    """
+
+    READER_POLL_INTERVAL = HardwareController.READER_POLL_INTERVAL
+
+    def __init__(self, moduleMap=None, defaultLink=None, recvQueueSize=256,
+                 overflowPolicy=OVERFLOW_DROP_OLDEST, metrics=None):
+        """ Sets up an empty pool
+
+        Args:
+            moduleMap (dict): Maps a module to the name of its link,
+                              e.g. {MODULE_MOTOR: 'motor'}
+            defaultLink (str): Link for modules not in moduleMap,
+                               defaults to the first link added
+            recvQueueSize (int): Maximum number of messages in the
+                                 merged recvMessageQueue
+            overflowPolicy (str): See MessageQueue
+            metrics (Metrics): Registry the metrics of every link are
+                               added to as source 'link.<name>'
+        """
+
+        self.moduleMap = dict(moduleMap or {})
+        self.defaultLink = defaultLink
+        self.recvMessageQueue = MessageQueue(recvQueueSize, overflowPolicy)
+        self.metrics = metrics or Metrics()
+        self.links = OrderedDict()      # name: (HardwareController, args)
+        self.recoveryTime = self.metrics.histogram('pool.recoveryTime')
+        self.__backoffs = {}            # name: Backoff
+        self.__nextAttempts = {}        # name: monotonic() of next attempt
+        self.__disconnectTimes = {}     # name: monotonic() link was lost
+        self.__readerThread = None
+        self.__stopReader = threading.Event()
+
+    def addLink(self, name, serialPort, baudrate=9600, handshakeTimeout=0):
+        """ Add a serial link to the pool
+
+        The link is connected by initialize.
+
+        Args:
+            name (str): Name of the link used in the moduleMap
+            serialPort (str): The serial port of the Arduino
+            baudrate (int): The baudrate of the serial connection
+            handshakeTimeout (float): See HardwareController.initialize,
+                                      0 skips the handshake. Robot
+                                      reconnects links from the control
+                                      loop, which waits this long for a
+                                      sketch that does not answer it.
+
+        Returns:
+            The HardwareController of the link
+        """
+
+        if name in self.links:
+            raise ValueError("Link %s already exists" % name)
+
+        controller = HardwareController(recvQueueSize=0)
+        self.links[name] = (controller, (serialPort, baudrate,
+                                         handshakeTimeout))
+        self.metrics.addSource('link.%s' % name, controller.metrics.snapshot)
+        if self.defaultLink is None:
+            self.defaultLink = name
+        return controller
+
+    def initialize(self):
+        """ Connect all links that are not connected
+
+        Returns:
+            True if all links are connected
+        """
+
+        for name, (controller, (serialPort, baudrate,
+                                handshakeTimeout)) in self.links.items():
+            if not controller.isConnected:
+                controller.initialize(serialPort, baudrate,
+                                      handshakeTimeout=handshakeTimeout)
+        return self.isConnected
+
+    def reconnect(self, now=None):
+        """ Try to reconnect the links that are not connected
+
+        Only links whose Backoff delay passed are tried, and links
+        whose device node is missing are skipped, so a link that is
+        gone costs the control loop nothing between attempts. The time
+        from losing a link until it is connected again is recorded in
+        the 'pool.recoveryTime' histogram.
+
+        Args:
+            now (float): monotonic() of the caller
+
+        Returns:
+            True if all links are connected
+        """
+
+        if now is None:
+            now = monotonic()
+
+        for name, (controller, (serialPort, baudrate,
+                                handshakeTimeout)) in self.links.items():
+            if controller.isConnected:
+                continue
+            if name not in self.__disconnectTimes:
+                self.__disconnectTimes[name] = now
+                logging.warning("Lost connection to link %s", name)
+            if now < self.__nextAttempts.get(name, 0) or \
+                    (isinstance(serialPort, str) and
+                     not os.path.exists(serialPort)):
+                continue
+
+            controller.initialize(serialPort, baudrate,
+                                  handshakeTimeout=handshakeTimeout)
+            backoff = self.__backoffs.setdefault(name, Backoff())
+            if controller.isConnected:
+                recovery = monotonic() - self.__disconnectTimes.pop(name)
+                self.recoveryTime.record(recovery)
+                logging.info("Reconnected link %s after %.3fs", name,
+                             recovery)
+                backoff.reset()
+                self.__nextAttempts.pop(name, None)
+            else:
+                self.__nextAttempts[name] = monotonic() + backoff.next()
+
+        return self.isConnected
+
+    @property
+    def isConnected(self):
+        """ True if every link is connected """
+        return all(controller.isConnected
+                   for controller, args in self.links.values())
+
+    @property
+    def acknowledges(self):
+        """ True if the Arduino of every link answered the handshake """
+        return all(controller.acknowledges
+                   for controller, args in self.links.values())
+
+    def controllerFor(self, module):
+        """ Returns the HardwareController handling module """
+
+        return self.links[self.moduleMap.get(module, self.defaultLink)][0]
+
+    def sendMessage(self, module, commandType, data=0, acknowledgeID=0,
+                    track=False):
+        """ Send a message on the link of its module
+
+        See HardwareController.sendMessage. messageIDs are only unique
+        per link.
+        """
+
+        return self.controllerFor(module).sendMessage(
+            module, commandType, data, acknowledgeID, track)
+
+    def sendMessages(self, commands, track=False):
+        """ Send messages with a single write per link
+
+        See HardwareController.sendMessages
+
+        Returns:
+            The messageIDs in the order of commands or None if a link
+            was not connected
+        """
+
+        commands = list(commands)
+        perLink = OrderedDict()
+        for index, command in enumerate(commands):
+            controller = self.controllerFor(command[0])
+            perLink.setdefault(controller, []).append((index, command))
+
+        messageIDs = [None] * len(commands)
+        connected = True
+        for controller, indexedCommands in perLink.items():
+            sentIDs = controller.sendMessages(
+                [command for index, command in indexedCommands], track)
+            if sentIDs is None:
+                connected = False
+                continue
+            for (index, command), messageID in zip(indexedCommands, sentIDs):
+                messageIDs[index] = messageID
+
+        return messageIDs if connected else None
+
+    def recvMessage(self):
+        """ Read all links once without blocking
+
+        For use without the I/O thread, e.g. from the control loop.
+        """
+
+        for controller, args in self.links.values():
+            if not controller.isConnected:
+                continue
+            controller.serialPort.timeout = 0
+            try:
+                messages = controller.readMessages()
+            except (OSError, serial.SerialException) as e:
+                logging.error("Reading serial port failed: %s", e)
+                controller.isConnected = False
+                continue
+            for message in messages:
+                self.recvMessageQueue.put(message)
+
+    @property
+    def readerRunning(self):
+        """ True if the I/O thread is active """
+        return self.__readerThread is not None and \
+            self.__readerThread.is_alive()
+
+    def startReader(self):
+        """ Start reading all links in a single background thread """
+
+        if self.readerRunning:
+            return
+
+        self.__stopReader.clear()
+        self.__readerThread = threading.Thread(target=self.__readerLoop,
+                                               name='morTimmy-pool-reader',
+                                               daemon=True)
+        self.__readerThread.start()
+        logging.info("Started pool reader thread for %d links",
+                     len(self.links))
+
+    def stopReader(self, timeout=None):
+        """ Stop the I/O thread
+
+        Args:
+            timeout (float): Seconds to wait for the thread to finish,
+                             None waits until it has stopped
+        """
+
+        if self.__readerThread is None:
+            return
+
+        self.__stopReader.set()
+        self.__readerThread.join(timeout)
+        self.__readerThread = None
+        logging.info("Stopped pool reader thread")
+
+    def __syncSelector(self, selector, registered):
+        """ Watch the serial port of every connected link
+
+        initialize() opens a new serial port on a reconnect, so the
+        registered ports are compared with the current ones every
+        iteration of the reader loop.
+        """
+
+        for name, (controller, args) in self.links.items():
+            serialPort = controller.serialPort if controller.isConnected \
+                else None
+            current = registered.get(name)
+            if current is not None and current[0] is serialPort:
+                continue
+
+            if current is not None:
+                try:
+                    selector.unregister(current[1])
+                except (KeyError, ValueError):
+                    pass
+                del registered[name]
+
+            if serialPort is not None:
+                serialPort.timeout = 0
+                fileno = serialPort.fileno()
+                selector.register(fileno, selectors.EVENT_READ,
+                                  (name, controller))
+                registered[name] = (serialPort, fileno)
+
+    def __readerLoop(self):
+        """ Main loop of the I/O thread """
+
+        selector = selectors.DefaultSelector()
+        registered = {}     # name: (serialPort, fileno)
+
+        try:
+            while not self.__stopReader.is_set():
+                self.__syncSelector(selector, registered)
+                if not registered:
+                    self.__stopReader.wait(self.READER_POLL_INTERVAL)
+                    continue
+
+                for key, mask in selector.select(self.READER_POLL_INTERVAL):
+                    name, controller = key.data
+                    try:
+                        messages = controller.readMessages()
+                    except (OSError, serial.SerialException) as e:
+                        logging.error("Link %s failed: %s", name, e)
+                        controller.isConnected = False
+                        continue
+                    for message in messages:
+                        self.__queueMessage(message)
+
+                # Retransmit timed out messages on idle links as well
+                for controller, args in self.links.values():
+                    if controller.isConnected:
+                        controller.messageTracker.checkTimeouts()
+        finally:
+            selector.close()
+
+    def __queueMessage(self, message):
+        """ Put a message on the recvMessageQueue from the I/O thread
+
+        A full queue with OVERFLOW_BLOCK policy blocks the I/O thread
+        until there is room or the reader is stopped.
+        """
+
+        while not self.__stopReader.is_set():
+            try:
+                self.recvMessageQueue.put(message,
+                                          timeout=self.READER_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+from array import array
+from bisect import bisect_left, insort
+
+
+class RingBuffer():
+
+    """ Fixed size buffer holding the most recent samples
+
+    The samples are stored in a preallocated array of doubles. Adding
+    a sample overwrites the oldest one once the buffer is full, so no
+    list has to be shifted or grown.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("RingBuffer size must be at least 1")
+
+        self.size = size
+        self.__samples = array('d', bytes(8 * size))
+        self.__index = 0        # position of the next sample
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, sample):
+        """ Add a sample
+
+        Returns:
+            The sample that was overwritten or None if the buffer
+            was not full yet
+        """
+
+        oldest = self.__samples[self.__index] \
+            if self.__count == self.size else None
+        self.__samples[self.__index] = sample
+        self.__index = (self.__index + 1) % self.size
+        if self.__count < self.size:
+            self.__count += 1
+        return oldest
+
+    def clear(self):
+        self.__index = 0
+        self.__count = 0
+
+    def values(self):
+        """ Returns the samples as a list from oldest to newest """
+
+        if self.__count < self.size:
+            return self.__samples[:self.__count].tolist()
+        return (self.__samples[self.__index:] +
+                self.__samples[:self.__index]).tolist()
+
+
+class DistanceFilter():
+
+    """ Generic class for filtering distance sensor readings
+
+    A filter is fed every new sample with update() and keeps its
+    current estimate in the estimate attribute, which is None until
+    the first sample arrives. Every filter updates in constant time
+    per sample.
+    """
+
+    estimate = None
+
+    def update(self, sample):
+        """ Add a sample and return the new estimate """
+        raise NotImplementedError
+
+    def reset(self):
+        """ Forget all samples """
+        self.estimate = None
+
+
+class RunningMeanFilter(DistanceFilter):
+
+    """ Mean of the last window samples, kept as a running sum """
+
+    def __init__(self, window=3):
+        self.__samples = RingBuffer(window)
+        self.__sum = 0.0
+
+    def update(self, sample):
+        oldest = self.__samples.append(sample)
+        self.__sum += sample
+        if oldest is not None:
+            self.__sum -= oldest
+        self.estimate = self.__sum / len(self.__samples)
+        return self.estimate
+
+    def reset(self):
+        self.__samples.clear()
+        self.__sum = 0.0
+        self.estimate = None
+
+
+class ExponentialMovingAverageFilter(DistanceFilter):
+
+    """ Exponential moving average
+
+    Args:
+        alpha (float): Weight of a new sample between 0 and 1, a higher
+                       value follows changes faster but smooths less
+    """
+
+    def __init__(self, alpha=0.5):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be between 0 and 1")
+        self.alpha = alpha
+
+    def update(self, sample):
+        if self.estimate is None:
+            self.estimate = float(sample)
+        else:
+            self.estimate += self.alpha * (sample - self.estimate)
+        return self.estimate
+
+
+class MedianFilter(DistanceFilter):
+
+    """ Median of the last window samples
+
+    Rejects single bad echoes of the ultrasonic sensor which would skew
+    a mean. Next to the ring buffer a sorted copy of the window is
+    kept, so an update only removes the oldest and inserts the newest
+    sample instead of sorting the whole window.
+    """
+
+    def __init__(self, window=3):
+        self.__samples = RingBuffer(window)
+        self.__sorted = []
+
+    def update(self, sample):
+        oldest = self.__samples.append(sample)
+        if oldest is not None:
+            del self.__sorted[bisect_left(self.__sorted, oldest)]
+        insort(self.__sorted, sample)
+
+        middle = len(self.__sorted) // 2
+        if len(self.__sorted) % 2:
+            self.estimate = self.__sorted[middle]
+        else:
+            self.estimate = (self.__sorted[middle - 1] +
+                             self.__sorted[middle]) / 2.0
+        return self.estimate
+
+    def reset(self):
+        self.__samples.clear()
+        self.__sorted = []
+        self.estimate = None
+
+
+class KalmanFilter(DistanceFilter):
+
+    """ One dimensional Kalman filter for a slowly changing distance
+
+    Args:
+        processNoise (float): Expected variance of the distance change
+                              between two samples
+        measurementNoise (float): Variance of the sensor readings
+    """
+
+    def __init__(self, processNoise=1.0, measurementNoise=4.0):
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.errorEstimate = None
+
+    def update(self, sample):
+        if self.estimate is None:
+            self.estimate = float(sample)
+            self.errorEstimate = self.measurementNoise
+            return self.estimate
+
+        errorEstimate = self.errorEstimate + self.processNoise
+        gain = errorEstimate / (errorEstimate + self.measurementNoise)
+        self.estimate += gain * (sample - self.estimate)
+        self.errorEstimate = (1 - gain) * errorEstimate
+        return self.estimate
+
+    def reset(self):
+        self.estimate = None
+        self.errorEstimate = None
+
+
+class FilterChain(DistanceFilter):
+
+    """ Feeds the estimate of each filter into the next one
+
+    e.g. FilterChain(MedianFilter(5), ExponentialMovingAverageFilter(0.3))
+    first rejects spikes and then smooths the result.
+    """
+
+    def __init__(self, *filters):
+        self.filters = filters
+
+    def update(self, sample):
+        for distanceFilter in self.filters:
+            sample = distanceFilter.update(sample)
+        self.estimate = sample
+        return self.estimate
+
+    def reset(self):
+        for distanceFilter in self.filters:
+            distanceFilter.reset()
+        self.estimate = None
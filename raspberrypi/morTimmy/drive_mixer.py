@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+from array import array
+from math import sqrt
+from time import monotonic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAX_SPEED = 255         # full speed of the motors and joystick axes
+
+
+class DriveMixer():
+
+    """ Turns joystick positions into left and right motor speeds
+
+    Each joystick axis is shaped by a lookup table computed once from
+    the deadzone and expo settings:
+
+      deadzone  positions closer to the center than this count as 0,
+                the remaining range is stretched to 0..MAX_SPEED
+      expo      0 is linear, 1 is fully cubic; higher values give
+                finer control around the center
+
+    The shaped axes are mixed for a differential drive, x steers to
+    the right and y drives forward:
+
+      left = y + x
+      right = y - x
+
+    When one side would exceed MAX_SPEED both sides are scaled down
+    so the robot keeps turning with the same radius.
+
+    mix() is stateless. update() additionally limits how fast the
+    motor speeds change (maxSlewRate, speed units per second) and how
+    fast that rate of change itself changes (maxAcceleration, speed
+    units per second squared), which spares the gears and keeps the
+    robot from tipping over on a full reverse.
+    """
+
+    def __init__(self, deadzone=16, expo=0.3, maxSlewRate=None,
+                 maxAcceleration=None, clock=monotonic):
+        """ Builds the lookup table
+
+        Args:
+            deadzone (int): Joystick positions within this distance of
+                            the center are ignored
+            expo (float): Amount of cubic expo, 0 to 1
+            maxSlewRate (float): Max speed change per second or None
+            maxAcceleration (float): Max change of the speed change
+                                     per second squared or None
+            clock (function): Returns the time in seconds for update
+        """
+
+        if not 0 <= deadzone < MAX_SPEED:
+            raise ValueError("Deadzone must be between 0 and %d" % MAX_SPEED)
+        if not 0 <= expo <= 1:
+            raise ValueError("Expo must be between 0 and 1")
+
+        self.deadzone = deadzone
+        self.expo = expo
+        self.maxSlewRate = maxSlewRate
+        self.maxAcceleration = maxAcceleration
+        self.clock = clock
+
+        # shaped value of every position -MAX_SPEED..MAX_SPEED
+        self.table = array('h', (self.__shape(position) for position
+                                 in range(-MAX_SPEED, MAX_SPEED + 1)))
+        if numpy is not None:
+            self.__numpyTable = numpy.frombuffer(self.table, numpy.int16)
+
+        self.reset()
+
+    def __shape(self, position):
+        """ Applies the deadzone and expo to a single axis position """
+
+        magnitude = abs(position)
+        if magnitude <= self.deadzone:
+            return 0
+        normalized = (magnitude - self.deadzone) / (MAX_SPEED - self.deadzone)
+        shaped = (1 - self.expo) * normalized + self.expo * normalized ** 3
+        speed = int(round(shaped * MAX_SPEED))
+        return speed if position > 0 else -speed
+
+    def reset(self):
+        """ Forget the current speeds, the next update starts at 0 """
+
+        self.leftMotorSpeed = 0.0
+        self.rightMotorSpeed = 0.0
+        self.__leftRate = 0.0
+        self.__rightRate = 0.0
+        self.__lastUpdate = None
+
+    def mix(self, x, y):
+        """ Returns the (left, right) motor speeds for a joystick position
+
+        Args:
+            x (int): Steering, -MAX_SPEED (left) to MAX_SPEED (right)
+            y (int): Speed, -MAX_SPEED (back) to MAX_SPEED (forward)
+        """
+
+        table = self.table
+        x = table[min(MAX_SPEED, max(-MAX_SPEED, int(x))) + MAX_SPEED]
+        y = table[min(MAX_SPEED, max(-MAX_SPEED, int(y))) + MAX_SPEED]
+        left = y + x
+        right = y - x
+
+        largest = max(abs(left), abs(right))
+        if largest > MAX_SPEED:
+            left = int(left * MAX_SPEED / largest)
+            right = int(right * MAX_SPEED / largest)
+        return left, right
+
+    def update(self, x, y, dt=None):
+        """ Move the motor speeds towards a joystick position
+
+        Call this every control loop tick, also when the joystick did
+        not move, so the speeds keep ramping towards their target.
+
+        Args:
+            x (int): Steering, see mix
+            y (int): Speed, see mix
+            dt (float): Seconds since the last update, measured with
+                        the clock when None
+
+        Returns:
+            The rate limited (left, right) motor speeds
+        """
+
+        left, right = self.mix(x, y)
+        if self.maxSlewRate is None and self.maxAcceleration is None:
+            self.leftMotorSpeed = left
+            self.rightMotorSpeed = right
+            return left, right
+
+        if dt is None:
+            now = self.clock()
+            dt = 0 if self.__lastUpdate is None else now - self.__lastUpdate
+            self.__lastUpdate = now
+        if dt <= 0:
+            return int(self.leftMotorSpeed), int(self.rightMotorSpeed)
+
+        self.leftMotorSpeed, self.__leftRate = self.__limit(
+            self.leftMotorSpeed, self.__leftRate, left, dt)
+        self.rightMotorSpeed, self.__rightRate = self.__limit(
+            self.rightMotorSpeed, self.__rightRate, right, dt)
+        return int(round(self.leftMotorSpeed)), \
+            int(round(self.rightMotorSpeed))
+
+    def __limit(self, speed, rate, target, dt):
+        """ Returns the new (speed, rate) of one side """
+
+        error = target - speed
+        desired = error / dt
+        if self.maxSlewRate is not None:
+            desired = max(-self.maxSlewRate, min(self.maxSlewRate, desired))
+        if self.maxAcceleration is not None:
+            # Never faster than what we can still brake to 0 at target
+            braking = sqrt(2 * self.maxAcceleration * abs(error))
+            desired = max(-braking, min(braking, desired))
+            change = self.maxAcceleration * dt
+            desired = max(rate - change, min(rate + change, desired))
+            if abs(desired) * dt > abs(error) and desired * error >= 0:
+                # Could not brake in time, stop at the target
+                desired = error / dt
+        return speed + desired * dt, desired
+
+    def mixBatch(self, x, y, dt=None):
+        """ Mix arrays of joystick positions with NumPy
+
+        For replaying recordings and simulating many trajectories at
+        once. x and y have the shape (..., steps); the last axis is
+        time. Without rate limits every sample is mixed independently.
+        With rate limits each trajectory starts at speed 0 and the
+        steps are limited one after another, vectorized over all
+        trajectories.
+
+        Args:
+            x (array): Steering positions
+            y (array): Speed positions
+            dt (float): Seconds between steps, required for the rate
+                        limits
+
+        Returns:
+            (left, right) float arrays with the shape of x
+
+        Raises:
+            RuntimeError: NumPy is not installed
+        """
+
+        if numpy is None:
+            raise RuntimeError("NumPy is required for DriveMixer.mixBatch")
+
+        table = self.__numpyTable.astype(numpy.float64)
+        x = table[numpy.clip(numpy.asarray(x, numpy.int64),
+                             -MAX_SPEED, MAX_SPEED) + MAX_SPEED]
+        y = table[numpy.clip(numpy.asarray(y, numpy.int64),
+                             -MAX_SPEED, MAX_SPEED) + MAX_SPEED]
+        left = y + x
+        right = y - x
+
+        largest = numpy.maximum(numpy.abs(left), numpy.abs(right))
+        largest = numpy.maximum(largest, MAX_SPEED)
+        left = numpy.trunc(left * MAX_SPEED / largest)
+        right = numpy.trunc(right * MAX_SPEED / largest)
+
+        if self.maxSlewRate is None and self.maxAcceleration is None:
+            return left, right
+        if dt is None:
+            raise ValueError("dt is required for rate limiting")
+
+        return self.__limitBatch(left, dt), self.__limitBatch(right, dt)
+
+    def __limitBatch(self, targets, dt):
+        """ Rate limit the targets along the last axis """
+
+        limited = numpy.empty_like(targets)
+        speed = numpy.zeros(targets.shape[:-1])
+        rate = numpy.zeros(targets.shape[:-1])
+
+        for step in range(targets.shape[-1]):
+            error = targets[..., step] - speed
+            desired = error / dt
+            if self.maxSlewRate is not None:
+                desired = numpy.clip(desired, -self.maxSlewRate,
+                                     self.maxSlewRate)
+            if self.maxAcceleration is not None:
+                braking = numpy.sqrt(2 * self.maxAcceleration *
+                                     numpy.abs(error))
+                desired = numpy.clip(desired, -braking, braking)
+                change = self.maxAcceleration * dt
+                desired = numpy.clip(desired, rate - change, rate + change)
+                overshoot = (numpy.abs(desired) * dt > numpy.abs(error)) & \
+                    (desired * error >= 0)
+                desired = numpy.where(overshoot, error / dt, desired)
+            speed = speed + desired * dt
+            rate = desired
+            limited[..., step] = speed
+
+        return limited
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import struct
+import threading
+from time import monotonic, sleep
+
+# Recording file layout
+#
+#  +--------+---------+--------+--------+-----+--------+
+#  | HEADER | VERSION | RECORD | RECORD | ... | RECORD |
+#  +--------+---------+--------+--------+-----+--------+
+#
+# Every record holds the raw bytes of one serial read or write:
+#
+#  +-------------------------+-----------+--------+------+
+#  | timestamp (double, sec) | direction | length | data |
+#  +-------------------------+-----------+--------+------+
+
+RECORDING_HEADER = b'MTFR'
+RECORDING_VERSION = 1
+RECORD_STRUCT = struct.Struct('<dBH')
+MAX_RECORD_SIZE = 0xffff
+
+DIRECTION_RECV = 0      # bytes read from the Arduino
+DIRECTION_SEND = 1      # bytes written to the Arduino
+REPLAY_LOG_FILENAME = 'my_morTimmy.replay.log'   # log of replay(useRobot=True)
+
+
+class FlightRecorder():
+
+    """ Records all raw serial traffic to a compact binary file
+
+    Every read from and write to the serial port is appended as a
+    length prefixed record with a monotonic timestamp. Records are
+    written through a buffered file, so recording costs one struct
+    pack and a memory copy per read or write and is cheap enough to
+    leave on in production. The buffer is flushed at least every
+    flushInterval seconds.
+
+    Like logging.handlers.RotatingFileHandler the recording rotates to
+    filename.1, filename.2, ... once it grows beyond maxBytes, keeping
+    backupCount old recordings.
+    """
+
+    def __init__(self, filename, maxBytes=1024 * 1024, backupCount=5,
+                 flushInterval=1.0):
+        """ Opens the recording
+
+        Args:
+            filename (str): The recording file
+            maxBytes (int): Rotate the file when it exceeds this size
+            backupCount (int): Number of rotated recordings to keep
+            flushInterval (float): Max seconds between buffer flushes
+        """
+
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.flushInterval = flushInterval
+        self.recordCount = 0
+
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__size = 0
+        self.__lastFlush = monotonic()
+        self.__open()
+
+    def __open(self):
+        self.__file = open(self.filename, 'ab')
+        self.__size = self.__file.tell()
+        if self.__size == 0:
+            self.__file.write(RECORDING_HEADER)
+            self.__file.write(bytes([RECORDING_VERSION]))
+            self.__size = len(RECORDING_HEADER) + 1
+
+    def __rotate(self):
+        self.__file.close()
+        for index in range(self.backupCount - 1, 0, -1):
+            source = "%s.%d" % (self.filename, index)
+            if os.path.exists(source):
+                os.replace(source, "%s.%d" % (self.filename, index + 1))
+        if self.backupCount > 0:
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self.__open()
+
+    def record(self, direction, data):
+        """ Append the bytes of a serial read or write
+
+        Args:
+            direction (int): DIRECTION_RECV or DIRECTION_SEND
+            data (bytes): The raw bytes, longer writes are split
+                          over several records
+        """
+
+        if not data:
+            return
+
+        now = monotonic()
+        data = memoryview(data)
+
+        with self.__lock:
+            if self.__file is None:
+                return
+
+            for start in range(0, len(data), MAX_RECORD_SIZE):
+                part = data[start:start + MAX_RECORD_SIZE]
+                self.__file.write(RECORD_STRUCT.pack(now, direction,
+                                                     len(part)))
+                self.__file.write(part)
+                self.__size += RECORD_STRUCT.size + len(part)
+                self.recordCount += 1
+
+            if self.__size >= self.maxBytes:
+                self.__rotate()
+            elif now - self.__lastFlush >= self.flushInterval:
+                self.__file.flush()
+                self.__lastFlush = now
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+
+def recordingFiles(filename):
+    """ Returns the rotated recordings and filename, oldest first """
+
+    index = 1
+    files = []
+    while os.path.exists("%s.%d" % (filename, index)):
+        files.insert(0, "%s.%d" % (filename, index))
+        index += 1
+    if os.path.exists(filename):
+        files.append(filename)
+    return files
+
+
+def readRecording(filename):
+    """ Read the records of a recording file
+
+    Yields:
+        (timestamp, direction, data) tuples
+
+    Raises:
+        ValueError: The file is not a flight recording
+    """
+
+    with open(filename, 'rb') as recording:
+        header = recording.read(len(RECORDING_HEADER) + 1)
+        if header[:len(RECORDING_HEADER)] != RECORDING_HEADER:
+            raise ValueError("%s is not a flight recording" % filename)
+
+        while True:
+            recordHeader = recording.read(RECORD_STRUCT.size)
+            if len(recordHeader) < RECORD_STRUCT.size:
+                return
+            timestamp, direction, length = RECORD_STRUCT.unpack(recordHeader)
+            data = recording.read(length)
+            if len(data) < length:
+                # Recording was cut off, e.g. by a power failure
+                return
+            yield timestamp, direction, data
+
+
+class ReplaySerialPort():
+
+    """ Serial port stand-in that plays back a recording
+
+    The received bytes of the recording are returned by read() either
+    with the original timing (realtime) or as fast as they are read.
+    Written bytes are counted and discarded. An instance can be passed
+    to HardwareController.initialize instead of a port name.
+    """
+
+    def __init__(self, records, realtime=True):
+        """ Sets up the replay
+
+        Args:
+            records (iterable): (timestamp, direction, data) tuples,
+                                see readRecording
+            realtime (bool): Keep the original timing between reads
+        """
+
+        self.realtime = realtime
+        self.timeout = None
+        self.finished = False
+        self.bytesWritten = 0
+
+        self.__records = (record for record in records
+                          if record[1] == DIRECTION_RECV)
+        self.__next = None
+        self.__pending = bytearray()
+        self.__startTime = None
+        self.__firstTimestamp = None
+
+    @property
+    def dtr(self):
+        return False
+
+    @dtr.setter
+    def dtr(self, level):
+        raise OSError("Replayed port has no DTR line")
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self.finished = True
+
+    def __release(self, block):
+        """ Move the records that are due into the pending bytes """
+
+        while True:
+            if self.__next is None:
+                self.__next = next(self.__records, None)
+                if self.__next is None:
+                    self.finished = True
+                    return
+
+            timestamp = self.__next[0]
+            if self.__startTime is None:
+                self.__startTime = monotonic()
+                self.__firstTimestamp = timestamp
+
+            if self.realtime:
+                delay = (timestamp - self.__firstTimestamp) - \
+                    (monotonic() - self.__startTime)
+                if delay > 0:
+                    if not block or self.__pending:
+                        return
+                    if self.timeout is not None:
+                        delay = min(delay, self.timeout)
+                    sleep(delay)
+                    block = False
+                    continue
+            elif self.__pending:
+                return
+
+            self.__pending += self.__next[2]
+            self.__next = None
+
+    @property
+    def in_waiting(self):
+        self.__release(block=False)
+        return len(self.__pending)
+
+    def read(self, size=1):
+        if not self.__pending:
+            self.__release(block=self.timeout != 0)
+        data = bytes(self.__pending[:size])
+        del self.__pending[:size]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+        return len(data)
+
+
+def replay(filename, realtime=True, useRobot=False):
+    """ Feed a recording through the HardwareController decode path
+
+    Args:
+        filename (str): The recording, rotated files are included
+        realtime (bool): Replay with the original timing
+        useRobot (bool): Drive Robot.run with the recording instead
+                         of only decoding the messages
+
+    Returns:
+        The HardwareController used for the replay
+    """
+
+    # Imported here to avoid a circular import with hardware_controller
+    from hardware_controller import HardwareController
+
+    def records():
+        for recordingFile in recordingFiles(filename):
+            for record in readRecording(recordingFile):
+                yield record
+
+    serialPort = ReplaySerialPort(records(), realtime)
+
+    if useRobot:
+        from morTimmy import Robot
+        from robot_logging import stopLogging
+        # Keep the log of the robot that made the recording
+        robot = Robot(serialPort=serialPort, handshakeTimeout=0,
+                      watchdogDeadline=None,
+                      logFilename=REPLAY_LOG_FILENAME)
+        try:
+            while not (serialPort.finished and
+                       robot.arduino.recvMessageQueue.empty()):
+                robot.run()
+        finally:
+            stopLogging(robot.logListener)
+        return robot.arduino
+
+    arduino = HardwareController(recvQueueSize=0)
+    arduino.initialize(serialPort=serialPort, handshakeTimeout=0)
+    while not serialPort.finished:
+        arduino.recvMessage()
+    return arduino
+
+
+def main():
+    """ Replay or dump a flight recording """
+
+    parser = argparse.ArgumentParser(
+        description="Replay or dump a morTimmy flight recording")
+    parser.add_argument('command', choices=['replay', 'dump'])
+    parser.add_argument('filename')
+    parser.add_argument('--fast', action='store_true',
+                        help='replay as fast as possible')
+    parser.add_argument('--robot', action='store_true',
+                        help='drive Robot.run with the recording')
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        firstTimestamp = None
+        for recordingFile in recordingFiles(args.filename):
+            for timestamp, direction, data in readRecording(recordingFile):
+                if firstTimestamp is None:
+                    firstTimestamp = timestamp
+                print("%10.4f %s %s" % (timestamp - firstTimestamp,
+                                        '<' if direction == DIRECTION_RECV
+                                        else '>', data.hex()))
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    arduino = replay(args.filename, realtime=not args.fast,
+                     useRobot=args.robot)
+    print("Replayed %d messages, %d invalid" %
+          (arduino.recvMessageQueue.qsize(), arduino.invalidMessageCount))
+
+
+if __name__ == '__main__':
+    main()
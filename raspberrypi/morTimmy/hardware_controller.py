@@ -3,44 +3,482 @@
 import serial			    # pyserial library for serial communications
 import struct 	         	# Python struct library for constructing the message
 import queue
+import threading
 from zlib import crc32      # used to calculate a message checksum
-from time import sleep
+from time import sleep, monotonic
 import logging
-
-# Definitions
+import re
+import os
+from message_tracker import MessageTracker
+from distance_filter import MedianFilter
+from flight_recorder import DIRECTION_RECV, DIRECTION_SEND
+from metrics import Metrics
+from telemetry import SampleBuffer, TELEMETRY_MAX_SIZE, isTelemetry, \
+    unpackTelemetry
+
+# Definitions, see protocol.py for the modules and commands
+from protocol import *
 
 # Frames
-FRAME_FLAG = 0x0C       # Marks the start and end of a frame
-FRAME_ESC = 0x1B        # Escape char for frame
-
-# Arduino
-MODULE_ARDUINO = 0x30
-CMD_ARDUINO_START = 0x64
-CMD_ARDUINO_START_NACK = 0x65
-CMD_ARDUINO_STOP = 0x66
-CMD_ARDUINO_STOP_NACK = 0x67
-CMD_ARDUINO_RESTART = 0x68
-CMD_ARDUINO_RESTART_NACK = 0x69
-
-# Distance Sensor
-MODULE_DISTANCE_SENSOR = 0x31
-CMD_DISTANCE_SENSOR_START = 0x64
-CMD_DISTANCE_SENSOR_NACK = 0x65
-CMD_DISTANCE_SENSOR_STOP = 0x66
-CMD_DISTANCE_SENSOR_STOP_NACK = 0x67
-
-# Motor
-MODULE_MOTOR = 0x32
-CMD_MOTOR_FORWARD = 0x64
-CMD_MOTOR_FORWARD_NACK = 0x65
-CMD_MOTOR_BACK = 0x66
-CMD_MOTOR_BACK_NACK = 0x67
-CMD_MOTOR_LEFT = 0x68
-CMD_MOTOR_LEFT_NACK = 0x69
-CMD_MOTOR_RIGHT = 0x6A
-CMD_MOTOR_RIGHT_NACK = 0x6B
-CMD_MOTOR_STOP = 0x6C
-CMD_MOTOR_STOP_NACK = 0x6D
+FRAME_FLAG_BYTE = bytes([FRAME_FLAG])
+FRAME_ESC_BYTE = bytes([FRAME_ESC])
+ESCAPED_FRAME_FLAG = FRAME_ESC_BYTE + FRAME_FLAG_BYTE
+ESCAPED_FRAME_ESC = FRAME_ESC_BYTE + FRAME_ESC_BYTE
+ESCAPED_BYTE = re.compile(re.escape(FRAME_ESC_BYTE) + b'(.)', re.DOTALL)
+
+# Receive queue overflow policies
+OVERFLOW_DROP_OLDEST = 'drop_oldest'    # discard the oldest queued message
+OVERFLOW_DROP_NEWEST = 'drop_newest'    # discard the message being added
+OVERFLOW_BLOCK = 'block'                # wait until there is room
+
+
+class MessageQueue(queue.Queue):
+
+    """ Bounded queue holding the messages received from the Arduino
+
+    Only valid messages (Message tuples created by unpackMessage) are
+    put on this queue. When the queue is full the overflowPolicy decides
+    what happens with a new message so memory use stays capped when the
+    Arduino floods us with sensor readings.
+    """
+
+    def __init__(self, maxsize=256, overflowPolicy=OVERFLOW_DROP_OLDEST):
+        """ Sets up the queue
+
+        Args:
+            maxsize (int): Maximum number of queued messages
+            overflowPolicy (str): One of OVERFLOW_DROP_OLDEST,
+                                  OVERFLOW_DROP_NEWEST or OVERFLOW_BLOCK
+        """
+
+        if overflowPolicy not in (OVERFLOW_DROP_OLDEST,
+                                  OVERFLOW_DROP_NEWEST,
+                                  OVERFLOW_BLOCK):
+            raise ValueError("Unknown overflow policy %s" % overflowPolicy)
+
+        queue.Queue.__init__(self, maxsize)
+        self.overflowPolicy = overflowPolicy
+        self.droppedMessages = 0
+
+    def put(self, item, block=True, timeout=None):
+        """ Put a message on the queue applying the overflow policy
+
+        With OVERFLOW_BLOCK this behaves like queue.Queue.put and
+        raises queue.Full when the timeout expires.
+        """
+
+        if self.overflowPolicy == OVERFLOW_BLOCK:
+            return queue.Queue.put(self, item, block, timeout)
+
+        with self.mutex:
+            if 0 < self.maxsize <= self._qsize():
+                self.droppedMessages += 1
+                if self.overflowPolicy == OVERFLOW_DROP_NEWEST:
+                    return
+                # Replace the oldest message, the number of
+                # unfinished tasks stays the same
+                self._get()
+            else:
+                self.unfinished_tasks += 1
+            self._put(item)
+            self.not_empty.notify()
+
+    def getBatch(self, maxItems=None):
+        """ Remove and return the queued messages without blocking
+
+        All messages are taken while holding the lock once instead of
+        once per message.
+
+        Args:
+            maxItems (int): Return at most this many messages, None
+                            returns everything queued
+
+        Returns:
+            A list with the messages, oldest first
+        """
+
+        with self.mutex:
+            count = self._qsize()
+            if maxItems is not None:
+                count = min(count, maxItems)
+            messages = [self._get() for i in range(count)]
+            if messages:
+                self.not_full.notify_all()
+            return messages
+
+
+class ReceiveBuffer():
+
+    """ Fixed capacity receive buffer decoding frames in place
+
+    Bytes are read from the serial port straight into a preallocated
+    bytearray with readinto, or with os.readv on the file descriptor
+    when the port has data waiting, so no bytes object is created per
+    read. Frames are searched for with bytearray.find and handed out
+    as memoryview slices of the buffer, only frames containing an
+    escaped byte are copied to unescape them.
+
+    Instead of wrapping around, the partial frame at the end of the
+    buffer is moved to the front once there is no room for the next
+    read. This keeps every frame contiguous. A partial frame is at most
+    twice the maximum message size, so a move is cheap and rare.
+
+    The returned frames and read bytes are views on the buffer and are
+    only valid until the next call of readFrom.
+
+    A FRAME_FLAG that is not preceded by a FRAME_ESC marks the boundary
+    of a frame. Since the end flag of one frame and the start flag of
+    the next can follow each other directly, empty frames are ignored.
+    This also resynchronises the buffer when it starts reading halfway
+    through a frame; the resulting partial message will fail the
+    checksum test in unpackMessage.
+    """
+
+    def __init__(self, capacity=4096, maxMessageSize=MESSAGE_SIZE):
+        """ Allocates the buffer
+
+        Args:
+            capacity (int): Size of the buffer in bytes
+            maxMessageSize (int): The largest unescaped message we
+                                  expect. Frames exceeding this are
+                                  discarded.
+        """
+
+        # Room for an escaped partial frame and a decent read
+        if capacity < 4 * maxMessageSize:
+            raise ValueError("ReceiveBuffer capacity must be at least "
+                             "%d bytes" % (4 * maxMessageSize))
+
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.__view = memoryview(self.buffer)
+        self.__maxMessageSize = maxMessageSize
+        self.__serialPort = None
+        self.__fileno = None
+        self.overflowCount = 0      # number of discarded oversized frames
+        self.highWaterMark = 0      # most bytes buffered at once
+        self.largestRead = 0        # most bytes read at once
+        self.compactionCount = 0    # number of partial frames moved
+        self.reset()
+
+    def reset(self):
+        """ Discards all buffered bytes """
+
+        self.__start = 0            # start of the current frame body
+        self.__scan = 0             # where to look for the next FRAME_FLAG
+        self.__end = 0              # end of the buffered bytes
+        self.__foundStartOfFrame = False
+        self.__discarding = False
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def __makeRoom(self, size):
+        """ Move the partial frame to the front if size bytes do not fit """
+
+        if self.capacity - self.__end >= size:
+            return
+
+        if self.__start == self.__end:
+            self.__start = self.__scan = self.__end = 0
+            return
+
+        length = self.__end - self.__start
+        self.__view[:length] = self.__view[self.__start:self.__end]
+        self.__scan -= self.__start
+        self.__start = 0
+        self.__end = length
+        self.compactionCount += 1
+
+    def __readInto(self, serialPort, view, waiting):
+        """ Read into view, directly from the file descriptor if possible
+
+        pyserial implements readinto with read, so when the port has
+        data waiting we read from its file descriptor ourselves.
+        Otherwise readinto blocks according to the port timeout.
+        """
+
+        if serialPort is not self.__serialPort:
+            self.__serialPort = serialPort
+            try:
+                self.__fileno = serialPort.fileno()
+            except (AttributeError, OSError, ValueError):
+                self.__fileno = None
+
+        if waiting and self.__fileno is not None and hasattr(os, 'readv'):
+            try:
+                return os.readv(self.__fileno, [view])
+            except BlockingIOError:
+                return 0
+        return serialPort.readinto(view) or 0
+
+    def readFrom(self, serialPort, waiting):
+        """ Read the waiting bytes from the serial port
+
+        Args:
+            serialPort: Port with readinto, e.g. a serial.Serial
+            waiting (int): Bytes waiting on the port, 0 reads a single
+                           byte which blocks according to the timeout
+                           of the port
+
+        Returns:
+            A memoryview of the bytes read
+        """
+
+        size = waiting or 1
+        self.__makeRoom(size)
+
+        end = self.__end
+        view = self.__view[end:min(end + size, self.capacity)]
+        count = self.__readInto(serialPort, view, waiting)
+        self.__end = end + count
+
+        if count > self.largestRead:
+            self.largestRead = count
+        if self.__end - self.__start > self.highWaterMark:
+            self.highWaterMark = self.__end - self.__start
+        return self.__view[end:end + count]
+
+    def frames(self):
+        """ Returns the frames completed by the bytes read so far
+
+        Returns:
+            A list with the unescaped message of every completed frame,
+            as memoryview or, when it had to be unescaped, bytes
+        """
+
+        buffer = self.buffer
+        find = buffer.find
+        view = self.__view
+        end = self.__end
+        maxMessageSize = self.__maxMessageSize
+        frames = []
+        append = frames.append
+
+        if not self.__foundStartOfFrame:
+            # Wait for the first FRAME_FLAG
+            flag = buffer.find(FRAME_FLAG, self.__start, end)
+            if flag < 0:
+                self.__start = self.__scan = end
+                return frames
+            self.__start = self.__scan = flag + 1
+            self.__foundStartOfFrame = True
+
+        start = self.__start
+        discarding = self.__discarding
+        escape = find(FRAME_ESC, start, end)
+        if escape < 0:
+            escape = end
+        flag = find(FRAME_FLAG, self.__scan, end)
+
+        while flag >= 0:
+            if escape < flag:
+                # The frame holds escaped bytes. A FRAME_FLAG after
+                # an odd number of FRAME_ESC is escaped itself
+                run = flag - 1
+                while run >= start and buffer[run] == FRAME_ESC:
+                    run -= 1
+                if (flag - 1 - run) % 2:
+                    flag = find(FRAME_FLAG, flag + 1, end)
+                    continue
+
+                if discarding:
+                    discarding = False
+                else:
+                    frame = unescapeMessage(bytes(view[start:flag]))
+                    if len(frame) <= maxMessageSize:
+                        append(frame)
+                    else:
+                        self.overflowCount += 1
+            elif discarding:
+                discarding = False
+            elif flag > start:
+                if flag - start <= maxMessageSize:
+                    append(view[start:flag])
+                else:
+                    self.overflowCount += 1
+
+            start = flag + 1
+            if escape < start:
+                escape = find(FRAME_ESC, start, end)
+                if escape < 0:
+                    escape = end
+            flag = find(FRAME_FLAG, start, end)
+
+        self.__discarding = discarding
+        scan = end
+        if end - start > 2 * maxMessageSize:
+            # Far too long for a frame, skip until the next FRAME_FLAG.
+            # We only need to keep a FRAME_ESC that escapes it
+            if not self.__discarding:
+                self.overflowCount += 1
+                self.__discarding = True
+            escape = end - 1
+            while escape >= start and buffer[escape] == FRAME_ESC:
+                escape -= 1
+            start = end - (end - 1 - escape) % 2
+
+        self.__start = start
+        self.__scan = scan
+        return frames
+
+
+def packMessageInto(buffer, messageID, module, commandType, data=0,
+                    acknowledgeID=0):
+    """ Packs a message understood by the Arduino into a buffer
+
+    The message is packed once with the checksum field set to 0. The
+    checksum is then calculated over the packed message and written
+    into the checksum field in place.
+
+      Message structure
+    +-----------+---------------+--------+-------------+------+----------+
+    | messageID | acknowledgeID | module | commandType | data | checksum |
+    +-----------+---------------+--------+-------------+------+----------+
+
+    Args:
+        buffer:        (bytearray, at least MESSAGE_SIZE bytes)
+        messageID:     (unsigned long, 4 bytes, numeric id of the message)
+        module:        (unsigned char, 1 byte, arduino module to target)
+        commandType:   (unsigned char, 1 byte, Type of command to send)
+        data:          (unsigned long, 4 bytes, the data payload)
+        acknowledgeID: (unsigned long, 4 bytes, messageID we reply to)
+    """
+
+    MESSAGE_STRUCT.pack_into(buffer, 0, messageID, acknowledgeID,
+                             module, commandType, data, 0)
+
+    # & 0xffffffff is ensuring the checksum is an unsigned long
+    # as 32bit python sometimes returns a signed int
+    with memoryview(buffer) as view:
+        checksum = crc32(view[:MESSAGE_SIZE]) & 0xffffffff
+    CHECKSUM_STRUCT.pack_into(buffer, CHECKSUM_OFFSET, checksum)
+
+
+def packMessage(messageID, module, commandType, data=0, acknowledgeID=0):
+    """ Creates a message understood by the Arduino
+
+    See packMessageInto, this allocates a new buffer for the message.
+
+    Returns:
+        Message byte string
+    """
+
+    buffer = bytearray(MESSAGE_SIZE)
+    packMessageInto(buffer, messageID, module, commandType, data,
+                    acknowledgeID)
+    return bytes(buffer)
+
+
+def unpackMessage(message):
+    """ Unpacks a message received from the Arduino
+
+    The checksum is verified by calculating the CRC over a view of
+    the received bytes up to the checksum field, continued over four
+    zero bytes in place of the checksum. The message is not copied or
+    repacked for this.
+
+    Args:
+        message (bytes): A message unpacked from a frame
+
+    Returns:
+        A Message containing the received data or None if
+        the checksum did not match
+
+    Raises:
+        struct.error: The message does not have the right size
+    """
+
+    recvMessage = Message._make(MESSAGE_STRUCT.unpack(message))
+
+    with memoryview(message) as view:
+        calcChecksum = crc32(EMPTY_CHECKSUM,
+                             crc32(view[:CHECKSUM_OFFSET])) & 0xffffffff
+
+    if recvMessage.checksum != calcChecksum:
+        return None
+
+    return recvMessage
+
+
+def escapeMessage(message):
+    """ Precede every FRAME_FLAG and FRAME_ESC in the message by a FRAME_ESC
+
+    FRAME_ESC bytes are escaped first so the escapes added for the
+    FRAME_FLAGs are not escaped again.
+    """
+
+    return message.replace(FRAME_ESC_BYTE, ESCAPED_FRAME_ESC) \
+                  .replace(FRAME_FLAG_BYTE, ESCAPED_FRAME_FLAG)
+
+
+def unescapeMessage(data):
+    """ Removes the FRAME_ESC from every escaped byte """
+
+    return ESCAPED_BYTE.sub(b'\\1', data)
+
+
+def packFrame(message):
+    """ Packs the message into a frame
+
+    Escapes any special chars and applies
+    the frame marker to the beginning and end
+    of the frame
+
+    Args:
+        message (struct): The message to be sent to
+                          the arduino
+
+    Returns:
+        A packed frame suitable for sending to the arduino
+        over the serial connection. """
+
+    return b''.join((FRAME_FLAG_BYTE, escapeMessage(message),
+                     FRAME_FLAG_BYTE))
+
+
+def packFrames(messages, frames=None):
+    """ Packs several messages into frames in one contiguous buffer
+
+    The result can be sent to the arduino with a single write.
+
+    Args:
+        messages (iterable): The messages to be sent to the arduino
+        frames (bytearray): Optional buffer to append the frames to,
+                            allows reusing a buffer between calls
+
+    Returns:
+        The bytearray holding the packed frames
+    """
+
+    if frames is None:
+        frames = bytearray()
+
+    for message in messages:
+        frames += FRAME_FLAG_BYTE
+        frames += escapeMessage(message)
+        frames += FRAME_FLAG_BYTE
+
+    return frames
+
+
+def unpackFrame(frame):
+    """ Unpacks a complete received frame
+
+    Args:
+        frame (bytes): A frame including the FRAME_FLAG at the
+                       beginning and end
+
+    Returns:
+        message (bytes): The unescaped message or None if the frame
+                         flags are not valid
+    """
+
+    if len(frame) < 2 or frame[0] != FRAME_FLAG or \
+            frame[-1] != FRAME_FLAG:
+        return None
+
+    return unescapeMessage(frame[1:-1])
 
 
 class HardwareController():
@@ -88,57 +526,144 @@ class HardwareController():
 
     __lastMessageID = 0        # holds the last used messageID
     isConnected = False
-    __distanceSensorValues = [0, 3, 0]    # holds the last three measured vals
-
-    def __init__(self):
+    flightRecorder = None       # FlightRecorder for all serial traffic
+    motorWatchdog = None        # MotorWatchdog fed by every motor command
+    traceMessages = False       # log every sent and received message
+    READER_POLL_INTERVAL = 0.1  # max secs the reader thread blocks on a read
+    DTR_RESET_PULSE = 0.05      # secs the DTR pin is held low for a reset
+    HANDSHAKE_TIMEOUT = 3.0     # max secs to wait for the Arduino to answer
+    HANDSHAKE_INTERVAL = 0.25   # secs between CMD_ARDUINO_START attempts
+    TELEMETRY_TIMEOUT = 0.5     # max secs to wait for the telemetry reply
+    connectTime = None          # secs the last successful initialize took
+    telemetryBatching = False   # True if the Arduino sends telemetry frames
+    acknowledges = False        # True if the Arduino answered the handshake
+
+    def __init__(self, recvQueueSize=256,
+                 overflowPolicy=OVERFLOW_DROP_OLDEST, distanceFilter=None,
+                 metrics=None, telemetryCapacity=1024,
+                 receiveBufferSize=4096):
         """ Initializes the HardwareController
 
         This sets up the recvMessageQueue which will hold
-        all the received messages from the Arduino
+        all the received messages from the Arduino. Messages are
+        added by calling recvMessage or, when started, by the
+        background reader thread (see startReader)
+
+        Replies to messages sent with track=True are handled by the
+        messageTracker, see MessageTracker for the retry settings and
+        latency statistics.
+
+        Link health is counted in the metrics registry under 'serial.*',
+        the round trip times are added as the 'messages' source.
 
-        TODO: Implement threading/queuing for the serial
-        read process
+        Args:
+            recvQueueSize (int): Maximum number of messages in the
+                                 recvMessageQueue
+            overflowPolicy (str): What to do when the recvMessageQueue
+                                  is full, see MessageQueue
+            distanceFilter (DistanceFilter): Filter for the distance
+                                             sensor readings, defaults
+                                             to the median of 3 samples
+            metrics (Metrics): Registry for the link metrics, a new one
+                               is created when not given
+            telemetryCapacity (int): Number of samples kept from
+                                     telemetry frames, see telemetry
+            receiveBufferSize (int): Size of the ReceiveBuffer the
+                                     serial port is read into
         """
 
-        self.recvMessageQueue = queue.Queue()
+        self.recvMessageQueue = MessageQueue(recvQueueSize, overflowPolicy)
+        self.messageTracker = MessageTracker(self.sendMessage, NACK_COMMANDS)
+        self.distanceFilter = distanceFilter or MedianFilter(3)
+        self.lastDistance = None        # unfiltered, e.g. for a sweep
+        self.lastDistanceTime = None    # monotonic() it was received
+        self.invalidMessageCount = 0
+        self.__receiveBuffer = ReceiveBuffer(
+            receiveBufferSize, max(MESSAGE_SIZE, TELEMETRY_MAX_SIZE))
+        self.telemetry = SampleBuffer(telemetryCapacity)
+        self.__readerThread = None
+        self.__stopReader = threading.Event()
+        self.__writeLock = threading.Lock()
+        self.__messageBuffer = bytearray(MESSAGE_SIZE)
+        self.__lastReadTime = None
+
+        self.metrics = metrics or Metrics()
+        self.__framesSent = self.metrics.counter('serial.framesSent')
+        self.__framesReceived = self.metrics.counter('serial.framesReceived')
+        self.__bytesSent = self.metrics.counter('serial.bytesSent')
+        self.__bytesReceived = self.metrics.counter('serial.bytesReceived')
+        self.__bytesEscaped = self.metrics.counter('serial.bytesEscaped')
+        self.__crcFailures = self.metrics.counter('serial.crcFailures')
+        self.__framingErrors = self.metrics.counter('serial.framingErrors')
+        self.__readerBacklog = self.metrics.gauge('serial.readerBacklog')
+        self.__connectTime = self.metrics.histogram('serial.connectTime')
+        self.__telemetryFrames = self.metrics.counter(
+            'serial.telemetryFrames')
+        self.__telemetrySamples = self.metrics.counter(
+            'serial.telemetrySamples')
+        self.metrics.gauge('serial.frameOverflows',
+                           lambda: self.__receiveBuffer.overflowCount)
+        self.metrics.gauge('serial.receiveHighWater',
+                           lambda: self.__receiveBuffer.highWaterMark)
+        self.metrics.gauge('serial.largestRead',
+                           lambda: self.__receiveBuffer.largestRead)
+        self.metrics.gauge('serial.receiveCompactions',
+                           lambda: self.__receiveBuffer.compactionCount)
+        self.metrics.gauge('serial.queueDepth', self.recvMessageQueue.qsize)
+        self.metrics.gauge('serial.droppedMessages',
+                           lambda: self.recvMessageQueue.droppedMessages)
+        self.metrics.gauge('serial.readerLag', self.__readerLag)
+        self.metrics.addSource('messages', self.messageTracker.getStats)
         logging.getLogger()
 
     def setDistance(self, distance):
         """ Set the latest distance sensor value
 
-        This function will pop the oldest value of the
-        __distanceSensorValues list and amend it with the
-        latest reading
+        The reading is fed to the distanceFilter which updates
+        its estimate in constant time
         """
 
-        self.__distanceSensorValues.pop(0)
-        self.__distanceSensorValues.append(distance)
-        logging.info("morTimmy: new distance "
-                     "value is %s") % str(self.__distanceSensorValues)
+        self.lastDistance = distance
+        self.lastDistanceTime = monotonic()
+        self.distanceFilter.update(distance)
+        logging.debug("morTimmy: new distance value is %s, estimate %s",
+                      distance, self.distanceFilter.estimate)
 
-    def getDistance(self, numOfSamples=3):
-        """ get the distance measures by the distance sensor
+    def getDistance(self):
+        """ get the distance measured by the distance sensor
 
-        The distance is calculated taking the average of the last
-        three measurements
+        Returns:
+            The current estimate of the distanceFilter or None when
+            no distance was received yet
         """
 
-        return sum(self.__distanceSensorValues)/numOfSamples
+        return self.distanceFilter.estimate
 
     def initialize(self, serialPort='/dev/ttyACM0',
                    baudrate=9600,
                    stopbits=serial.STOPBITS_ONE,
                    bytesize=serial.EIGHTBITS,
-                   timeout=0):
+                   timeout=0,
+                   handshakeTimeout=HANDSHAKE_TIMEOUT,
+                   telemetryBatchSize=0):
         """ initialize serial connection towards Arduino
 
         First the serial connection is opened to the arduino. Then
         we use the DTR pin to reset the arduino making sure we
         have a clean session and flushed all data from the recv
-        buffer
+        buffer. Finally we send CMD_ARDUINO_START until the Arduino
+        acknowledges it, so we know it finished booting and is
+        ready for commands. Firmware that does not answer the
+        handshake is connected to anyway once handshakeTimeout
+        passed, acknowledges tells which of the two we talk to.
+
+        The time from opening the port until the Arduino is ready is
+        kept in connectTime and the 'serial.connectTime' histogram.
 
         Args:
           serialPort (str): The port used to communicate with the Arduino
+                            or an already opened port object, like
+                            the ReplaySerialPort of a flight recording
           baudrate (int): The baudrate of the serial connection
           stopbits (int): The stopbits of the serial connection
           bytesize (int): The bytesize of the serial connection
@@ -146,207 +671,235 @@ class HardwareController():
                            None wait forever
                            0 non blocking
                            x set timeout to x seconds (float allowed)
+          handshakeTimeout (float): Max seconds to wait for the Arduino
+                                    to acknowledge CMD_ARDUINO_START,
+                                    0 skips the handshake
+          telemetryBatchSize (int): Ask the Arduino to send up to this
+                                    many sensor readings per telemetry
+                                    frame, 0 to get a message per
+                                    reading. Only asked when the Arduino
+                                    answered the handshake. See
+                                    telemetry.py
         """
 
+        startTime = monotonic()
+        self.isConnected = False
+        self.acknowledges = False
+        self.telemetryBatching = False
+
         try:
-            logging.info("Opening serial connection to arduino on"
-                         "port %s with baudrate %d") % (serialPort, baudrate)
-            self.serialPort = serial.Serial(serialPort, baudrate)
-            logging.info("Connected to Arduino")
+            logging.info("Opening serial connection to arduino on "
+                         "port %s with baudrate %d", serialPort, baudrate)
+            if isinstance(serialPort, str):
+                newSerialPort = serial.Serial(serialPort, baudrate)
+            else:
+                newSerialPort = serialPort
+            if getattr(self, 'serialPort', None) not in (None, newSerialPort):
+                self.serialPort.close()
+            self.serialPort = newSerialPort
+            logging.info("Opened serial port %s", serialPort)
 
             '''  Reset the arduino by setting the DTR pin LOW and then
             HIGH again. This is the same as pressing the reset button
-            on the Arduino itself. The flushInput() whilst the reset
-            is in progress is to ensure there is no data from before
-            the Arduino was reset in the serial buffer '''
-
-            logging.info("Resetting Arduino using DTR pin")
-            self.serialPort.setDTR(level=False)
-            sleep(0.5)
-            self.serialPort.flushInput()
-            self.serialPort.setDTR()
-
-            logging.info("TODO: implement proper handshake between Arduino "
-                         "and Pi to make sure it's initalised properly")
-
-            '''
-            self.serialPort.timeout = 0.1     # Set blocking read to 5 sec
-            handshake = self.serialPort.readline()
-            print "Recv from Arduino: %s" % handshake
-            self.serialPort.timeout = 0     # set non-blocking read
-            '''
+            on the Arduino itself. The reset_input_buffer() whilst the
+            reset is in progress is to ensure there is no data from before
+            the Arduino was reset in the serial buffer. Ports without
+            a DTR line, like the pseudo terminal of the ArduinoSimulator,
+            are only flushed '''
+
+            try:
+                logging.info("Resetting Arduino using DTR pin")
+                self.serialPort.dtr = False
+                sleep(self.DTR_RESET_PULSE)
+                self.serialPort.reset_input_buffer()
+                self.serialPort.dtr = True
+            except OSError:
+                logging.info("Serial port does not support DTR reset")
+                self.serialPort.reset_input_buffer()
+            self.__receiveBuffer.reset()
+
+            if handshakeTimeout:
+                answer = self.__handshake(handshakeTimeout)
+                if answer is False:
+                    return
+                self.acknowledges = bool(answer)
+
+            self.telemetryBatching = self.acknowledges and \
+                bool(telemetryBatchSize) and \
+                self.__negotiateTelemetry(telemetryBatchSize,
+                                          self.TELEMETRY_TIMEOUT)
+
+            self.connectTime = monotonic() - startTime
+            self.__connectTime.record(self.connectTime)
+            logging.info("Connected to Arduino in %.3fs", self.connectTime)
             self.isConnected = True
         except OSError:
             logging.error("Failed to connect to Arduino on "
-                          "serial port %s. Is the port correct?") % serialPort
+                          "serial port %s. Is the port correct?", serialPort)
             self.isConnected = False
         except Exception:
             logging.warning("Could not connect to Arduino")
             self.isConnected = False
 
-    def __del__(self):
-        """ Close the serial connection when the class is deleted """
-        try:
-            self.serialPort.close()
-        except:
-            pass
+    def __handshake(self, timeout):
+        """ Wait until the Arduino acknowledges CMD_ARDUINO_START
 
-    def __packMessage(self, module, commandType, data=0, acknowledgeID=0):
-        """ Creates a message understood by the Arduino
+        After a reset the Arduino spends some time in its bootloader,
+        so the command is repeated every HANDSHAKE_INTERVAL seconds.
 
-        The checksum is calculated over the full packet with checksum field
-        set to 0. The data is then repacked again with the calculated
-        checksum
+        Args:
+            timeout (float): Max seconds to wait for the Arduino
+
+        Returns:
+            True if the Arduino acknowledged the command, False if it
+            refused it and None if it did not answer, like firmware
+            that does not read our messages
+        """
 
-          Message structure
-        +-----------+--------+-------------+-------+----------+
-        | messageID | module | commandType |  data | checksum |
-        +-----------+--------+-------------+-------+----------+
+        reply = self.__request(MODULE_ARDUINO, CMD_ARDUINO_START, 0, timeout)
+        if reply == CMD_ARDUINO_START:
+            return True
+        if reply == CMD_ARDUINO_START_NACK:
+            logging.error("Arduino refused to start")
+            return False
+        logging.warning("Arduino did not answer the handshake within "
+                        "%.1fs, assuming firmware without "
+                        "acknowledgements", timeout)
+        return None
+
+    def __negotiateTelemetry(self, batchSize, timeout):
+        """ Ask the Arduino to send its sensor readings in batches
 
         Args:
-            module:      (unsigned short, 1 byte, arduino module to target)
-            commandType: (unsigned short, 1 byte, Type of command to send)
-            data:        (unsigned int, 4 bytes, the data payload)
+            batchSize (int): Max samples per telemetry frame
+            timeout (float): Max seconds to wait for the Arduino
 
         Returns:
-            Message byte string
+            True if the Arduino will send telemetry frames
         """
 
-        self.__lastMessageID += 1
+        reply = self.__request(MODULE_ARDUINO, CMD_ARDUINO_TELEMETRY,
+                               batchSize, timeout)
+        if reply == CMD_ARDUINO_TELEMETRY:
+            logging.info("Arduino sends telemetry in batches of %d samples",
+                         batchSize)
+            return True
+        logging.info("Arduino does not support telemetry batches, "
+                     "using a message per reading")
+        return False
 
-        checksum = 0
-        rawMessage = struct.pack('<LLBBLL',
-                                 self.__lastMessageID,
-                                 acknowledgeID,
-                                 module,
-                                 commandType,
-                                 data,
-                                 checksum)
-
-        # Calculate the checksum. & 0xffffffff is ensuring
-        # the checksum is an unsigned long as 32bit python
-        # sometimes returns a signed int
-        checksum = crc32(rawMessage) & 0xffffffff
-
-        rawMessage = struct.pack('<LLBBLL',
-                                 self.__lastMessageID,
-                                 acknowledgeID,
-                                 module,
-                                 commandType,
-                                 data,
-                                 checksum)
-
-        return rawMessage
+    def __request(self, module, commandType, data, timeout):
+        """ Send a command until the Arduino replies, before connecting
 
-    def __unpackMessage(self, message):
-        """ Unpacks a message received from the Arduino
+        The command is repeated every HANDSHAKE_INTERVAL seconds. Other
+        messages received in the meantime are queued as usual.
 
-        It unpacks the received struct into seperate variables.
-        Then it repacks the message again but with a checksum of 0
-        to verify the data is transmitted intact.
+        Returns:
+            The commandType of the reply (ACK or NACK) or None if no
+            reply arrived within timeout seconds
+        """
 
-        A dictionary containing the received data is added to the
-        recvMessageQueue if the message was valid.
+        previousTimeout = self.serialPort.timeout
+        self.serialPort.timeout = min(self.HANDSHAKE_INTERVAL, timeout)
+        deadline = monotonic() + timeout
+        nextAttempt = monotonic()
+        sentIDs = set()
 
-        Args:
-            message (struct): A message unpacked from a frame
-        """
         try:
-            (messageID, acknowledgeID, module, commandType,
-             data, recvChecksum) = struct.unpack('<LLBBLL', message)
-
-            # recalculate the checksum to check if we received
-            # a valid message. & 0xffffffff is ensuring
-            # the checksum is an unsigned long as 32bit python 2.x
-            # sometimes returns a signed int
-
-            checksum = 0
-            rawMessage = struct.pack('<LLBBLL',
-                                     messageID,
-                                     acknowledgeID,
-                                     module,
-                                     commandType,
-                                     data,
-                                     checksum)
-
-            calcChecksum = crc32(rawMessage) & 0xffffffff
-
-            if recvChecksum == calcChecksum:
-                self.recvMessageQueue.put({'messageID': messageID,
-                                           'acknowledgeID': acknowledgeID,
-                                           'module': module,
-                                           'commandType': commandType,
-                                           'data': data,
-                                           'checksum': recvChecksum})
-            else:
-                self.recvMessageQueue.put("Invalid: Checksum failed")
-        except Exception:
-            self.recvMessageQueue.put("error putting messg to queue")
+            while monotonic() < deadline:
+                if monotonic() >= nextAttempt:
+                    with self.__writeLock:
+                        frame = packFrame(self.__packMessage(
+                            module, commandType, data))
+                        sentIDs.add(self.__lastMessageID)
+                        self.__writeFrames(frame, 1)
+                    nextAttempt = monotonic() + self.HANDSHAKE_INTERVAL
+
+                for message in self.__readMessages():
+                    if message.acknowledgeID in sentIDs:
+                        return message.commandType
+                    self.recvMessageQueue.put(message)
+        finally:
+            self.serialPort.timeout = previousTimeout
+
+        return None
 
-    def __packFrame(self, message):
-        """ Packs the message into a frame
+    def __del__(self):
+        """ Close the serial connection when the class is deleted """
+        try:
+            self.serialPort.close()
+        except:
+            pass
 
-        Escapes any special chars and applies
-        the frame marker to the beginning and end
-        of the frame
+    def __packMessage(self, module, commandType, data=0, acknowledgeID=0):
+        """ Creates a message understood by the Arduino
 
-        Args:
-            message (struct): The message to be sent to
-                              the arduino
+        Assigns the next messageID and packs the message into the
+        reusable message buffer. Must be called with the write lock
+        held.
 
         Returns:
-            A packed frame suitable for sending to the arduino
-            over the serial connection. """
+            The message buffer
+        """
 
-        frame = b''
-        frame += chr(FRAME_FLAG)
+        self.__lastMessageID += 1
 
-        for byte in message:
-            if (byte == chr(FRAME_ESC)) or (byte == chr(FRAME_FLAG)):
-                frame += chr(FRAME_ESC)
-                frame += byte          # TODO, Need to XOR this value?
-            else:
-                frame += byte
+        packMessageInto(self.__messageBuffer, self.__lastMessageID,
+                        module, commandType, data, acknowledgeID)
+        return self.__messageBuffer
+
+    def __writeFrames(self, frames, frameCount):
+        """ Write frames to the serial port, count and record them
+
+        Every frame we send goes through here, so the flight recording
+        and the 'serial.*' counters include the handshake. Must be
+        called with the write lock held.
+
+        Args:
+            frames (bytes): One or more frames
+            frameCount (int): The number of frames in frames
+        """
 
-        frame += chr(FRAME_FLAG)
+        self.serialPort.write(frames)
+        self.__framesSent.inc(frameCount)
+        self.__bytesSent.inc(len(frames))
+        self.__bytesEscaped.inc(len(frames) - frameCount *
+                                (MESSAGE_SIZE + 2))
+        if self.flightRecorder is not None:
+            self.flightRecorder.record(DIRECTION_SEND, frames)
 
-        return frame
+    def __unpackMessage(self, message):
+        """ Unpacks a message received from the Arduino
 
-    def __unpackFrame(self, frame):
-        """ Unpacks a received frame from the arduino
+        Invalid messages are logged and counted in invalidMessageCount.
 
         Args:
-            frame (string): The received frame from
-                            the arduino
+            message (struct): A message unpacked from a frame
+
         Returns:
-            message (struct): A received message from the
-                              arduino
+            A Message containing the received data or None if
+            the message was invalid
         """
-
-        nextByteValid = False   # Indicates we found a FRAME_ESC char
-        message = b''
-
-        if(frame[:1] != chr(FRAME_FLAG)) or (frame[-1:] != chr(FRAME_FLAG)):
-            print("Invalid frame received, frame flag not valid")
-            self.recvMessageQueue.put("Invalid")
-        else:
-            for byte in frame:
-                if nextByteValid:
-                    message += byte
-                    nextByteValid = False
-                elif (byte == chr(FRAME_ESC)):
-                        nextByteValid = True
-                elif (byte != chr(FRAME_FLAG)):
-                        message += byte
-
-        return message
-
-    def sendMessage(self, module, commandType, data=0, acknowledgeID=0):
+        try:
+            recvMessage = unpackMessage(message)
+            if recvMessage is not None:
+                return recvMessage
+            logging.warning("Invalid message received: checksum failed")
+            self.__crcFailures.inc()
+        except struct.error:
+            logging.warning("Invalid message received: wrong size")
+            self.__framingErrors.inc()
+
+        self.invalidMessageCount += 1
+        return None
+
+    def sendMessage(self, module, commandType, data=0, acknowledgeID=0,
+                    track=False):
         """ Send data onto the serial port towards the arduino.
 
         Used by the HardwareController class to send commands. It packs
         the message into a struct using the given arguments. The packed
-        message then gets processed by __packFrame to ensure any special
+        message then gets processed by packFrame to ensure any special
         characters are escaped with FRAME_ESC and a beginning and end
         flag is added to the message.
 
@@ -354,72 +907,306 @@ class HardwareController():
             module (byte):      The module to address
             commandType (byte): The command to send to the specified module
             data (int):         The data that goes with the command (if any)
+            acknowledgeID (int): The messageID this message replies to
+            track (bool):       Wait for an ACK from the Arduino and
+                                retransmit the message if it fails
+
+        Returns:
+            The messageID of the sent message or None if not connected.
+            A failed write disconnects, see isConnected.
         """
 
         if not self.isConnected:
-            print("sendMessage: Not connected to Arduino")
+            logging.warning("sendMessage: Not connected to Arduino")
             return None
 
-        packedMessage = self.__packMessage(module,
-                                           commandType,
-                                           data,
-                                           acknowledgeID)
-        packedFrame = self.__packFrame(packedMessage)
+        # Before writing, so a stop of the watchdog cannot come after it
+        if module == MODULE_MOTOR and self.motorWatchdog is not None:
+            self.motorWatchdog.motorCommand(commandType)
+
+        # The reader thread retransmits messages too
+        with self.__writeLock:
+            packedMessage = self.__packMessage(module,
+                                               commandType,
+                                               data,
+                                               acknowledgeID)
+            messageID = self.__lastMessageID
+            packedFrame = packFrame(packedMessage)
+
+            # The reply may be read before write() returns
+            if track:
+                self.messageTracker.track(messageID, module, commandType,
+                                          data)
+            try:
+                self.__writeFrames(packedFrame, 1)
+            except (OSError, serial.SerialException) as e:
+                if track:
+                    self.messageTracker.forget(messageID)
+                logging.error("Writing serial port failed: %s", e)
+                self.isConnected = False
+                return None
+
+        if self.traceMessages:
+            logging.debug("Sent msgID=%d ackID=%d %s data=%s",
+                          messageID, acknowledgeID,
+                          commandName(module, commandType), data)
+
+        return messageID
+
+    def sendMessages(self, commands, track=False):
+        """ Send several messages towards the arduino in a single write
+
+        All messages are framed into one contiguous buffer by packFrames
+        so the serial port is only written to once.
 
-        print ("morTimmy: "
-               "msgID=%d "
-               "ackID=%d "
-               "module=%s "
-               "cmd=%s "
-               "data=%s ") % (self.__lastMessageID, acknowledgeID, hex(module),
-                              hex(commandType), data)
+        Args:
+            commands (iterable): (module, commandType, data) tuples
+            track (bool):        Wait for an ACK from the Arduino for
+                                 each message, see sendMessage
 
-        self.serialPort.write(packedFrame)
+        Returns:
+            A list with the messageIDs of the sent messages or None if
+            not connected. A failed write disconnects, see isConnected.
+        """
+
+        if not self.isConnected:
+            logging.warning("sendMessages: Not connected to Arduino")
+            return None
+
+        if self.motorWatchdog is not None:
+            commands = list(commands)
+            for module, commandType, data in commands:
+                if module == MODULE_MOTOR:
+                    self.motorWatchdog.motorCommand(commandType)
+
+        sentMessages = []
+
+        def packCommands():
+            for module, commandType, data in commands:
+                message = self.__packMessage(module, commandType, data)
+                sentMessages.append((self.__lastMessageID, module,
+                                     commandType, data))
+                yield message
+
+        with self.__writeLock:
+            frames = packFrames(packCommands())
+            # The replies may be read before write() returns
+            if track:
+                for messageID, module, commandType, data in sentMessages:
+                    self.messageTracker.track(messageID, module,
+                                              commandType, data)
+            if frames:
+                try:
+                    self.__writeFrames(frames, len(sentMessages))
+                except (OSError, serial.SerialException) as e:
+                    if track:
+                        for sentMessage in sentMessages:
+                            self.messageTracker.forget(sentMessage[0])
+                    logging.error("Writing serial port failed: %s", e)
+                    self.isConnected = False
+                    return None
+
+        if self.traceMessages:
+            for messageID, module, commandType, data in sentMessages:
+                logging.debug("Sent msgID=%d ackID=0 %s data=%s", messageID,
+                              commandName(module, commandType), data)
+
+        return [sentMessage[0] for sentMessage in sentMessages]
 
     def recvMessage(self):
         """ Receive data from the Arduino through the serial port.
 
         Used by the HardwareController class to receive
-        messages from the Arduino. It reads single bytes from the
-        serial port and starts processing when it finds the beginning
-        of a message (FRAME_FLAG). each subsequent byte is read and checked
-        for a FRAME_FLAG message or a FRAME_ESC escape flag for special
-        characters.
-
-        When a full message is found it is passed to the __unpackMessage
-        function. This converts the received message to a dictionary and
-        adds it to the recvMessageQueue.
+        messages from the Arduino. Everything waiting in the serial
+        receive buffer is read in a single call into the ReceiveBuffer.
+        If nothing is waiting we read a single byte, which blocks
+        according to the timeout of the serial port.
+
+        Every complete message found is passed to the __unpackMessage
+        function. This converts the received message to a Message
+        which is added to the recvMessageQueue. Partially received frames
+        are kept by the ReceiveBuffer until the next call.
+
+        Should not be called while the reader thread is running. A
+        failed read disconnects like it does in the reader thread.
         """
 
         if not self.isConnected:
-            print("recvMessage: Not connected to Arduino")
+            logging.warning("recvMessage: Not connected to Arduino")
+            return None
+
+        try:
+            messages = self.__readMessages()
+        except (OSError, serial.SerialException) as e:
+            logging.error("Reading serial port failed: %s", e)
+            self.isConnected = False
+            return None
+
+        for message in messages:
+            self.recvMessageQueue.put(message)
+
+    def readMessages(self):
+        """ Read and decode what is waiting on the serial port
+
+        For an I/O loop that waits for the port to become readable
+        itself, like the ControllerPool. The messages are returned
+        instead of being added to the recvMessageQueue.
+
+        Returns:
+            A list with the received messages
+        """
+
+        return self.__readMessages()
+
+    def __readMessages(self):
+        """ Reads the serial port once and returns the valid messages
+
+        Replies to tracked messages are consumed by the messageTracker
+        which also gets the chance to retransmit timed out messages.
+        """
+
+        backlog = self.serialPort.in_waiting
+        self.__readerBacklog.set(backlog)
+        chunk = self.__receiveBuffer.readFrom(self.serialPort, backlog)
+        self.__lastReadTime = monotonic()
+        self.__bytesReceived.inc(len(chunk))
+        if chunk and self.flightRecorder is not None:
+            self.flightRecorder.record(DIRECTION_RECV, chunk)
+
+        messages = []
+        for frame in self.__receiveBuffer.frames():
+            self.__framesReceived.inc()
+            if len(frame) != MESSAGE_SIZE and isTelemetry(frame):
+                self.__handleTelemetry(frame)
+                continue
+            message = self.__unpackMessage(frame)
+            if message is None:
+                continue
+            if self.traceMessages:
+                logging.debug("Received msgID=%d ackID=%d %s data=%s",
+                              message.messageID, message.acknowledgeID,
+                              commandName(message.module,
+                                          message.commandType),
+                              message.data)
+            if not self.messageTracker.handleReply(message):
+                messages.append(message)
+
+        self.messageTracker.checkTimeouts()
+
+        return messages
+
+    def __handleTelemetry(self, frame):
+        """ Add the samples of a telemetry frame to the telemetry buffer
+
+        Distance readings are fed to the distanceFilter right away, so
+        they do not take a trip through the recvMessageQueue.
+        """
+
+        if unpackTelemetry(frame) is None:
+            logging.warning("Invalid telemetry received: checksum failed")
+            self.__crcFailures.inc()
+            self.invalidMessageCount += 1
+            return
+
+        samples = self.telemetry.extendFrame(frame)
+        self.__telemetryFrames.inc()
+        self.__telemetrySamples.inc(len(samples))
+        for timestamp, module, value in samples:
+            if module == MODULE_DISTANCE_SENSOR:
+                self.setDistance(value)
+
+    def __readerLag(self):
+        """ Seconds since the serial port was last read
+
+        Grows when the reader thread or control loop stalls, None
+        before the first read.
+        """
+
+        if self.__lastReadTime is None:
             return None
+        return monotonic() - self.__lastReadTime
+
+    @property
+    def readerRunning(self):
+        """ True if the background reader thread is active """
+        return self.__readerThread is not None and \
+            self.__readerThread.is_alive()
+
+    def startReader(self):
+        """ Start reading the serial port in a background thread
+
+        The reader thread feeds all received messages into the
+        recvMessageQueue so the caller never has to wait on serial
+        I/O. Reads on the serial port are limited to
+        READER_POLL_INTERVAL seconds so the thread can be stopped
+        cleanly with stopReader.
+        """
+
+        if self.readerRunning:
+            return
+
+        self.__stopReader.clear()
+        self.__readerThread = threading.Thread(target=self.__readerLoop,
+                                               name='morTimmy-serial-reader',
+                                               daemon=True)
+        self.__readerThread.start()
+        logging.info("Started serial reader thread")
+
+    def stopReader(self, timeout=None):
+        """ Stop the background reader thread
+
+        Args:
+            timeout (float): Seconds to wait for the thread to finish,
+                             None waits until it has stopped
+        """
+
+        if self.__readerThread is None:
+            return
+
+        self.__stopReader.set()
+        self.__readerThread.join(timeout)
+        self.__readerThread = None
+        logging.info("Stopped serial reader thread")
+
+    def __readerLoop(self):
+        """ Main loop of the background reader thread """
+
+        serialPort = None
+
+        while not self.__stopReader.is_set():
+            if not self.isConnected:
+                self.__stopReader.wait(self.READER_POLL_INTERVAL)
+                continue
+
+            # initialize() may have opened a new serial port
+            if serialPort is not self.serialPort:
+                serialPort = self.serialPort
+                serialPort.timeout = self.READER_POLL_INTERVAL
+
+            try:
+                messages = self.__readMessages()
+            except (OSError, serial.SerialException) as e:
+                logging.error("Serial reader failed: %s", e)
+                self.isConnected = False
+                continue
+
+            for message in messages:
+                self.__queueMessage(message)
+
+    def __queueMessage(self, message):
+        """ Put a message on the recvMessageQueue from the reader thread
+
+        A full queue with OVERFLOW_BLOCK policy blocks the reader
+        until there is room or the reader is stopped.
+        """
 
-        message = b''
-        foundStartOfFrame = False
-        foundEndOfFrame = False
-        foundEscFlag = False
-
-        while not foundEndOfFrame:
-            recvByte = self.serialPort.read(1)
-            if foundStartOfFrame and recvByte == chr(FRAME_FLAG) and not foundEscFlag:
-                foundEndOfFrame = True
-            elif recvByte == chr(FRAME_FLAG) and not foundStartOfFrame:
-                # Beginning of our message
-                foundStartOfFrame = True
-            elif (foundStartOfFrame) and recvByte == chr(FRAME_ESC) and not foundEscFlag:
-                # Found an escape flag which was not escaped itself
-                foundEscFlag = True
-            elif foundStartOfFrame and foundEscFlag:
-                # Byte preceded by FLAG_ESC so treat as normal data
-                foundEscFlag = False
-                message += recvByte
-            elif foundStartOfFrame and not foundEscFlag:
-                # regular data part of message
-                message += recvByte
-
-        unpackedMessage = self.__unpackMessage(message)
-        self.recvMessageQueue.put(unpackedMessage)
+        while not self.__stopReader.is_set():
+            try:
+                self.recvMessageQueue.put(message,
+                                          timeout=self.READER_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
 
 
 def main():
@@ -430,8 +1217,8 @@ def main():
     try:
         arduino = HardwareController()
     except Exception as e:
-        print ("Error, could not establish connection to "
-               "Arduino through the serial port.\n%s") % e
+        print("Error, could not establish connection to "
+              "Arduino through the serial port.\n%s" % e)
 #        exit()
 
     arduino.initialize()
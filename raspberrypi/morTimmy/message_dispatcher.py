@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import logging
+
+ANY = None      # wildcard for the module or commandType of a handler
+
+
+class MessageDispatcher():
+
+    """ Calls the handler registered for each received message
+
+    Handlers are registered per (module, commandType). Either can be
+    ANY to handle e.g. all commands of a module. For every message the
+    most specific handler is used:
+
+        (module, commandType)
+        (module, ANY)
+        (ANY, commandType)
+        (ANY, ANY)
+        defaultHandler
+
+    The handler found for a (module, commandType) is cached, so the
+    dispatch of a message is a single dictionary lookup no matter how
+    many handlers are registered.
+    """
+
+    def __init__(self, defaultHandler=None):
+        """ Sets up an empty dispatch table
+
+        Args:
+            defaultHandler (function): Called with messages no handler
+                                       is registered for
+        """
+
+        self.defaultHandler = defaultHandler
+        self.dispatchedCount = 0
+        self.unhandledCount = 0
+        self.failedCount = 0
+        self.__handlers = {}
+        self.__resolved = {}
+
+    def register(self, module, commandType, handler):
+        """ Register the handler for (module, commandType)
+
+        Args:
+            module (byte): The module or ANY
+            commandType (byte): The commandType or ANY
+            handler (function): Called with the Message, replaces the
+                                handler registered before
+        """
+
+        self.__handlers[(module, commandType)] = handler
+        self.__resolved.clear()
+
+    def unregister(self, module, commandType):
+        """ Remove the handler for (module, commandType) if any """
+
+        self.__handlers.pop((module, commandType), None)
+        self.__resolved.clear()
+
+    def __resolve(self, key):
+        """ Returns the most specific handler for key """
+
+        module, commandType = key
+        for candidate in (key, (module, ANY), (ANY, commandType),
+                          (ANY, ANY)):
+            if candidate in self.__handlers:
+                return self.__handlers[candidate]
+        return self.defaultHandler
+
+    def dispatch(self, message):
+        """ Pass a message to its handler
+
+        A failing handler is logged and does not stop the dispatching
+        of the other messages.
+
+        Returns:
+            True if a handler was found for the message
+        """
+
+        key = (message.module, message.commandType)
+        try:
+            handler = self.__resolved[key]
+        except KeyError:
+            handler = self.__resolved[key] = self.__resolve(key)
+
+        if handler is None:
+            self.unhandledCount += 1
+            return False
+
+        try:
+            handler(message)
+        except Exception:
+            self.failedCount += 1
+            logging.exception("Handler for module %#x cmd %#x failed",
+                              message.module, message.commandType)
+        self.dispatchedCount += 1
+        return True
+
+    def dispatchMessages(self, messages):
+        """ Dispatch a batch of messages in order
+
+        Returns:
+            The number of messages dispatched
+        """
+
+        count = 0
+        for message in messages:
+            self.dispatch(message)
+            count += 1
+        return count
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+import threading
+import logging
+from bisect import bisect_left
+from time import monotonic
+from protocol import commandName
+
+
+class LatencyHistogram():
+
+    """ Histogram of round trip times
+
+    Latencies are counted in fixed buckets so recording a sample
+    is cheap and memory use does not grow with the number of samples.
+    The upper bound of each bucket is given in milliseconds, samples
+    larger than the last bound end up in an overflow bucket.
+    """
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, latency):
+        """ Add a sample
+
+        Args:
+            latency (float): The round trip time in seconds
+        """
+
+        latency *= 1000
+        self.counts[bisect_left(self.buckets, latency)] += 1
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def percentile(self, percent):
+        """ Estimate a percentile from the buckets
+
+        Returns:
+            The upper bound in ms of the bucket holding the percentile,
+            the maximum seen for the overflow bucket or None without
+            samples
+        """
+
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold and count:
+                if index == len(self.buckets):
+                    return self.max
+                return min(self.buckets[index], self.max)
+        return self.max
+
+    def summary(self):
+        """ Returns a dictionary with the statistics in ms """
+
+        return {'count': self.count,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': dict(zip(self.buckets + ('inf',), self.counts))}
+
+
+class PendingMessage():
+
+    """ A message waiting for an acknowledgement from the Arduino """
+
+    __slots__ = ('messageID', 'module', 'commandType', 'data',
+                 'firstSentTime', 'sentTime', 'deadline', 'retries')
+
+    def __init__(self, messageID, module, commandType, data, sentTime,
+                 deadline):
+        self.messageID = messageID
+        self.module = module
+        self.commandType = commandType
+        self.data = data
+        self.firstSentTime = sentTime
+        self.sentTime = sentTime
+        self.deadline = deadline
+        self.retries = 0
+
+
+class MessageTracker():
+
+    """ Matches replies from the Arduino to the messages we sent
+
+    Every tracked message is kept in an in-flight table keyed by its
+    messageID. The Arduino replies with the messageID in the
+    acknowledgeID field and either the same commandType (ACK) or the
+    matching *_NACK commandType.
+
+    On an ACK the message is removed from the table and the round trip
+    time is recorded per (module, commandType). On a NACK or when no
+    reply arrived before the deadline the message is retransmitted,
+    waiting timeout * backoff ** retries for every next attempt. After
+    maxRetries retransmissions or expireAfter seconds the message is
+    considered lost.
+
+    A new tracked message for a module supersedes messages still in
+    flight for that module, so we never retransmit e.g. an old
+    CMD_MOTOR_FORWARD after a CMD_MOTOR_STOP was sent.
+    """
+
+    def __init__(self, sendFunction, nackCommands, timeout=0.2,
+                 maxRetries=3, backoff=2.0, expireAfter=5.0):
+        """ Sets up the in-flight table
+
+        Args:
+            sendFunction (callable): Called as sendFunction(module,
+                                     commandType, data) to retransmit a
+                                     message, returns the new messageID
+            nackCommands (dict): Maps (module, commandType) to the
+                                 commandType of its NACK
+            timeout (float): Seconds to wait for the first reply
+            maxRetries (int): Maximum number of retransmissions
+            backoff (float): Multiplier for the timeout of each retry
+            expireAfter (float): Seconds after which a message is given
+                                 up regardless of the retries left
+        """
+
+        self.sendFunction = sendFunction
+        self.nackCommands = nackCommands
+        self.timeout = timeout
+        self.maxRetries = maxRetries
+        self.backoff = backoff
+        self.expireAfter = expireAfter
+
+        self.latency = {}       # (module, commandType): LatencyHistogram
+        self.trackedCount = 0
+        self.ackCount = 0
+        self.nackCount = 0
+        self.retransmitCount = 0
+        self.lostCount = 0
+        self.supersededCount = 0
+
+        self.__inFlight = {}    # messageID: PendingMessage
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__inFlight)
+
+    def track(self, messageID, module, commandType, data=0):
+        """ Start tracking a message that is about to be sent
+
+        Must be called before the message is written, otherwise its
+        reply may arrive before it is in the in-flight table.
+        """
+
+        now = monotonic()
+
+        with self.__lock:
+            for pending in list(self.__inFlight.values()):
+                if pending.module == module:
+                    del self.__inFlight[pending.messageID]
+                    self.supersededCount += 1
+
+            self.__inFlight[messageID] = PendingMessage(
+                messageID, module, commandType, data, now,
+                now + self.timeout)
+            self.trackedCount += 1
+
+    def forget(self, messageID):
+        """ Stop tracking a message that could not be sent """
+
+        with self.__lock:
+            if self.__inFlight.pop(messageID, None) is not None:
+                self.trackedCount -= 1
+
+    def handleReply(self, message):
+        """ Process a message received from the Arduino
+
+        Args:
+            message (Message): The received message
+
+        Returns:
+            True if the message was a reply to a tracked message
+        """
+
+        now = monotonic()
+
+        with self.__lock:
+            pending = self.__inFlight.get(message.acknowledgeID)
+            if pending is None or message.module != pending.module:
+                return False
+
+            nackCommand = self.nackCommands.get((pending.module,
+                                                 pending.commandType))
+            if message.commandType == nackCommand:
+                self.nackCount += 1
+                logging.warning("NACK received for message %d",
+                                pending.messageID)
+                retry = self.__nextAttempt(pending)
+            else:
+                self.ackCount += 1
+                del self.__inFlight[pending.messageID]
+                key = (pending.module, pending.commandType)
+                histogram = self.latency.get(key)
+                if histogram is None:
+                    histogram = self.latency[key] = LatencyHistogram()
+                histogram.record(now - pending.sentTime)
+                retry = None
+
+        if retry is not None:
+            self.__retransmit(retry)
+        return True
+
+    def checkTimeouts(self):
+        """ Retransmit messages past their deadline and expire old ones
+
+        Should be called regularly, e.g. once per control loop tick.
+        """
+
+        now = monotonic()
+        retries = []
+
+        with self.__lock:
+            for pending in list(self.__inFlight.values()):
+                if now < pending.deadline:
+                    continue
+                retry = self.__nextAttempt(pending)
+                if retry is not None:
+                    retries.append(retry)
+
+        for retry in retries:
+            self.__retransmit(retry)
+
+    def __nextAttempt(self, pending):
+        """ Remove a message from the table for another attempt
+
+        Must be called with the lock held.
+
+        Returns:
+            The PendingMessage to retransmit or None if it is lost
+        """
+
+        del self.__inFlight[pending.messageID]
+
+        if (pending.retries >= self.maxRetries or
+                monotonic() - pending.firstSentTime >= self.expireAfter):
+            self.lostCount += 1
+            logging.error("Message %d (%s) lost after %d retries",
+                          pending.messageID,
+                          commandName(pending.module, pending.commandType),
+                          pending.retries)
+            return None
+
+        pending.retries += 1
+        return pending
+
+    def __retransmit(self, pending):
+        """ Send a message again and put it back in the table """
+
+        messageID = self.sendFunction(pending.module, pending.commandType,
+                                      pending.data)
+        if messageID is None:
+            # Not connected, count the attempt and try again later
+            messageID = pending.messageID
+
+        now = monotonic()
+        pending.messageID = messageID
+        pending.sentTime = now
+        pending.deadline = now + self.timeout * \
+            self.backoff ** pending.retries
+
+        with self.__lock:
+            self.retransmitCount += 1
+            for other in self.__inFlight.values():
+                if other.module == pending.module:
+                    # superseded while we were retransmitting
+                    self.supersededCount += 1
+                    return
+            self.__inFlight[messageID] = pending
+
+    def getStats(self):
+        """ Returns a dictionary with the counters and latency summaries
+
+        The latency summaries are keyed by (module, commandType).
+        """
+
+        with self.__lock:
+            return {'inFlight': len(self.__inFlight),
+                    'tracked': self.trackedCount,
+                    'acked': self.ackCount,
+                    'nacked': self.nackCount,
+                    'retransmitted': self.retransmitCount,
+                    'lost': self.lostCount,
+                    'superseded': self.supersededCount,
+                    'latency': dict((key, histogram.summary())
+                                    for key, histogram
+                                    in self.latency.items())}
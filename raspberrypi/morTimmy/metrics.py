@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import socket
+import threading
+from time import time
+from message_tracker import LatencyHistogram
+
+
+class Counter():
+
+    """ A value that only goes up, e.g. the number of frames sent """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge():
+
+    """ A value that goes up and down, e.g. the queue depth
+
+    The value is either set by the owner or, when a function is given,
+    read from the function every time a snapshot is taken so the hot
+    path does not have to update it.
+    """
+
+    __slots__ = ('value', 'function')
+
+    def __init__(self, function=None):
+        self.value = None
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Metrics():
+
+    """ Registry of the counters, gauges and histograms of the robot
+
+    Components ask the registry for their metrics once and keep a
+    reference, updating a counter is a single attribute increment.
+    Whole statistics dictionaries, like MessageTracker.getStats, can be
+    added as a source which is called on every snapshot.
+
+    Metric names are dotted, e.g. 'serial.framesSent'.
+    """
+
+    def __init__(self):
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+        self.__sources = {}
+        self.__lock = threading.Lock()
+
+    def counter(self, name):
+        """ Returns the Counter name, creating it when needed """
+
+        with self.__lock:
+            if name not in self.__counters:
+                self.__counters[name] = Counter()
+            return self.__counters[name]
+
+    def gauge(self, name, function=None):
+        """ Returns the Gauge name, creating it when needed
+
+        Args:
+            name (str): The name of the gauge
+            function (function): Called without arguments to read the
+                                 value of the gauge
+        """
+
+        with self.__lock:
+            if name not in self.__gauges:
+                self.__gauges[name] = Gauge(function)
+            elif function is not None:
+                self.__gauges[name].function = function
+            return self.__gauges[name]
+
+    def histogram(self, name, buckets=LatencyHistogram.BUCKETS):
+        """ Returns the LatencyHistogram name, creating it when needed
+
+        Args:
+            name (str): The name of the histogram
+            buckets (tuple): Upper bounds of the buckets in ms
+        """
+
+        with self.__lock:
+            if name not in self.__histograms:
+                self.__histograms[name] = LatencyHistogram(buckets)
+            return self.__histograms[name]
+
+    def addSource(self, name, function):
+        """ Add the dictionary returned by function to every snapshot """
+
+        with self.__lock:
+            self.__sources[name] = function
+
+    def snapshot(self):
+        """ Returns the current value of all metrics
+
+        Returns:
+            A dictionary with a timestamp, the counters, gauges,
+            histogram summaries (in ms) and the sources
+        """
+
+        with self.__lock:
+            counters = list(self.__counters.items())
+            gauges = list(self.__gauges.items())
+            histograms = list(self.__histograms.items())
+            sources = list(self.__sources.items())
+
+        return {'timestamp': time(),
+                'counters': dict((name, counter.value)
+                                 for name, counter in counters),
+                'gauges': dict((name, gauge.read())
+                               for name, gauge in gauges),
+                'histograms': dict((name, histogram.summary())
+                                   for name, histogram in histograms),
+                'sources': dict((name, function())
+                                for name, function in sources)}
+
+
+def jsonSafe(value):
+    """ Convert the keys of (nested) dictionaries to strings
+
+    Tuple keys like the (module, commandType) of the latency statistics
+    are joined as hex values, e.g. '0x32/0x64'.
+    """
+
+    if isinstance(value, dict):
+        safe = {}
+        for key, item in value.items():
+            if isinstance(key, tuple):
+                key = '/'.join(hex(part) if isinstance(part, int)
+                               else str(part) for part in key)
+            safe[str(key)] = jsonSafe(item)
+        return safe
+    if isinstance(value, (list, tuple)):
+        return [jsonSafe(item) for item in value]
+    return value
+
+
+class MetricsDumper():
+
+    """ Periodically writes a metrics snapshot as JSON
+
+    The snapshot is written to a file, replaced atomically so readers
+    never see a partial snapshot, and/or sent as a datagram to a UNIX
+    socket a collector listens on. A missing collector is not an error.
+    """
+
+    def __init__(self, metrics, filename=None, socketPath=None,
+                 interval=10.0):
+        """ Sets up the dumper
+
+        Args:
+            metrics (Metrics): The registry to dump
+            filename (str): The file holding the latest snapshot
+            socketPath (str): The UNIX datagram socket of a collector
+            interval (float): Seconds between snapshots
+        """
+
+        self.metrics = metrics
+        self.filename = filename
+        self.socketPath = socketPath
+        self.interval = interval
+        self.dumpCount = 0
+
+        self.__socket = None
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def dump(self):
+        """ Take a snapshot and write it out """
+
+        data = json.dumps(jsonSafe(self.metrics.snapshot()), sort_keys=True)
+
+        if self.filename is not None:
+            temporaryFile = self.filename + '.tmp'
+            with open(temporaryFile, 'w') as snapshotFile:
+                snapshotFile.write(data + '\n')
+            os.replace(temporaryFile, self.filename)
+
+        if self.socketPath is not None:
+            if self.__socket is None:
+                self.__socket = socket.socket(socket.AF_UNIX,
+                                              socket.SOCK_DGRAM)
+                self.__socket.setblocking(False)
+            try:
+                self.__socket.sendto(data.encode(), self.socketPath)
+            except OSError as e:
+                logging.debug("No metrics collector on %s: %s",
+                              self.socketPath, e)
+
+        self.dumpCount += 1
+
+    def start(self):
+        """ Dump every interval seconds in a background thread """
+
+        if self.__thread is not None:
+            return
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='morTimmy-metrics',
+                                         daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """ Stop the background thread after a final dump """
+
+        if self.__thread is None:
+            return
+
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.__dumpSafely()
+        self.__dumpSafely()
+
+    def __dumpSafely(self):
+        try:
+            self.dump()
+        except Exception as e:
+            logging.error("Writing metrics snapshot failed: %s", e)
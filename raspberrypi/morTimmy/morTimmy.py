@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 
 # imports
+import argparse
 import logging
+import os
 from hardware_controller import *
-from time import sleep, time
+from command_writer import CommandWriter
+from flight_recorder import FlightRecorder
+from robot_logging import NO_RATE_LIMIT, setupLogging, stopLogging
+from metrics import Metrics, MetricsDumper
+from message_dispatcher import MessageDispatcher
+from reconnect import Backoff, waitForDevice
+from network_remote_control import NetworkRemoteController
+from drive_mixer import DriveMixer
+from obstacle_planner import ObstaclePlanner
+from motor_watchdog import MotorWatchdog
+from scheduler import Scheduler
+from time import sleep, monotonic
 import queue
 
 
@@ -20,17 +33,75 @@ class Robot:
         running = "running"
         stopped = "stopped"
         autonomous = "autonomous"
+        remote = "remote"
+        idle = "idle"           # stopped until the next remote command
 
     # Note: only variables belonging to all
     # instances of the class belong here. Others
     # should be initialised in __init__
     MIN_DISTANCE_TO_OBJECT = 10
+    CONTROL_LOOP_RATE = 50      # Hz, rate at which run() is called
+    TELEMETRY_RATE = 1          # Hz, rate at which telemetry is logged
+    LOG_FILENAME = 'my_morTimmy.log'
+    RECORDING_FILENAME = 'my_morTimmy.rec'
+    METRICS_FILENAME = 'my_morTimmy.metrics.json'
+    METRICS_INTERVAL = 10       # seconds between metrics snapshots
+    TICK_BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50)  # ms
+    MAX_MESSAGES_PER_TICK = 64  # received messages handled per run()
+    TELEMETRY_BATCH_SIZE = 8    # sensor readings per telemetry frame
+    MAX_RESULTS_PER_TICK = 4    # perception results handled per run()
+    PLANNER_TELEMETRY_BATCH_SIZE = 1    # readings must arrive while the
+                                        # servo still points at them
+    REMOTE_TIMEOUT = 0.5        # seconds without remote command to stop
+    MAX_SLEW_RATE = 1020        # motor speed change per second, remote
+    MAX_ACCELERATION = 8160     # change of MAX_SLEW_RATE per second
+    MOTOR_WATCHDOG_DEADLINE = 0.25  # seconds without motor command or
+                                    # completed tick to stop the motors
 
-    def __init__(self):
+    def __init__(self, useReaderThread=False, serialPort='/dev/ttyACM0',
+                 recordingFile=None, logLevel=logging.INFO,
+                 traceMessages=False, handshakeTimeout=0,
+                 remoteController=None, planner=None, perceptionPool=None,
+                 watchdogDeadline=MOTOR_WATCHDOG_DEADLINE,
+                 logFilename=LOG_FILENAME, controllerPool=None):
         """ Called when the robot class is created.
 
         It intializes the sensor data queue and sets up the
-        logging output file
+        logging output file. Log records are written by a background
+        thread, see robot_logging.setupLogging
+
+        Args:
+          useReaderThread (bool): Read the serial port in a background
+                                  thread instead of from run()
+          serialPort (str): The port used to communicate with the Arduino,
+                            e.g. the port of an ArduinoSimulator
+          recordingFile (str): Record all serial traffic to this file,
+                               see flight_recorder.py to replay it
+          logLevel (int): The level of the log file
+          traceMessages (bool): Log every message sent to and received
+                                from the Arduino, needs logging.DEBUG
+          handshakeTimeout (float): Max seconds to wait for the Arduino
+                                    to answer the handshake, 0 skips it.
+                                    The sketch in arduino/ does not
+                                    answer it yet, and every reconnect
+                                    from run() would wait this long.
+          remoteController (NetworkRemoteController): Drive the robot
+                                    with the joystick commands it
+                                    receives
+          planner (ObstaclePlanner): Drive autonomously with this
+                                     planner
+          perceptionPool (PerceptionPool): Dispatch the results of its
+                                           jobs from the control loop
+          watchdogDeadline (float): Stop the motors when no motor
+                                    command was sent and no run()
+                                    completed for this many seconds,
+                                    None disables the motor watchdog
+          logFilename (str): The log file, it is overwritten
+          controllerPool (ControllerPool): Talk to several Arduinos
+                                           through this pool instead of
+                                           a single one on serialPort.
+                                           Links that drop are
+                                           reconnected one by one.
 
         Returns:
 
@@ -38,87 +109,420 @@ class Robot:
           TODO: Add proper error handling.
         """
 
-        self.LOG_FILENAME = 'my_morTimmy.log'
-        logging.basicConfig(filename=self.LOG_FILENAME,
-                            level=logging.DEBUG,
-                            filemode='w',
-                            format='%(asctime)s %(levelname)s %(message)s')
+        if controllerPool is not None and recordingFile is not None:
+            raise ValueError("Recording a ControllerPool is not supported")
+
+        startTime = monotonic()
+
+        self.logFilename = logFilename
+        self.logListener = setupLogging(logFilename, logLevel, filemode='w')
 
         self.state = self.State()
         self.currentState = self.state.stopped
-        self.arduino = HardwareController()
+        self.metrics = Metrics()
+        self.tickDuration = self.metrics.histogram('robot.tickDuration',
+                                                   self.TICK_BUCKETS)
+        self.controllerPool = controllerPool
+        if controllerPool is None:
+            self.arduino = HardwareController(metrics=self.metrics)
+            controllers = [self.arduino]
+            if recordingFile is not None:
+                self.arduino.flightRecorder = FlightRecorder(recordingFile)
+            # Sends and receives all messages
+            self.link = self.arduino
+        else:
+            # The link we get the distance readings from
+            self.arduino = controllerPool.controllerFor(
+                MODULE_DISTANCE_SENSOR)
+            controllers = [controller for controller, args
+                           in controllerPool.links.values()]
+            self.metrics.addSource('pool', controllerPool.metrics.snapshot)
+            self.link = controllerPool
+        for controller in controllers:
+            controller.traceMessages = traceMessages
+        self.commandWriter = CommandWriter(self.link)
         self.runningTime = 0
         self.lastSensorReading = 0
+        self.serialPort = serialPort
+        self.handshakeTimeout = handshakeTimeout
+        self.reconnectBackoff = Backoff()
+        self.nextReconnect = 0
+        self.disconnectTime = None
+        self.coldStartTime = None
+        self.recoveryTime = self.metrics.histogram('robot.recoveryTime')
+
+        self.dispatcher = MessageDispatcher(self.handleUnknownMessage)
+        self.dispatcher.register(MODULE_DISTANCE_SENSOR,
+                                 CMD_DISTANCE_SENSOR_START,
+                                 self.handleDistance)
+
+        self.planner = planner
+        self.planDuration = self.metrics.histogram('robot.planDuration',
+                                                   self.TICK_BUCKETS)
+        if planner is not None:
+            self.currentState = self.state.autonomous
+            self.metrics.gauge('robot.planOverBudget',
+                               lambda: planner.overBudgetCount)
+
+        self.perceptionPool = perceptionPool
+        if perceptionPool is not None:
+            self.metrics.addSource('perception',
+                                   perceptionPool.metrics.snapshot)
+
+        self.remoteController = remoteController
+        self.mixer = DriveMixer(maxSlewRate=self.MAX_SLEW_RATE,
+                                maxAcceleration=self.MAX_ACCELERATION)
+        self.remoteTarget = (0, 0)      # joystick (x, y) to ramp towards
+        self.driveSpeeds = (0, 0)       # (left, right) sent last or None
+        self.motorsHalted = False       # stopped outside the control loop
+        if remoteController is not None:
+            remoteController.onCommand = self.handleRemoteCommand
+            self.metrics.addSource('remote',
+                                   remoteController.metrics.snapshot)
+
+        self.motorWatchdog = None
+        if watchdogDeadline is not None:
+            self.motorWatchdog = MotorWatchdog(
+                self.sendCommand,
+                watchdogDeadline, self.metrics, self.handleWatchdogTrip)
+            # Every motor command sent on the motor link feeds it
+            motorController = self.arduino if controllerPool is None \
+                else controllerPool.controllerFor(MODULE_MOTOR)
+            motorController.motorWatchdog = self.motorWatchdog
 
         logging.info('initialising morTimmy the robot')
         self.sensorDataQueue = queue.Queue()
         self.initialize()
+        self.coldStartTime = monotonic() - startTime
+        logging.info("Ready for the first command %.3fs after start",
+                     self.coldStartTime)
+        self.metrics.gauge('robot.coldStartTime').set(self.coldStartTime)
+
+        if useReaderThread:
+            self.link.startReader()
+        if self.motorWatchdog is not None:
+            self.motorWatchdog.start()
 
     def initialize(self):
         """ (re)initializes the robot.
 
         Responsible for setting up the connection to the Arduino.
-        The function loops until a connection is established
+        The function loops until a connection is established, waiting
+        exponentially longer between attempts. When the serial device
+        node is missing we retry as soon as it is plugged in.
         """
-        self.arduino.initialize()
-        while not self.arduino.isConnected:
-            print ("Failed to establish connection to Arduino, retrying in 5s")
+        self.reconnectBackoff.reset()
+        while not self.connect():
+            delay = self.reconnectBackoff.next()
+            print("Failed to establish connection to Arduino, "
+                  "retrying in %.2fs" % delay)
             logging.warning("Failed to establish connection to Arduino, "
-                            "retrying in 5s")
-            sleep(5)                # wait 5sec before trying again
-            self.arduino.initialize()
+                            "retrying in %.2fs", delay)
+            if not self.serialDeviceMissing():
+                sleep(delay)
+            elif waitForDevice(self.serialPort, delay):
+                # Give udev a moment to set the permissions
+                sleep(self.reconnectBackoff.initial)
+        self.reconnectBackoff.reset()
         logging.info('Connected to Arduino through serial connection')
         self.runningTime = 0
 
+    def serialDeviceMissing(self):
+        """ True if serialPort is a device node that does not exist
+
+        Always False with a controllerPool, it checks the device node
+        of every link itself.
+        """
+
+        return self.controllerPool is None and \
+            isinstance(self.serialPort, str) and \
+            not os.path.exists(self.serialPort)
+
+    def connect(self):
+        """ Try to connect to the Arduino once
+
+        Returns:
+            True if the Arduino answered the handshake
+        """
+
+        if self.serialDeviceMissing():
+            return False
+
+        if self.controllerPool is not None:
+            self.controllerPool.initialize()
+            self.commandWriter.track = self.controllerPool.acknowledges
+            return self.controllerPool.isConnected
+
+        batchSize = self.TELEMETRY_BATCH_SIZE if self.planner is None \
+            else self.PLANNER_TELEMETRY_BATCH_SIZE
+        self.arduino.initialize(self.serialPort,
+                                handshakeTimeout=self.handshakeTimeout,
+                                telemetryBatchSize=batchSize)
+        # Retransmitting only helps when the firmware sends ACKs
+        self.commandWriter.track = self.arduino.acknowledges
+        return self.arduino.isConnected
+
+    def reconnect(self, currentTime):
+        """ Reconnect to the Arduino without stalling the control loop
+
+        Attempts are spread out by the reconnectBackoff and skipped
+        while the device node is missing. The time from losing the
+        connection until the Arduino is ready again is recorded in
+        the 'robot.recoveryTime' histogram.
+
+        A controllerPool reconnects only the links that dropped, each
+        with its own backoff, see ControllerPool.reconnect.
+        """
+
+        if self.controllerPool is not None:
+            self.controllerPool.reconnect(currentTime)
+            self.commandWriter.track = self.controllerPool.acknowledges
+            return
+
+        if self.disconnectTime is None:
+            self.disconnectTime = currentTime
+            logging.warning("Lost connection to Arduino")
+
+        if currentTime < self.nextReconnect or self.serialDeviceMissing():
+            return
+
+        if self.connect():
+            recovery = monotonic() - self.disconnectTime
+            self.recoveryTime.record(recovery)
+            logging.info("Reconnected to Arduino after %.3fs", recovery)
+            self.disconnectTime = None
+            self.reconnectBackoff.reset()
+        else:
+            self.nextReconnect = monotonic() + self.reconnectBackoff.next()
+
     def run(self):
         """ The main robot loop """
 
+        tickStart = monotonic()
+
+        currentTime = monotonic()
+
         # Check connection to arduino, reinitialize if not
-        if not self.arduino.isConnected:
-            self.arduino.initialize()
+        if not self.link.isConnected:
+            self.reconnect(currentTime)
 
-        currentTime = time()
+        if self.remoteController is not None:
+            self.checkRemote(currentTime)
 
-        # Turn robot randomly to the left or right when an object is near
-        if self.arduino.getDistance() <= self.MIN_DISTANCE_TO_OBJECT:
-            pass
+        # Stop when an object is near and we are not steering around it
+        distance = self.arduino.getDistance()
+        if distance is not None and distance <= self.MIN_DISTANCE_TO_OBJECT \
+                and self.currentState == self.state.running:
+            self.commandWriter.queueCommand(MODULE_MOTOR, CMD_MOTOR_STOP)
+            self.runningTime = currentTime
+            self.currentState = self.state.stopped
+            logging.info("Robot stopped, object at %scm", distance)
 
+        if self.currentState == self.state.autonomous:
+            self.drivePlanner(currentTime)
+        elif self.currentState == self.state.remote:
+            self.driveRemote()
         # Move robot forward if stopped for 5sec
-        if self.currentState == self.state.stopped and (currentTime - self.runningTime) >= 5:
-            self.arduino.sendMessage(MODULE_MOTOR, CMD_MOTOR_FORWARD, 255)
+        elif self.currentState == self.state.stopped and (currentTime - self.runningTime) >= 5:
+            self.commandWriter.queueCommand(MODULE_MOTOR, CMD_MOTOR_FORWARD,
+                                            255)
             self.runningTime = currentTime
             self.currentState = self.state.running
-            print("Robot moving forward")
+            logging.info("Robot moving forward")
         # Stop robot if running for 5sec
         elif self.currentState == self.state.running and (currentTime - self.runningTime) >= 5:
-            self.arduino.sendMessage(MODULE_MOTOR, CMD_MOTOR_STOP)
+            self.commandWriter.queueCommand(MODULE_MOTOR, CMD_MOTOR_STOP)
             self.runningTime = currentTime
             self.currentState = self.state.stopped
-            print("Robot stopped")
+            logging.info("Robot stopped")
+
+        # Send all motor commands of this tick in one write
+        self.commandWriter.flush()
 
         # Read bytes from the Arduino and add messages to the Queue if found
-        self.arduino.recvMessage()
-
-        # Process all received messages in the queue
-        while not self.arduino.recvMessageQueue.empty():
-            recvMessage = self.arduino.recvMessageQueue.get_nowait()
-
-            if recvMessage is None:
-                # Why does the queue always return a None object?
-                break
-            elif recvMessage == 'Invalid':
-                logging.error('Received invalid packet, ignoring')
-            elif recvMessage['module'] == chr(MODULE_DISTANCE_SENSOR):
-                self.arduino.setDistance(recvMessage['data'])
-            else:
-                logging.warning("Message with unknown module or command received. Message details:")
-                logging.warning("msgID: %d ackID: %d module: %s "
-                               "commandType: %s data: %d checksum: %s" % (recvMessage['messageID'],
-                                                                          recvMessage['acknowledgeID'],
-                                                                          hex(recvMessage['module']),
-                                                                          hex(recvMessage['commandType']),
-                                                                          recvMessage['data'],
-                                                                          hex(recvMessage['checksum'])))
+        if not self.link.readerRunning:
+            self.link.recvMessage()
+
+        # Pass the received messages to their handlers, messages
+        # beyond MAX_MESSAGES_PER_TICK are handled next tick
+        self.dispatcher.dispatchMessages(
+            self.link.recvMessageQueue.getBatch(
+                self.MAX_MESSAGES_PER_TICK))
+
+        # Results of perception jobs that finished in the meantime
+        if self.perceptionPool is not None:
+            self.perceptionPool.dispatchResults(self.MAX_RESULTS_PER_TICK)
+
+        # The tick completed, the motors may keep their speed
+        if self.motorWatchdog is not None:
+            self.motorWatchdog.heartbeat()
+
+        self.tickDuration.record(monotonic() - tickStart)
+
+    def sendCommand(self, module, commandType, data=0):
+        """ Send a command right away, bypassing the commandWriter
+
+        The command is tracked for retransmission like the queued ones
+        when the Arduino acknowledges messages.
+
+        Returns:
+            The messageID or None if not connected
+        """
+
+        return self.link.sendMessage(module, commandType, data,
+                                     track=self.commandWriter.track)
+
+    def drivePlanner(self, currentTime):
+        """ Let the planner steer the robot for a tick
+
+        The latest distance reading is handed to the planner, which
+        returns the servo and motor commands to send, if any.
+        """
+
+        panAngle, motorCommand = self.planner.step(
+            currentTime, self.arduino.lastDistance,
+            self.arduino.lastDistanceTime)
+        self.planDuration.record(self.planner.lastPlanDuration)
+
+        if panAngle is not None:
+            self.commandWriter.queueCommand(MODULE_SERVO, CMD_SERVO_PAN,
+                                            panAngle)
+        if motorCommand is not None:
+            self.commandWriter.queueCommand(MODULE_MOTOR, *motorCommand)
+
+    def checkRemote(self, currentTime):
+        """ Follow the remote control and stop when it goes quiet
+
+        The control loop takes the latest joystick position, which
+        driveRemote ramps the motors towards. When no command arrived
+        for REMOTE_TIMEOUT seconds, e.g. because the phone lost its
+        WiFi connection, the robot stops and stays idle until the
+        remote sends again. It never falls back to a state that
+        drives on its own.
+        """
+
+        command = self.remoteController.recvCommand()
+        if command is not None:
+            self.remoteTarget = (command.x, command.y)
+            self.currentState = self.state.remote
+        elif self.currentState == self.state.remote and \
+                currentTime - self.remoteController.lastCommandTime >= \
+                self.REMOTE_TIMEOUT:
+            self.commandWriter.queueCommand(MODULE_MOTOR, CMD_MOTOR_STOP)
+            self.remoteTarget = (0, 0)
+            self.mixer.reset()
+            self.driveSpeeds = (0, 0)
+            self.currentState = self.state.idle
+            logging.warning("Remote control timed out, robot stopped "
+                            "until the next remote command")
+
+    def driveRemote(self):
+        """ Ramp the motors towards the remote joystick position
+
+        Called every tick in the remote state. The mixer limits how
+        fast the motor speeds change, the speeds of each side are sent
+        with CMD_MOTOR_DRIVE whenever they changed.
+        """
+
+        if self.motorsHalted:
+            # Ramp up from standstill again. The speeds sent last are
+            # unknown, a DRIVE could have been queued after the stop
+            self.motorsHalted = False
+            self.mixer.reset()
+            self.driveSpeeds = None
+
+        speeds = self.mixer.update(*self.remoteTarget)
+        if speeds == self.driveSpeeds:
+            return
+        self.driveSpeeds = speeds
+        if speeds == (0, 0):
+            self.commandWriter.queueCommand(MODULE_MOTOR, CMD_MOTOR_STOP)
+        else:
+            self.commandWriter.queueCommand(MODULE_MOTOR, CMD_MOTOR_DRIVE,
+                                            packSpeeds(*speeds))
+
+    def handleRemoteCommand(self, command):
+        """ Stop the motors right away when the remote says so
+
+        Called from the I/O thread of the remote controller, so a stop
+        does not wait for the next control loop tick nor for the
+        mixer to ramp down. Joystick positions are picked up by
+        checkRemote.
+
+        Args:
+            command (ControllerCmd): The latest remote command
+        """
+
+        if not command.halt:
+            return
+        self.motorsHalted = True
+        self.commandWriter.queueCommand(MODULE_MOTOR, CMD_MOTOR_STOP)
+        self.commandWriter.flush()
+
+    def handleWatchdogTrip(self, stall):
+        """ Called from the watchdog thread after it stopped the motors
+
+        The control loop resends its motor command once it is back.
+
+        Args:
+            stall (float): Seconds since the last motor command or tick
+        """
+
+        if self.currentState == self.state.running:
+            self.runningTime = monotonic()
+            self.currentState = self.state.stopped
+        if self.planner is not None:
+            self.planner.motorCommand = None
+        self.motorsHalted = True
+
+    def handleDistance(self, message):
+        """ Handle a reading of the distance sensor """
+
+        self.arduino.setDistance(message.data)
+
+    def handleUnknownMessage(self, message):
+        """ Handle a message no handler is registered for """
+
+        logging.warning("Message with unknown module or command "
+                        "received. msgID: %d ackID: %d module: %#x "
+                        "commandType: %#x data: %d checksum: %#x",
+                        message.messageID,
+                        message.acknowledgeID,
+                        message.module,
+                        message.commandType,
+                        message.data,
+                        message.checksum)
+
+    def logTelemetry(self, scheduler):
+        """ Log the timing and message statistics
+
+        The records repeat every call, so they bypass the rate limit.
+
+        Args:
+            scheduler (Scheduler): The scheduler running the robot
+        """
+
+        for name, stats in scheduler.getStats().items():
+            logging.info("Task %s: %d runs, %d overruns, %d skipped, "
+                         "duration mean %.2fms max %.2fms, "
+                         "jitter mean %.2fms max %.2fms",
+                         name, stats['runs'], stats['overruns'],
+                         stats['skipped'], stats['meanDuration'],
+                         stats['maxDuration'], stats['meanJitter'],
+                         stats['maxJitter'], extra=NO_RATE_LIMIT)
+
+        if self.controllerPool is None:
+            logging.info("Messages: %s",
+                         self.arduino.messageTracker.getStats(),
+                         extra=NO_RATE_LIMIT)
+        else:
+            for name, (controller, args) in \
+                    self.controllerPool.links.items():
+                logging.info("Messages on link %s: %s", name,
+                             controller.messageTracker.getStats(),
+                             extra=NO_RATE_LIMIT)
+        logging.info("Metrics: %s", self.metrics.snapshot()['counters'],
+                     extra=NO_RATE_LIMIT)
 
 
 def main():
@@ -126,14 +530,54 @@ def main():
 
     It will only contain a very limited program
     logic. The main action happens in the Robot class
+    which is run at a fixed rate by the Scheduler
     """
-    morTimmy = Robot()
+    parser = argparse.ArgumentParser(description="morTimmy the robot")
+    parser.add_argument('--remote', action='store_true',
+                        help='drive with the network remote control, '
+                        'anyone who can reach --remote-host can steer')
+    parser.add_argument('--remote-host', default='127.0.0.1',
+                        help='address the remote control listens on')
+    parser.add_argument('--autonomous', action='store_true',
+                        help='steer around obstacles with the pan servo '
+                        'and distance sensor')
+    args = parser.parse_args()
+
+    remoteController = None
+    if args.remote:
+        remoteController = NetworkRemoteController(args.remote_host)
+    morTimmy = Robot(useReaderThread=True,
+                     recordingFile=Robot.RECORDING_FILENAME,
+                     remoteController=remoteController,
+                     planner=ObstaclePlanner() if args.autonomous
+                     else None)
+    if remoteController is not None:
+        remoteController.start()
+
+    scheduler = Scheduler()
+    scheduler.addTask(morTimmy.run, morTimmy.CONTROL_LOOP_RATE, 'control')
+    scheduler.addTask(lambda: morTimmy.logTelemetry(scheduler),
+                      morTimmy.TELEMETRY_RATE, 'telemetry')
+
+    morTimmy.metrics.addSource('tasks', scheduler.getStats)
+    metricsDumper = MetricsDumper(morTimmy.metrics,
+                                  filename=Robot.METRICS_FILENAME,
+                                  interval=Robot.METRICS_INTERVAL)
+    metricsDumper.start()
 
     try:
-        while(True):
-            morTimmy.run()
+        scheduler.run()
     except KeyboardInterrupt:
         print("Thanks for running me!")
+    finally:
+        metricsDumper.stop()
+        if morTimmy.motorWatchdog is not None:
+            morTimmy.motorWatchdog.stop()
+        if remoteController is not None:
+            remoteController.stop()
+        morTimmy.link.stopReader()
+        morTimmy.arduino.flightRecorder.close()
+        stopLogging(morTimmy.logListener)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+from time import monotonic
+from metrics import Metrics
+from protocol import MODULE_MOTOR, CMD_MOTOR_STOP
+
+
+class MotorWatchdog():
+
+    """ Stops the motors when the control loop stops feeding us
+
+    Once a motor command other than CMD_MOTOR_STOP was sent the
+    watchdog is armed. From then on every motor command and every
+    heartbeat() of the control loop pushes the deadline forward. When
+    neither arrives for deadline seconds, e.g. because the loop hangs
+    in a blocking read or a slow log write, a timer thread sends
+    CMD_MOTOR_STOP itself and disarms until the next motor command.
+
+    A heartbeat is a single attribute assignment, the timer thread is
+    only woken when the deadline may have passed. Motor commands must
+    be passed to motorCommand before they are written: it waits while
+    the watchdog is stopping the motors, so a new command is always
+    written after the stop and never overridden by it.
+
+    Every trip is logged and counted with its latency: the time from
+    the deadline until the stop command was written, which shows how
+    long the GIL kept the watchdog from running. When the stop cannot
+    be sent, e.g. while the Arduino is disconnected, that is counted
+    separately and the watchdog tries again every deadline seconds.
+    """
+
+    def __init__(self, sendFunction, deadline=0.25, metrics=None,
+                 onTrip=None, clock=monotonic):
+        """ Sets up the watchdog, start() starts the timer thread
+
+        Args:
+            sendFunction (function): Called as sendFunction(module,
+                                     commandType) to stop the motors,
+                                     returns None if nothing was sent
+            deadline (float): Seconds without a motor command or
+                              heartbeat before the motors are stopped
+            metrics (Metrics): Registry for the 'watchdog.*' metrics
+            onTrip (function): Called from the timer thread with the
+                               seconds since the last feed after the
+                               motors were stopped
+            clock (function): Returns the time in seconds
+        """
+
+        self.sendFunction = sendFunction
+        self.deadline = deadline
+        self.onTrip = onTrip
+        self.clock = clock
+        self.armed = False
+        self.lastFeed = clock()
+
+        self.metrics = metrics or Metrics()
+        self.__trips = self.metrics.counter('watchdog.trips')
+        self.__tripLatency = self.metrics.histogram('watchdog.tripLatency')
+        self.__lastStall = self.metrics.gauge('watchdog.lastStall')
+        self.__failedStops = self.metrics.counter('watchdog.failedStops')
+
+        # Reentrant, sending the stop command feeds us from check
+        self.__lock = threading.RLock()
+        self.__stopFailing = False
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def heartbeat(self):
+        """ Tell the watchdog the control loop is alive """
+        self.lastFeed = self.clock()
+
+    def motorCommand(self, commandType):
+        """ Feed the watchdog with a motor command about to be sent
+
+        CMD_MOTOR_STOP disarms the watchdog, any other command arms it.
+        """
+
+        with self.__lock:
+            self.lastFeed = self.clock()
+            self.armed = commandType != CMD_MOTOR_STOP
+
+    @property
+    def running(self):
+        """ True if the timer thread is active """
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        """ Start the timer thread """
+
+        if self.running:
+            return
+
+        self.lastFeed = self.clock()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='morTimmy-watchdog',
+                                         daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop the timer thread, the motors are left alone """
+
+        if self.__thread is None:
+            return
+
+        self.__stop.set()
+        self.__thread.join(timeout)
+        self.__thread = None
+
+    def check(self, now=None):
+        """ Stop the motors if the deadline passed
+
+        Called by the timer thread, can also be called directly.
+
+        Returns:
+            Seconds until the deadline, the deadline if disarmed
+        """
+
+        with self.__lock:
+            if now is None:
+                now = self.clock()
+            remaining = self.lastFeed + self.deadline - now
+            if not self.armed:
+                return self.deadline
+            if remaining > 0:
+                return remaining
+
+            # Sending the stop command feeds us too
+            lastFeed = self.lastFeed
+            try:
+                sent = self.sendFunction(MODULE_MOTOR,
+                                         CMD_MOTOR_STOP) is not None
+            except Exception:
+                logging.exception("Watchdog failed to stop the motors")
+                sent = False
+            stall = self.clock() - lastFeed
+
+            if not sent:
+                self.lastFeed = lastFeed
+                self.armed = True
+                self.__failedStops.inc()
+                if not self.__stopFailing:
+                    logging.error("Watchdog could not stop the motors, "
+                                  "no motor command or heartbeat for "
+                                  "%.3fs", stall)
+                self.__stopFailing = True
+                return self.deadline
+
+            self.armed = False
+            self.__stopFailing = False
+
+        latency = stall - self.deadline
+        self.__trips.inc()
+        self.__tripLatency.record(latency)
+        self.__lastStall.set(stall)
+        logging.warning("Watchdog stopped the motors, no motor command or "
+                        "heartbeat for %.3fs (%.1fms after the deadline)",
+                        stall, latency * 1000)
+
+        if self.onTrip is not None:
+            try:
+                self.onTrip(stall)
+            except Exception:
+                logging.exception("Watchdog trip handler failed")
+        return self.deadline
+
+    def __run(self):
+        """ Main loop of the timer thread """
+
+        wait = self.deadline
+        while not self.__stop.wait(wait):
+            wait = self.check()
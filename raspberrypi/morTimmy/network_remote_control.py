@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import hashlib
+import logging
+import selectors
+import socket
+import struct
+import threading
+from collections import OrderedDict
+from time import monotonic, sleep
+from metrics import Metrics
+from remote_control import ControllerDriver, ControllerCmd
+
+# Joystick packet layout
+#
+# A phone or game controller sends its joystick position many times a
+# second as a small binary packet:
+#
+#  +--------+-------+----------+---+---+
+#  | marker | flags | sequence | x | y |
+#  +--------+-------+----------+---+---+
+#
+#  marker    (unsigned char, 1 byte, REMOTE_PACKET_MARKER)
+#  flags     (unsigned char, 1 byte, REMOTE_FLAG_*)
+#  sequence  (unsigned long, 4 bytes, incremented for every packet)
+#  x         (signed short, 2 bytes, steering, -255 to 255)
+#  y         (signed short, 2 bytes, forward/back speed, -255 to 255)
+#
+# Over UDP every datagram holds one packet. Over TCP and in WebSocket
+# binary messages the packets simply follow each other.
+
+REMOTE_PACKET_MARKER = 0xA5
+REMOTE_PACKET_STRUCT = struct.Struct('<BBLhh')
+REMOTE_PACKET_SIZE = REMOTE_PACKET_STRUCT.size
+REMOTE_FLAG_STOP = 0x01         # stop the motors, x and y are ignored
+
+REMOTE_UDP_PORT = 5005
+REMOTE_TCP_PORT = 5006
+REMOTE_WEBSOCKET_PORT = 5007
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_OPCODE_CONTINUATION = 0x0
+WEBSOCKET_OPCODE_BINARY = 0x2
+WEBSOCKET_OPCODE_CLOSE = 0x8
+WEBSOCKET_OPCODE_PING = 0x9
+WEBSOCKET_OPCODE_PONG = 0xA
+WEBSOCKET_MAX_CONTROL_PAYLOAD = 125     # bytes, see RFC 6455 5.5
+
+
+def packJoystick(sequence, x, y, flags=0):
+    """ Creates a joystick packet, see the layout above """
+
+    return REMOTE_PACKET_STRUCT.pack(REMOTE_PACKET_MARKER, flags,
+                                     sequence & 0xffffffff, x, y)
+
+
+def unpackJoystick(packet):
+    """ Unpacks a joystick packet
+
+    Returns:
+        (flags, sequence, x, y) or None if the packet is invalid
+    """
+
+    if len(packet) != REMOTE_PACKET_SIZE:
+        return None
+    marker, flags, sequence, x, y = REMOTE_PACKET_STRUCT.unpack(packet)
+    if marker != REMOTE_PACKET_MARKER:
+        return None
+    return flags, sequence, x, y
+
+
+def isNewer(sequence, lastSequence):
+    """ True if sequence comes after lastSequence
+
+    Sequence numbers wrap around, a sequence up to half the number
+    space ahead of lastSequence counts as newer.
+    """
+
+    return 0 < (sequence - lastSequence) & 0xffffffff < 0x80000000
+
+
+class RemoteConnection():
+
+    """ A TCP or WebSocket client of the NetworkRemoteController """
+
+    def __init__(self, sock, address, webSocket):
+        self.sock = sock
+        self.address = address
+        self.webSocket = webSocket
+        self.handshakeDone = not webSocket
+        self.buffer = bytearray()       # received bytes not handled yet
+        self.packets = bytearray()      # WebSocket payload not handled yet
+
+
+class NetworkRemoteController(ControllerDriver):
+
+    """ Remote control morTimmy over the network
+
+    Joystick packets are received over UDP, WebSocket (for a browser
+    on a phone) and plain TCP (handy for tests) by a single I/O thread
+    waiting on all sockets with a selector.
+
+    Only the newest command matters for driving, so packets are not
+    queued. Each sender has its own sequence numbers, a packet that is
+    not newer than the last one of its sender arrived out of order and
+    is dropped. Accepted packets replace the command waiting for the
+    control loop, which picks it up with recvCommand. For the lowest
+    latency onCommand is called from the I/O thread right away.
+    """
+
+    MAX_PEERS = 16              # senders we keep the sequence number of
+    SELECT_TIMEOUT = 0.1        # seconds, how often stop() is noticed
+    MAX_HANDSHAKE_SIZE = 4096   # bytes of a WebSocket upgrade request
+    MAX_FRAME_SIZE = 4096       # bytes of WebSocket frame payload
+
+    def __init__(self, host='127.0.0.1', udpPort=REMOTE_UDP_PORT,
+                 tcpPort=None, webSocketPort=REMOTE_WEBSOCKET_PORT,
+                 onCommand=None, metrics=None):
+        """ Sets up the controller, the sockets are opened by start
+
+        Args:
+            host (str): Address to listen on. There is no
+                        authentication, only listen on a public address
+                        on a network you trust.
+            udpPort (int): UDP port or None, 0 picks a free port
+            tcpPort (int): TCP port or None, 0 picks a free port
+            webSocketPort (int): WebSocket port or None, 0 picks a
+                                 free port
+            onCommand (function): Called from the I/O thread with every
+                                  accepted ControllerCmd
+            metrics (Metrics): Registry for the 'remote.*' metrics
+        """
+
+        self.host = host
+        self.udpPort = udpPort
+        self.tcpPort = tcpPort
+        self.webSocketPort = webSocketPort
+        self.onCommand = onCommand
+        self.lastCommandTime = None     # monotonic() of the newest command
+
+        self.metrics = metrics or Metrics()
+        self.__packets = self.metrics.counter('remote.packets')
+        self.__stalePackets = self.metrics.counter('remote.stalePackets')
+        self.__invalidPackets = self.metrics.counter('remote.invalidPackets')
+        self.__coalesced = self.metrics.counter('remote.coalescedCommands')
+        self.__handoffLatency = self.metrics.histogram(
+            'remote.handoffLatency')
+
+        self.__latest = None            # (ControllerCmd, receivedTime)
+        self.__lock = threading.Lock()
+        self.__sequences = OrderedDict()    # sender: last sequence
+        self.__selector = None
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    @property
+    def running(self):
+        """ True if the I/O thread is active """
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        """ Open the sockets and start the I/O thread """
+
+        if self.running:
+            return
+
+        self.__selector = selectors.DefaultSelector()
+        if self.udpPort is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.udpPort))
+            sock.setblocking(False)
+            self.udpPort = sock.getsockname()[1]
+            self.__selector.register(sock, selectors.EVENT_READ, 'udp')
+        for port, name in ((self.tcpPort, 'tcp'),
+                           (self.webSocketPort, 'websocket')):
+            if port is None:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, port))
+            sock.listen()
+            sock.setblocking(False)
+            if name == 'tcp':
+                self.tcpPort = sock.getsockname()[1]
+            else:
+                self.webSocketPort = sock.getsockname()[1]
+            self.__selector.register(sock, selectors.EVENT_READ, name)
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__ioLoop,
+                                         name='morTimmy-remote',
+                                         daemon=True)
+        self.__thread.start()
+        logging.info("Remote control listening on udp:%s tcp:%s "
+                     "websocket:%s", self.udpPort, self.tcpPort,
+                     self.webSocketPort)
+
+    def stop(self, timeout=None):
+        """ Stop the I/O thread and close all sockets """
+
+        if self.__thread is None:
+            return
+
+        self.__stop.set()
+        self.__thread.join(timeout)
+        self.__thread = None
+
+    def recvCommand(self):
+        """ Returns the newest command or None if there is no new one
+
+        Commands that arrived since the last call and were replaced by
+        a newer one are never returned.
+        """
+
+        with self.__lock:
+            latest = self.__latest
+            self.__latest = None
+
+        if latest is None:
+            return None
+
+        command, receivedTime = latest
+        self.__handoffLatency.record(monotonic() - receivedTime)
+        return command
+
+    def handlePacket(self, packet, sender, receivedTime=None):
+        """ Decode a joystick packet and make it the latest command
+
+        Args:
+            packet (bytes): The packet
+            sender: Identifies the sender for its sequence numbers
+            receivedTime (float): monotonic() when it was received
+
+        Returns:
+            The ControllerCmd or None if the packet was dropped
+        """
+
+        self.__packets.inc()
+        decoded = unpackJoystick(packet)
+        if decoded is None:
+            self.__invalidPackets.inc()
+            return None
+
+        flags, sequence, x, y = decoded
+        lastSequence = self.__sequences.get(sender)
+        if lastSequence is not None and not isNewer(sequence, lastSequence):
+            self.__stalePackets.inc()
+            return None
+
+        self.__sequences[sender] = sequence
+        self.__sequences.move_to_end(sender)
+        if len(self.__sequences) > self.MAX_PEERS:
+            self.__sequences.popitem(last=False)
+
+        command = ControllerCmd()
+        if flags & REMOTE_FLAG_STOP:
+            command.stop()
+        else:
+            command.joystick(x, y)
+
+        if receivedTime is None:
+            receivedTime = monotonic()
+        with self.__lock:
+            if self.__latest is not None:
+                self.__coalesced.inc()
+            self.__latest = (command, receivedTime)
+        self.lastCommandTime = receivedTime
+
+        if self.onCommand is not None:
+            try:
+                self.onCommand(command)
+            except Exception:
+                logging.exception("Remote command handler failed")
+        return command
+
+    def __ioLoop(self):
+        """ Main loop of the I/O thread """
+
+        try:
+            while not self.__stop.is_set():
+                for key, mask in self.__selector.select(self.SELECT_TIMEOUT):
+                    if key.data == 'udp':
+                        self.__readDatagrams(key.fileobj)
+                    elif key.data in ('tcp', 'websocket'):
+                        self.__accept(key.fileobj, key.data == 'websocket')
+                    else:
+                        self.__readConnection(key.data)
+        finally:
+            for key in list(self.__selector.get_map().values()):
+                key.fileobj.close()
+            self.__selector.close()
+
+    def __readDatagrams(self, sock):
+        """ Handle every datagram waiting, newest last """
+
+        while True:
+            try:
+                packet, address = sock.recvfrom(64)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.warning("Remote control UDP error: %s", e)
+                return
+            self.handlePacket(packet, address, monotonic())
+
+    def __accept(self, listener, webSocket):
+        """ Accept a TCP or WebSocket client """
+
+        try:
+            sock, address = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = RemoteConnection(sock, address, webSocket)
+        self.__selector.register(sock, selectors.EVENT_READ, connection)
+        logging.info("Remote control client %s connected", address)
+
+    def __send(self, connection, data):
+        """ Send data to a client without blocking
+
+        The replies are tiny, a client that cannot take them right
+        away is not reading and gets dropped by the caller.
+
+        Returns:
+            False if sending failed
+        """
+
+        try:
+            connection.sock.sendall(data)
+        except OSError as e:
+            logging.warning("Remote control client %s failed: %s",
+                            connection.address, e)
+            return False
+        return True
+
+    def __close(self, connection):
+        self.__selector.unregister(connection.sock)
+        connection.sock.close()
+        self.__sequences.pop(connection, None)
+        logging.info("Remote control client %s disconnected",
+                     connection.address)
+
+    def __readConnection(self, connection):
+        """ Handle the bytes received from a TCP or WebSocket client """
+
+        try:
+            data = connection.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logging.warning("Remote control client %s failed: %s",
+                            connection.address, e)
+            data = b''
+        if not data:
+            self.__close(connection)
+            return
+
+        receivedTime = monotonic()
+        connection.buffer += data
+
+        if connection.webSocket:
+            if not connection.handshakeDone:
+                handshake = self.__webSocketHandshake(connection)
+                if handshake is None:
+                    self.__close(connection)
+                if not handshake:
+                    return
+            if not self.__readWebSocketFrames(connection):
+                self.__close(connection)
+                return
+            stream = connection.packets
+        else:
+            stream = connection.buffer
+
+        self.__handleStream(stream, connection, receivedTime)
+
+    def __handleStream(self, stream, connection, receivedTime):
+        """ Handle the complete packets in stream and remove them
+
+        All complete packets are decoded so their sequence numbers are
+        seen, but only the newest one becomes the latest command.
+        """
+
+        start = 0
+        end = len(stream)
+        while end - start >= REMOTE_PACKET_SIZE:
+            if stream[start] != REMOTE_PACKET_MARKER:
+                # Out of sync, skip to the next marker
+                marker = stream.find(REMOTE_PACKET_MARKER, start + 1)
+                self.__invalidPackets.inc()
+                start = end if marker < 0 else marker
+                continue
+            self.handlePacket(bytes(stream[start:start + REMOTE_PACKET_SIZE]),
+                              connection, receivedTime)
+            start += REMOTE_PACKET_SIZE
+        del stream[:start]
+
+    def __webSocketHandshake(self, connection):
+        """ Answer the HTTP upgrade request of a WebSocket client
+
+        Returns:
+            True once the handshake is done, False if the request is
+            not complete yet or None if the client must be dropped
+        """
+
+        end = connection.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(connection.buffer) > self.MAX_HANDSHAKE_SIZE:
+                return None
+            return False
+
+        key = None
+        for line in bytes(connection.buffer[:end]).split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'sec-websocket-key':
+                key = value.strip()
+        if key is None:
+            self.__send(connection, b'HTTP/1.1 400 Bad Request\r\n\r\n')
+            return None
+
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+        if not self.__send(connection,
+                           b'HTTP/1.1 101 Switching Protocols\r\n'
+                           b'Upgrade: websocket\r\n'
+                           b'Connection: Upgrade\r\n'
+                           b'Sec-WebSocket-Accept: ' + accept +
+                           b'\r\n\r\n'):
+            return None
+        del connection.buffer[:end + 4]
+        connection.handshakeDone = True
+        return True
+
+    def __readWebSocketFrames(self, connection):
+        """ Move the payload of all complete frames to connection.packets
+
+        Frames larger than MAX_FRAME_SIZE and control frames larger
+        than RFC 6455 allows are refused, so a client cannot make the
+        buffer grow without bound.
+
+        Returns:
+            False if the client closed the connection or must be
+            dropped
+        """
+
+        buffer = connection.buffer
+        while len(buffer) >= 2:
+            opcode = buffer[0] & 0x0f
+            masked = buffer[1] & 0x80
+            length = buffer[1] & 0x7f
+            offset = 2
+            if length == 126:
+                if len(buffer) < 4:
+                    break
+                length, = struct.unpack_from('>H', buffer, 2)
+                offset = 4
+            elif length == 127:
+                if len(buffer) < 10:
+                    break
+                length, = struct.unpack_from('>Q', buffer, 2)
+                offset = 10
+            if length > self.MAX_FRAME_SIZE or (
+                    opcode & 0x8 and length > WEBSOCKET_MAX_CONTROL_PAYLOAD):
+                logging.warning("Remote control client %s sent a %d byte "
+                                "frame, dropping it", connection.address,
+                                length)
+                return False
+            if masked:
+                offset += 4
+            if len(buffer) < offset + length:
+                break
+
+            payload = bytes(buffer[offset:offset + length])
+            if masked and length:
+                mask = buffer[offset - 4:offset] * (length // 4 + 1)
+                payload = (int.from_bytes(payload, 'big') ^
+                           int.from_bytes(mask[:length], 'big')
+                           ).to_bytes(length, 'big')
+            del buffer[:offset + length]
+
+            if opcode in (WEBSOCKET_OPCODE_BINARY,
+                          WEBSOCKET_OPCODE_CONTINUATION):
+                connection.packets += payload
+            elif opcode == WEBSOCKET_OPCODE_PING:
+                if not self.__send(connection, bytes(
+                        [0x80 | WEBSOCKET_OPCODE_PONG, length]) + payload):
+                    return False
+            elif opcode == WEBSOCKET_OPCODE_CLOSE:
+                self.__send(connection,
+                            bytes([0x80 | WEBSOCKET_OPCODE_CLOSE, 0]))
+                return False
+        return True
+
+
+def main():
+    """ Print the commands received from a remote, or send one """
+
+    parser = argparse.ArgumentParser(
+        description="morTimmy network remote control")
+    parser.add_argument('command', choices=['listen', 'send'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=REMOTE_UDP_PORT,
+                        help='UDP port')
+    parser.add_argument('-x', type=int, default=0, help='steering')
+    parser.add_argument('-y', type=int, default=0, help='speed')
+    parser.add_argument('--sequence', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == 'send':
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packJoystick(args.sequence, args.x, args.y),
+                        (args.host, args.port))
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    remote = NetworkRemoteController(
+        args.host, udpPort=args.port, tcpPort=REMOTE_TCP_PORT,
+        onCommand=lambda command: print("left %4d right %4d" % (
+            command.leftMotorSpeed, command.rightMotorSpeed)))
+    remote.start()
+    try:
+        while remote.running:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.stop()
+
+
+if __name__ == '__main__':
+    main()
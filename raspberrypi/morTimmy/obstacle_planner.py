@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+from array import array
+from time import perf_counter
+from protocol import CMD_MOTOR_FORWARD, CMD_MOTOR_BACK, CMD_MOTOR_LEFT, \
+    CMD_MOTOR_RIGHT, CMD_MOTOR_STOP
+
+# Angles are those of the pan servo in degrees: 90 is straight ahead,
+# lower angles are to the right and higher angles to the left.
+SERVO_CENTER = 90
+
+
+class PolarGrid():
+
+    """ Distance to the nearest obstacle in every direction
+
+    The field of view of the pan servo is divided in sectors of
+    sectorWidth degrees. Each sector holds the last distance measured
+    in its direction and when it was measured, in two preallocated
+    arrays, so a reading is a constant time update.
+
+    The robot moves, so readings older than maxAge seconds are not
+    trusted anymore and count as unknownDistance. By default that is
+    0, so directions we have no recent reading of are blocked.
+    """
+
+    def __init__(self, sectorWidth=30, fieldOfView=180, maxDistance=200,
+                 maxAge=2.0, unknownDistance=0):
+        """ Sets up an empty grid
+
+        Args:
+            sectorWidth (int): Degrees per sector
+            fieldOfView (int): Degrees covered, starting at angle 0
+            maxDistance (int): Readings are capped to this distance
+            maxAge (float): Seconds a reading is trusted
+            unknownDistance (int): Distance of sectors without a recent
+                                   reading
+        """
+
+        self.sectorWidth = sectorWidth
+        self.sectorCount = fieldOfView // sectorWidth + 1
+        self.maxDistance = maxDistance
+        self.maxAge = maxAge
+        self.unknownDistance = unknownDistance
+
+        self.distances = array('H', [0]) * self.sectorCount
+        self.timestamps = array('d', [0.0]) * self.sectorCount
+        self.updateCount = 0
+        self.clear()
+
+    def clear(self):
+        """ Forget all readings """
+
+        for sector in range(self.sectorCount):
+            self.distances[sector] = 0
+            self.timestamps[sector] = float('-inf')
+
+    def sector(self, angle):
+        """ Returns the sector of an angle """
+
+        return min(self.sectorCount - 1,
+                   max(0, int(round(angle / self.sectorWidth))))
+
+    def angle(self, sector):
+        """ Returns the center angle of a sector """
+
+        return sector * self.sectorWidth
+
+    def update(self, angle, distance, timestamp):
+        """ Add a distance reading taken at angle """
+
+        sector = self.sector(angle)
+        self.distances[sector] = min(int(distance), self.maxDistance)
+        self.timestamps[sector] = timestamp
+        self.updateCount += 1
+
+    def hasRecentReading(self, now):
+        """ True if any sector has a reading younger than maxAge """
+
+        return max(self.timestamps) >= now - self.maxAge
+
+    def clearances(self, now):
+        """ Returns the distance per sector, unknownDistance if stale """
+
+        oldest = now - self.maxAge
+        unknown = self.unknownDistance
+        return [distance if timestamp >= oldest else unknown
+                for distance, timestamp
+                in zip(self.distances, self.timestamps)]
+
+
+class ObstaclePlanner():
+
+    """ Picks a heading away from obstacles every control loop tick
+
+    The planner sweeps the pan servo over sweepAngles, one step per
+    settleTime. The distance readings arriving after the servo settled
+    are added to a PolarGrid at the current pan angle.
+
+    Every tick, step() scores the directions of the grid, starting
+    straight ahead and working outwards. A direction is as clear as
+    the nearest obstacle within halfWidth sectors on either side, so
+    the whole robot fits through. Directions closer than minDistance
+    are blocked, the others are scored by clearance minus a penalty
+    for turning and for changing the heading. Once timeBudget seconds
+    are spent the best direction so far is used, so a slow tick never
+    delays the control loop any further.
+
+    The chosen heading is turned into one of the Arduino motor
+    commands, which can only drive straight or turn in place. Without
+    any recent reading the robot stands still until the sweep found
+    a way out.
+    """
+
+    SWEEP_ANGLES = (90, 60, 30, 60, 90, 120, 150, 120)
+
+    def __init__(self, grid=None, minDistance=20, cruiseSpeed=200,
+                 turnSpeed=150, sweepAngles=SWEEP_ANGLES, settleTime=0.15,
+                 halfWidth=0, turnPenalty=0.5, switchPenalty=10,
+                 timeBudget=0.002, clock=perf_counter):
+        """ Sets up the planner
+
+        Args:
+            grid (PolarGrid): The grid to fill, a new one by default
+            minDistance (int): Directions with an obstacle closer than
+                               this in cm are blocked
+            cruiseSpeed (int): Motor speed driving straight
+            turnSpeed (int): Motor speed turning or backing up
+            sweepAngles (tuple): Pan angles visited in turn
+            settleTime (float): Seconds the servo needs per step
+            halfWidth (int): Sectors on either side of a heading the
+                             robot needs to pass, with 30 degree
+                             sectors the beam of the distance sensor
+                             is about as wide as the robot
+            turnPenalty (float): Score per degree away from straight
+            switchPenalty (float): Score for changing the heading
+            timeBudget (float): Max seconds spent in chooseHeading
+            clock (function): Measures the time budget
+        """
+
+        self.grid = grid or PolarGrid()
+        self.minDistance = minDistance
+        self.cruiseSpeed = cruiseSpeed
+        self.turnSpeed = turnSpeed
+        self.sweepAngles = tuple(sweepAngles)
+        self.settleTime = settleTime
+        self.halfWidth = halfWidth
+        self.turnPenalty = turnPenalty
+        self.switchPenalty = switchPenalty
+        self.timeBudget = timeBudget
+        self.clock = clock
+
+        self.heading = None             # angle chosen last tick
+        self.motorCommand = None        # (commandType, speed) sent last
+        self.overBudgetCount = 0        # ticks that ran out of time
+        self.lastPlanDuration = 0.0     # seconds spent in chooseHeading
+
+        center = self.grid.sector(SERVO_CENTER)
+        # Sectors ordered from straight ahead outwards
+        self.__candidates = sorted(range(self.grid.sectorCount),
+                                   key=lambda sector: abs(sector - center))
+        self.__sweepIndex = -1
+        self.panAngle = None
+        self.__panTime = float('-inf')
+        self.__lastReadingTime = None
+
+    def observe(self, distance, readingTime):
+        """ Add a distance reading if it was taken at the pan angle
+
+        Args:
+            distance (int): The distance in cm
+            readingTime (float): When the reading was received
+        """
+
+        if distance is None or readingTime is None or \
+                self.panAngle is None or \
+                readingTime == self.__lastReadingTime or \
+                readingTime < self.__panTime + self.settleTime:
+            return
+        self.__lastReadingTime = readingTime
+        self.grid.update(self.panAngle, distance, readingTime)
+
+    def nextPanAngle(self, now):
+        """ Returns the pan angle to move the servo to or None
+
+        The servo stays at an angle until it settled and a reading was
+        taken there, or twice the settleTime passed.
+        """
+
+        if self.panAngle is not None:
+            settled = self.__panTime + self.settleTime
+            measured = self.__lastReadingTime is not None and \
+                self.__lastReadingTime >= settled
+            if now < settled or (not measured and
+                                 now < settled + self.settleTime):
+                return None
+
+        self.__sweepIndex = (self.__sweepIndex + 1) % len(self.sweepAngles)
+        angle = self.sweepAngles[self.__sweepIndex]
+        self.__panTime = now
+        if angle == self.panAngle:
+            return None
+        self.panAngle = angle
+        return angle
+
+    def chooseHeading(self, now):
+        """ Returns the clearest heading angle or None if all are blocked """
+
+        start = self.clock()
+        deadline = start + self.timeBudget
+        grid = self.grid
+        clearances = grid.clearances(now)
+        lastSector = grid.sectorCount - 1
+        previous = self.heading
+
+        bestAngle = None
+        bestScore = None
+        for sector in self.__candidates:
+            first = max(0, sector - self.halfWidth)
+            clearance = min(clearances[first:sector + self.halfWidth + 1])
+            if sector - self.halfWidth < 0 or \
+                    sector + self.halfWidth > lastSector:
+                # Part of the robot is outside the field of view
+                clearance = min(clearance, grid.unknownDistance)
+
+            if clearance > self.minDistance:
+                angle = grid.angle(sector)
+                score = clearance - self.turnPenalty * \
+                    abs(angle - SERVO_CENTER)
+                if previous is not None and angle != previous:
+                    score -= self.switchPenalty
+                if bestScore is None or score > bestScore:
+                    bestAngle = angle
+                    bestScore = score
+
+            if self.clock() >= deadline:
+                self.overBudgetCount += 1
+                break
+
+        self.lastPlanDuration = self.clock() - start
+        return bestAngle
+
+    def step(self, now, distance=None, readingTime=None):
+        """ Plan a control loop tick
+
+        Args:
+            now (float): The current time
+            distance (int): The latest distance reading
+            readingTime (float): When it was received, same clock as now
+
+        Returns:
+            (panAngle, motorCommand) where panAngle is the angle to
+            move the servo to and motorCommand a (commandType, speed)
+            tuple, either is None if it did not change
+        """
+
+        self.observe(distance, readingTime)
+        panAngle = self.nextPanAngle(now)
+
+        heading = self.chooseHeading(now)
+        self.heading = heading
+        sectorWidth = self.grid.sectorWidth
+
+        if heading is None and not self.grid.hasRecentReading(now):
+            # Blind, wait for the sweep
+            motorCommand = (CMD_MOTOR_STOP, 0)
+        elif heading is None:
+            # Boxed in, back up and let the readings age
+            motorCommand = (CMD_MOTOR_BACK, self.turnSpeed)
+        elif abs(heading - SERVO_CENTER) < sectorWidth:
+            motorCommand = (CMD_MOTOR_FORWARD, self.cruiseSpeed)
+        elif heading > SERVO_CENTER:
+            motorCommand = (CMD_MOTOR_LEFT, self.turnSpeed)
+        else:
+            motorCommand = (CMD_MOTOR_RIGHT, self.turnSpeed)
+
+        if motorCommand == self.motorCommand:
+            motorCommand = None
+        else:
+            self.motorCommand = motorCommand
+        return panAngle, motorCommand
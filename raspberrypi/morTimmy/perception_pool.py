@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+import logging
+import multiprocessing
+import os
+import queue
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
+from time import monotonic, sleep
+from metrics import Metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Job and result messages
+#
+# Only small tuples go through the queues, the data itself stays in
+# shared memory:
+#
+#   job     (jobID, name, slot, inputSize, args)
+#   result  (jobID, slot, resultSize, error)
+#
+# slot is the index of the input and result buffer of the job in the
+# input and result SharedMemory blocks, error is None or a string.
+#
+# Every worker writes the jobID it is running to its entry of the
+# shared currentJobs array and 0 once the result is queued, so the
+# pool knows which job was lost when a worker dies.
+
+
+def _worker(functions, inputName, resultName, inputSize, resultSize,
+            jobQueue, resultQueue, niceness, cpus, index, currentJobs):
+    """ Main function of a worker process """
+
+    if niceness:
+        os.nice(niceness)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    # The workers share the resource tracker of the pool, which
+    # unlinks the blocks in stop()
+    inputMemory = SharedMemory(inputName)
+    resultMemory = SharedMemory(resultName)
+    inputs = inputMemory.buf
+    results = resultMemory.buf
+
+    try:
+        while True:
+            job = jobQueue.get()
+            if job is None:
+                break
+
+            jobID, name, slot, size, args = job
+            currentJobs[index] = jobID
+            inputView = inputs[slot * inputSize:slot * inputSize + size]
+            resultView = results[slot * resultSize:(slot + 1) * resultSize]
+            try:
+                written = functions[name](inputView, resultView, *args)
+                resultQueue.put((jobID, slot, resultSize if written is None
+                                 else written, None))
+            except Exception as e:
+                resultQueue.put((jobID, slot, 0, '%s: %s' %
+                                 (type(e).__name__, e)))
+            finally:
+                inputView.release()
+                resultView.release()
+                currentJobs[index] = 0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del inputs, results
+        inputMemory.close()
+        resultMemory.close()
+
+
+class PerceptionResult():
+
+    """ The result of a perception job
+
+    data is a memoryview on the result buffer in shared memory. It is
+    only valid until the onResult handler returns and the slot is
+    reused for the next job, so copy what you want to keep, e.g. with
+    bytes(result.data) or result.array(...).copy().
+    """
+
+    def __init__(self, jobID, name, data, error, latency):
+        self.jobID = jobID
+        self.name = name
+        self.data = data
+        self.error = error
+        self.latency = latency      # seconds from submit to dispatch
+
+    def array(self, dtype, shape=None):
+        """ Returns data as a NumPy array without copying it
+
+        Like data the array must not be kept after the handler returns.
+        """
+
+        if numpy is None:
+            raise RuntimeError("NumPy is required for PerceptionResult.array")
+        result = numpy.frombuffer(self.data, dtype)
+        return result if shape is None else result.reshape(shape)
+
+
+class PerceptionPool():
+
+    """ Runs heavy perception jobs in worker processes
+
+    Frame processing, audio analysis or planner updates can take far
+    longer than a control loop tick. The pool runs them in separate
+    processes, so on another core and without holding our GIL, while
+    the control loop keeps sending motor commands.
+
+    The input and result data of a job do not travel through a pipe.
+    The pool allocates slotCount input and result buffers in two
+    SharedMemory blocks. submit copies the input into a free slot and
+    queues a small job tuple. The worker function reads the input and
+    writes its result straight into shared memory, see register.
+
+    Nothing on the control path blocks on the workers: submit drops a
+    job when all slots are busy and dispatchResults only handles the
+    results that are already there.
+
+    A worker that dies, e.g. in a crashing native library, is replaced
+    by dispatchResults. The job it was running is counted as failed
+    and its slot is freed.
+    """
+
+    POLL_INTERVAL = 0.01        # seconds between checks in stop()
+
+    def __init__(self, inputSize=65536, resultSize=65536, slotCount=4,
+                 workers=None, niceness=5, cpus=None, metrics=None):
+        """ Allocates the shared memory, start() starts the workers
+
+        Args:
+            inputSize (int): Max bytes of input data per job
+            resultSize (int): Max bytes of result data per job
+            slotCount (int): Max jobs submitted and not dispatched yet
+            workers (int): Number of worker processes, defaults to the
+                           number of CPUs minus one for the control loop
+            niceness (int): Added to the niceness of the workers so the
+                            control loop wins when CPUs are scarce
+            cpus (set): CPUs the workers may run on, e.g. all but the
+                        one of the control loop
+            metrics (Metrics): Registry for the 'perception.*' metrics
+        """
+
+        self.inputSize = inputSize
+        self.resultSize = resultSize
+        self.slotCount = slotCount
+        self.workerCount = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.niceness = niceness
+        self.cpus = cpus
+
+        self.metrics = metrics or Metrics()
+        self.__submitted = self.metrics.counter('perception.jobsSubmitted')
+        self.__dropped = self.metrics.counter('perception.jobsDropped')
+        self.__failed = self.metrics.counter('perception.jobsFailed')
+        self.__latency = self.metrics.histogram('perception.jobLatency')
+        self.__keptViews = self.metrics.counter('perception.keptViews')
+        self.__restarts = self.metrics.counter('perception.workerRestarts')
+        self.metrics.gauge('perception.busySlots',
+                           lambda: self.slotCount - len(self.__freeSlots))
+
+        self.__functions = {}       # name: function, run by the workers
+        self.__handlers = {}        # name: onResult, run by dispatchResults
+        self.__jobs = {}            # jobID: (name, submitTime, slot)
+        self.__freeSlots = deque(range(slotCount))
+        self.__lastJobID = 0
+        self.__processes = []
+        self.__inputMemory = None
+        self.__resultMemory = None
+        self.__jobQueue = None
+        self.__resultQueue = None
+        self.__currentJobs = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def register(self, name, function, onResult=None):
+        """ Register a perception job, before start
+
+        Args:
+            name (str): Name of the job used by submit
+            function (function): Runs in a worker process as
+                function(inputView, resultView, *args) and returns
+                the number of bytes written to resultView, or None if
+                it filled all of it. Must be a module level function.
+            onResult (function): Called by dispatchResults in the
+                                 control loop with a PerceptionResult
+        """
+
+        if self.__processes:
+            raise RuntimeError("Register jobs before starting the pool")
+        self.__functions[name] = function
+        self.__handlers[name] = onResult
+
+    @property
+    def running(self):
+        """ True if the worker processes are running """
+        return any(process.is_alive() for process in self.__processes)
+
+    def start(self):
+        """ Allocate the shared memory and start the workers """
+
+        if self.__processes:
+            return
+
+        self.__inputMemory = SharedMemory(
+            create=True, size=self.inputSize * self.slotCount)
+        self.__resultMemory = SharedMemory(
+            create=True, size=self.resultSize * self.slotCount)
+        self.__jobQueue = multiprocessing.Queue(self.slotCount)
+        self.__resultQueue = multiprocessing.Queue()
+        self.__currentJobs = multiprocessing.RawArray('q', self.workerCount)
+
+        for index in range(self.workerCount):
+            self.__processes.append(self.__startWorker(index))
+        logging.info("Started %d perception workers", self.workerCount)
+
+    def __startWorker(self, index):
+        """ Start worker process index and return it """
+
+        process = multiprocessing.Process(
+            target=_worker,
+            name='morTimmy-perception-%d' % index,
+            args=(self.__functions, self.__inputMemory.name,
+                  self.__resultMemory.name, self.inputSize,
+                  self.resultSize, self.__jobQueue, self.__resultQueue,
+                  self.niceness, self.cpus, index, self.__currentJobs),
+            daemon=True)
+        process.start()
+        return process
+
+    def __replaceDeadWorkers(self):
+        """ Fail the job of every worker that died and restart it """
+
+        for index, process in enumerate(self.__processes):
+            if process.exitcode is None:
+                continue
+
+            jobID = self.__currentJobs[index]
+            self.__currentJobs[index] = 0
+            name, submitTime, slot = self.__jobs.pop(jobID,
+                                                     (None, None, None))
+            if slot is not None:
+                self.__failed.inc()
+                self.__freeSlots.append(slot)
+            logging.error("Perception worker %d died with exit code %s "
+                          "running job %s, restarting it", index,
+                          process.exitcode, name)
+            process.join()
+            self.__processes[index] = self.__startWorker(index)
+            self.__restarts.inc()
+
+    def stop(self, timeout=1.0):
+        """ Stop the workers and free the shared memory """
+
+        if not self.__processes:
+            return
+
+        for process in self.__processes:
+            try:
+                self.__jobQueue.put_nowait(None)
+            except queue.Full:
+                break
+        deadline = monotonic() + timeout
+        while self.running and monotonic() < deadline:
+            sleep(self.POLL_INTERVAL)
+        for process in self.__processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.__processes = []
+
+        for jobQueue in (self.__jobQueue, self.__resultQueue):
+            jobQueue.close()
+            jobQueue.cancel_join_thread()
+        for sharedMemory in (self.__inputMemory, self.__resultMemory):
+            try:
+                sharedMemory.close()
+            except BufferError:
+                logging.error("Perception results are still referenced, "
+                              "leaving the shared memory mapped")
+            sharedMemory.unlink()
+        self.__jobs.clear()
+        self.__freeSlots = deque(range(self.slotCount))
+        logging.info("Stopped perception workers")
+
+    def submit(self, name, data=b'', *args):
+        """ Queue a job without blocking
+
+        Args:
+            name (str): The registered job
+            data (bytes-like): Input copied to shared memory, e.g. a
+                               camera frame
+            args: Small extra arguments, these are pickled
+
+        Returns:
+            The jobID or None if the job was dropped because all slots
+            are busy
+        """
+
+        size = len(data) if not hasattr(data, 'nbytes') else data.nbytes
+        if size > self.inputSize:
+            raise ValueError("Input of %d bytes does not fit in a %d byte "
+                             "slot" % (size, self.inputSize))
+        if not self.__freeSlots:
+            self.__dropped.inc()
+            return None
+
+        slot = self.__freeSlots.popleft()
+        start = slot * self.inputSize
+        self.__inputMemory.buf[start:start + size] = memoryview(data).cast('B')
+
+        self.__lastJobID += 1
+        jobID = self.__lastJobID
+        try:
+            self.__jobQueue.put_nowait((jobID, name, slot, size, args))
+        except queue.Full:
+            self.__freeSlots.appendleft(slot)
+            self.__dropped.inc()
+            return None
+
+        self.__jobs[jobID] = (name, monotonic(), slot)
+        self.__submitted.inc()
+        return jobID
+
+    def dispatchResults(self, maxResults=None):
+        """ Pass the finished results to their onResult handler
+
+        Returns right away when no result is waiting. The slot of a
+        result is reused once its handler returned. Workers that died
+        are replaced first.
+
+        Args:
+            maxResults (int): Handle at most this many results
+
+        Returns:
+            The number of results dispatched
+        """
+
+        if self.__processes:
+            self.__replaceDeadWorkers()
+
+        count = 0
+        while maxResults is None or count < maxResults:
+            try:
+                jobID, slot, size, error = self.__resultQueue.get_nowait()
+            except queue.Empty:
+                break
+            except (OSError, ValueError):
+                # The pool was stopped
+                break
+
+            if jobID not in self.__jobs:
+                # Failed when its worker died, the slot is free already
+                continue
+            name, submitTime, slot = self.__jobs.pop(jobID)
+            latency = monotonic() - submitTime
+            self.__latency.record(latency)
+            if error is not None:
+                self.__failed.inc()
+                logging.error("Perception job %s failed: %s", name, error)
+
+            start = slot * self.resultSize
+            data = self.__resultMemory.buf[start:start + size]
+            handler = self.__handlers.get(name)
+            if handler is not None and error is None:
+                try:
+                    handler(PerceptionResult(jobID, name, data, error,
+                                             latency))
+                except Exception:
+                    logging.exception("Perception result handler for "
+                                      "%s failed", name)
+            try:
+                data.release()
+            except BufferError:
+                # The handler kept a view, it will see the next result
+                self.__keptViews.inc()
+                logging.error("Perception result handler for %s kept a "
+                              "view on its result, copy it instead", name)
+            self.__freeSlots.append(slot)
+            count += 1
+
+        return count
+
+
+def busyJob(inputView, resultView, iterations):
+    """ Burns CPU for the demo in main, returns the checksum """
+
+    total = 0
+    for i in range(iterations):
+        total = (total * 31 + inputView[i % len(inputView)]) & 0xffffffff
+    resultView[:4] = total.to_bytes(4, 'little')
+    return 4
+
+
+def main():
+    """ Show that busy workers do not delay a 50Hz control loop """
+
+    logging.basicConfig(level=logging.INFO)
+
+    results = []
+    pool = PerceptionPool(inputSize=4096, resultSize=64)
+    pool.register('busy', busyJob, lambda result: results.append(
+        int.from_bytes(result.data[:4], 'little')))
+
+    interval = 0.02
+    lateness = []
+    with pool:
+        nextTick = monotonic()
+        for tick in range(250):
+            pool.submit('busy', bytes(range(256)) * 16, 200000)
+            pool.dispatchResults()
+            lateness.append(monotonic() - nextTick)
+            nextTick += interval
+            sleep(max(0, nextTick - monotonic()))
+
+    lateness.sort()
+    print("%d results, %d jobs dropped, tick lateness p50 %.2fms "
+          "max %.2fms" % (len(results),
+                          pool.metrics.counter('perception.jobsDropped').value,
+                          lateness[len(lateness) // 2] * 1000,
+                          lateness[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import struct
+import sys
+from collections import namedtuple
+
+# Protocol definition
+#
+# The single description of the messages exchanged between the
+# Raspberry Pi and the Arduino. The module and command constants,
+# the message layout and the lookup tables below are generated from
+# it, and so is the Arduino header:
+#
+#   python3 protocol.py header
+#
+# writes ARDUINO_HEADER and `python3 protocol.py check` fails when the
+# header is out of date.
+#
+# Every module has an id and a list of commands:
+#
+#   (name, commandType, payload[, nackName])
+#
+# The command constant is CMD_<module>_<name>. The NACK reply uses the
+# next commandType and is named CMD_<module>_<name>_NACK unless a
+# nackName is given. The payload is the meaning of the data field.
+
+PAYLOAD_NONE = 'none'           # data is ignored
+PAYLOAD_SPEED = 'speed'         # motor speed 0-255
+PAYLOAD_DISTANCE = 'distance'   # distance in cm
+PAYLOAD_COUNT = 'count'         # a number of items
+PAYLOAD_ANGLE = 'angle'         # servo angle in degrees, 0-180
+PAYLOAD_SPEEDS = 'speeds'       # left and right motor speed, see packSpeeds
+
+FRAME_FLAG = 0x0C               # Marks the start and end of a frame
+FRAME_ESC = 0x1B                # Escape char for frame
+
+TELEMETRY_MARKER = 0xFE         # First byte of a telemetry batch
+TELEMETRY_MAX_SAMPLES = 32      # Samples in a telemetry batch
+
+ARDUINO_HEADER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', '..', 'arduino', 'morTimmy', 'protocol.h')
+
+PROTOCOL = (
+    ('ARDUINO', 0x30, (
+        ('START', 0x64, PAYLOAD_NONE),
+        ('STOP', 0x66, PAYLOAD_NONE),
+        ('RESTART', 0x68, PAYLOAD_NONE),
+        ('TELEMETRY', 0x6A, PAYLOAD_COUNT),     # max samples per batch
+    )),
+    ('DISTANCE_SENSOR', 0x31, (
+        ('START', 0x64, PAYLOAD_DISTANCE, 'CMD_DISTANCE_SENSOR_NACK'),
+        ('STOP', 0x66, PAYLOAD_NONE),
+    )),
+    ('MOTOR', 0x32, (
+        ('FORWARD', 0x64, PAYLOAD_SPEED),
+        ('BACK', 0x66, PAYLOAD_SPEED),
+        ('LEFT', 0x68, PAYLOAD_SPEED),
+        ('RIGHT', 0x6A, PAYLOAD_SPEED),
+        ('STOP', 0x6C, PAYLOAD_NONE),
+        ('DRIVE', 0x6E, PAYLOAD_SPEEDS),    # each side its own speed
+    )),
+    ('SERVO', 0x33, (
+        ('PAN', 0x64, PAYLOAD_ANGLE),       # 90 is straight ahead
+        ('TILT', 0x66, PAYLOAD_ANGLE),
+    )),
+)
+
+# Message layout, the checksum must be the last field
+#
+#   (name, struct format, C type)
+#
+MESSAGE_FIELDS = (
+    ('messageID', 'L', 'unsigned long'),
+    ('acknowledgeID', 'L', 'unsigned long'),
+    ('module', 'B', 'byte'),
+    ('commandType', 'B', 'byte'),
+    ('data', 'L', 'unsigned long'),
+    ('checksum', 'L', 'unsigned long'),
+)
+
+# Generated from the definition above
+
+MESSAGE_STRUCT = struct.Struct(
+    '<' + ''.join(fieldFormat for name, fieldFormat, cType in MESSAGE_FIELDS))
+CHECKSUM_STRUCT = struct.Struct('<' + MESSAGE_FIELDS[-1][1])
+MESSAGE_SIZE = MESSAGE_STRUCT.size
+CHECKSUM_OFFSET = MESSAGE_SIZE - CHECKSUM_STRUCT.size
+EMPTY_CHECKSUM = bytes(CHECKSUM_STRUCT.size)
+
+# A message received from the Arduino
+Message = namedtuple('Message', [name for name, fieldFormat, cType
+                                 in MESSAGE_FIELDS])
+
+MODULE_NAMES = {}       # module: 'MODULE_MOTOR'
+COMMAND_NAMES = {}      # (module, commandType): 'CMD_MOTOR_FORWARD'
+NACK_COMMANDS = {}      # (module, commandType): NACK commandType
+PAYLOAD_TYPES = {}      # (module, commandType): PAYLOAD_*
+
+
+def __buildTables():
+    """ Returns the constants defined by PROTOCOL and fills the tables
+
+    Raises:
+        ValueError: Two modules or commands share an id or a name
+    """
+
+    constants = {}
+
+    def define(name, value):
+        if name in constants:
+            raise ValueError("Protocol defines %s twice" % name)
+        constants[name] = value
+
+    for moduleName, module, commands in PROTOCOL:
+        if module in MODULE_NAMES:
+            raise ValueError("Protocol module %#x defined twice" % module)
+        MODULE_NAMES[module] = 'MODULE_' + moduleName
+        define('MODULE_' + moduleName, module)
+
+        for command in commands:
+            name, commandType, payload = command[:3]
+            name = 'CMD_%s_%s' % (moduleName, name)
+            nackName = command[3] if len(command) > 3 else name + '_NACK'
+            for key, keyName in (((module, commandType), name),
+                                 ((module, commandType + 1), nackName)):
+                if key in COMMAND_NAMES:
+                    raise ValueError("Protocol command %#x of %s defined "
+                                     "twice" % (key[1], moduleName))
+                COMMAND_NAMES[key] = keyName
+                define(keyName, key[1])
+            NACK_COMMANDS[(module, commandType)] = commandType + 1
+            PAYLOAD_TYPES[(module, commandType)] = payload
+            PAYLOAD_TYPES[(module, commandType + 1)] = PAYLOAD_NONE
+
+    return constants
+
+
+globals().update(__buildTables())
+
+
+def commandName(module, commandType):
+    """ Returns the name of a command for logging, e.g. CMD_MOTOR_STOP """
+
+    try:
+        return COMMAND_NAMES[(module, commandType)]
+    except KeyError:
+        return '%#x/%#x' % (module, commandType)
+
+
+def packSpeeds(leftMotorSpeed, rightMotorSpeed):
+    """ Returns the data of a PAYLOAD_SPEEDS command
+
+    The left speed is stored in the low and the right speed in the
+    high 16 bits, both as signed 16 bit numbers from -255 to 255.
+    """
+
+    return (leftMotorSpeed & 0xffff) | (rightMotorSpeed & 0xffff) << 16
+
+
+def unpackSpeeds(data):
+    """ Returns the (left, right) motor speeds of a PAYLOAD_SPEEDS command """
+
+    left = data & 0xffff
+    right = data >> 16 & 0xffff
+    return left - (left >> 15 << 16), right - (right >> 15 << 16)
+
+
+def arduinoHeader():
+    """ Returns the Arduino header with the protocol definition """
+
+    lines = ["/**",
+             "  * @file protocol.h",
+             "  * @brief Protocol definition for the morTimmy robot",
+             "  *",
+             "  * Generated by raspberrypi/morTimmy/protocol.py, do not edit",
+             "  */",
+             "",
+             "#ifndef MORTIMMY_PROTOCOL_H",
+             "#define MORTIMMY_PROTOCOL_H",
+             "",
+             "namespace morTimmy {",
+             "",
+             "  // Frames",
+             "  const byte FRAME_FLAG = 0x%02X;" % FRAME_FLAG,
+             "  const byte FRAME_ESC = 0x%02X;" % FRAME_ESC,
+             "",
+             "  // Telemetry frames, see telemetry.py",
+             "  const byte TELEMETRY_MARKER = 0x%02X;" % TELEMETRY_MARKER,
+             "  const byte TELEMETRY_MAX_SAMPLES = %d;" %
+             TELEMETRY_MAX_SAMPLES]
+
+    for moduleName, module, commands in PROTOCOL:
+        lines += ["", "  // %s" % moduleName.replace('_', ' ').title(),
+                  "  const byte %s = 0x%02X;" %
+                  (MODULE_NAMES[module], module)]
+        for command in commands:
+            commandType = command[1]
+            for key in ((module, commandType), (module, commandType + 1)):
+                lines.append("  const byte %s = 0x%02X;" %
+                             (COMMAND_NAMES[key], key[1]))
+
+    lines += ["", "  struct message_t {"]
+    lines += ["    %s %s;" % (cType, name)
+              for name, fieldFormat, cType in MESSAGE_FIELDS]
+    lines += ["  };", "", "};", "", "#endif", ""]
+
+    return '\n'.join(lines)
+
+
+def main():
+    """ Write or check the Arduino header """
+
+    parser = argparse.ArgumentParser(
+        description="Generate the morTimmy Arduino protocol header")
+    parser.add_argument('command', choices=['header', 'check'])
+    parser.add_argument('filename', nargs='?',
+                        default=ARDUINO_HEADER)
+    args = parser.parse_args()
+
+    header = arduinoHeader()
+    if args.command == 'header':
+        with open(args.filename, 'w') as headerFile:
+            headerFile.write(header)
+        return
+
+    try:
+        with open(args.filename) as headerFile:
+            current = headerFile.read()
+    except FileNotFoundError:
+        current = None
+    if current != header:
+        print("%s is out of date, run: %s header %s" %
+              (args.filename, sys.argv[0], args.filename))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import random
+from time import monotonic, sleep
+
+
+class Backoff():
+
+    """ Exponential backoff with jitter between reconnect attempts
+
+    The first retry waits initial seconds, every next retry factor
+    times longer up to maximum. Each delay is randomly shortened by up
+    to jitter (a fraction) so several robots, or links, that lost
+    their connection at the same time do not retry in lockstep.
+    """
+
+    def __init__(self, initial=0.1, maximum=5.0, factor=2.0, jitter=0.5,
+                 seed=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+        self.__random = random.Random(seed)
+
+    def next(self):
+        """ Returns the delay in seconds before the next attempt """
+
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        # Stop counting at the maximum, factor ** attempts would overflow
+        if delay < self.maximum:
+            self.attempts += 1
+        return delay * (1 - self.jitter * self.__random.random())
+
+    def reset(self):
+        """ Start over after a successful attempt """
+        self.attempts = 0
+
+
+def waitForDevice(path, timeout, pollInterval=0.05):
+    """ Wait for a serial device node to appear
+
+    When the USB cable of the Arduino is unplugged its device node,
+    e.g. /dev/ttyACM0, disappears. Polling the node lets us reconnect
+    as soon as it is plugged in again instead of after a fixed sleep.
+
+    Args:
+        path (str): The device node
+        timeout (float): Maximum seconds to wait
+        pollInterval (float): Seconds between checks
+
+    Returns:
+        True if the device node exists
+    """
+
+    deadline = monotonic() + timeout
+    while not os.path.exists(path):
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        sleep(min(pollInterval, remaining))
+    return True
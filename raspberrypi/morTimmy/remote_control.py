@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from drive_mixer import DriveMixer
+
 
 class ControllerDriver:
     """ Generic class for remote controlling morTimmy the Robot
@@ -25,6 +27,10 @@ class ControllerCmd:
 
     leftMotorSpeed = 0      # Controls the speed of the left side motors
     rightMotorSpeed = 0     # Controls the speed of the right side motors
+    x = 0                   # Joystick steering, see joystick
+    y = 0                   # Joystick speed, see joystick
+    halt = False            # Stop right away instead of ramping down
+    mixer = DriveMixer()    # Shared by all commands, mix() is stateless
 
     def goForward(self, speed):
         self.leftMotorSpeed = speed
@@ -45,29 +51,26 @@ class ControllerCmd:
     def stop(self):
         self.leftMotorSpeed = 0
         self.rightMotorSpeed = 0
+        self.x = 0
+        self.y = 0
+        self.halt = True
 
     def joystick(self, x, y):
         """ Controlling the robot using a joystick
 
+        The position is kept in x and y for a rate limited mixer and
+        shaped and mixed by the DriveMixer in mixer, see
+        drive_mixer.py.
+
         Args:
             x (int): x-axis of the joystick, controls the amount of
                      steering
             y (int): y-axis if the joystick, controls the
                      forward/back speed
         """
-        self.leftMotorsSpeed = x - y
-        self.rightMotorsSpeed = x + y
-
-        # Make sure the remote control x and y values
-        # do not exceed the maximum speed
-        if (self.leftMotorsSpeed < -255):
-            self.leftMotorsSpeed = -255
-        elif (self.leftMotorsSpeed > 255):
-            self.leftMotorsSpeed = 255
-        if (self.rightMotorsSpeed < -255):
-            self.rightMotorsSpeed = -255
-        elif (self.rightMotorsSpeed > 255):
-            self.rightMotorsSpeed = 255
+        self.x = x
+        self.y = y
+        self.leftMotorSpeed, self.rightMotorSpeed = self.mixer.mix(x, y)
 
 
 def main():
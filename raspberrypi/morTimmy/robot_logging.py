@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import logging
+import logging.handlers
+import queue
+import threading
+from time import monotonic
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(module)s %(message)s'
+# Pass as extra to log a record even if it repeats, e.g. telemetry
+NO_RATE_LIMIT = {'rateLimit': False}
+
+
+class RateLimitFilter(logging.Filter):
+
+    """ Limits how often the same message is logged
+
+    Repetitive messages, like a warning for every invalid frame on a
+    noisy serial line, are limited per module and message to burst
+    records and after that rate records per second. The number of
+    suppressed records is added to the next record that gets through.
+    Records below level, like the DEBUG message tracing, and records
+    logged with extra=NO_RATE_LIMIT, like the periodic telemetry that
+    logs the same message for every task or link, are never limited.
+
+    The filter only looks at the unformatted message so suppressed
+    records are never formatted.
+    """
+
+    def __init__(self, rate=1.0, burst=5, level=logging.INFO,
+                 clock=monotonic):
+        """ Sets up the filter
+
+        Args:
+            rate (float): Records per second allowed after the burst
+            burst (int): Records allowed in a row
+            level (int): Only limit records of this level and above
+            clock (function): Returns the current time in seconds
+        """
+
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+        self.suppressedCount = 0
+        self.__clock = clock
+        self.__buckets = {}     # (module, msg): [tokens, time, suppressed]
+        self.__lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.level or \
+                not getattr(record, 'rateLimit', True):
+            return True
+
+        key = (record.module, record.msg)
+        now = self.__clock()
+
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if bucket is None:
+                bucket = self.__buckets[key] = [self.burst, now, 0]
+            else:
+                bucket[0] = min(self.burst,
+                                bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressedCount += 1
+                return False
+
+            bucket[0] -= 1
+            suppressed = bucket[2]
+            bucket[2] = 0
+
+        if suppressed:
+            record.msg = "%s (%d similar messages suppressed)" % \
+                (record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    """ QueueHandler that leaves all formatting to the listener thread
+
+    The default QueueHandler formats every record before putting it on
+    the queue. Here the record is queued as is, so the logging thread
+    only pays for a LogRecord and a queue put. Arguments should not be
+    changed after they are logged, which holds for the numbers and
+    strings logged by morTimmy.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setupLogging(filename=None, level=logging.INFO, filemode='a',
+                 logFormat=LOG_FORMAT, rate=1.0, burst=5):
+    """ Route all logging through a queue to a background thread
+
+    The root logger gets a DeferredQueueHandler with a RateLimitFilter.
+    Records are written to the file (or stderr) by a QueueListener
+    thread, so a slow SD card never stalls the control loop.
+
+    Args:
+        filename (str): The log file, None logs to stderr
+        level (int): The log level of the root logger
+        filemode (str): 'w' to truncate the log file, 'a' to append
+        logFormat (str): The format of the log records
+        rate (float): Repeated messages per second, see RateLimitFilter
+        burst (int): Repeated messages in a row, see RateLimitFilter
+
+    Returns:
+        The started QueueListener, stop it with stopLogging
+    """
+
+    if filename is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(filename, mode=filemode)
+    handler.setFormatter(logging.Formatter(logFormat))
+
+    logQueue = queue.SimpleQueue()
+    queueHandler = DeferredQueueHandler(logQueue)
+    queueHandler.addFilter(RateLimitFilter(rate, burst))
+
+    rootLogger = logging.getLogger()
+    for oldHandler in rootLogger.handlers[:]:
+        rootLogger.removeHandler(oldHandler)
+    rootLogger.addHandler(queueHandler)
+    rootLogger.setLevel(level)
+
+    listener = logging.handlers.QueueListener(logQueue, handler)
+    listener.start()
+    return listener
+
+
+def stopLogging(listener):
+    """ Write all queued records and stop the listener thread """
+
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
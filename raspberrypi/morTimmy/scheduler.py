@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import logging
+from time import monotonic, sleep
+
+
+class TaskStats():
+
+    """ Timing statistics of a scheduled task
+
+    Jitter is the time between the moment a run was due and the
+    moment it actually started. A run overruns when it finishes after
+    the next run was due.
+    """
+
+    __slots__ = ('runs', 'overruns', 'skipped', 'lastDuration',
+                 'maxDuration', 'totalDuration', 'lastJitter', 'maxJitter',
+                 'totalJitter')
+
+    def __init__(self):
+        self.runs = 0
+        self.overruns = 0           # runs that missed their deadline
+        self.skipped = 0            # runs dropped to catch up
+        self.lastDuration = 0.0
+        self.maxDuration = 0.0
+        self.totalDuration = 0.0
+        self.lastJitter = 0.0
+        self.maxJitter = 0.0
+        self.totalJitter = 0.0
+
+    def summary(self):
+        """ Returns a dictionary with the statistics, times in ms """
+
+        runs = self.runs or 1
+        return {'runs': self.runs,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'meanDuration': self.totalDuration / runs * 1000,
+                'maxDuration': self.maxDuration * 1000,
+                'meanJitter': self.totalJitter / runs * 1000,
+                'maxJitter': self.maxJitter * 1000}
+
+
+class ScheduledTask():
+
+    """ A function called by the Scheduler at a fixed rate """
+
+    def __init__(self, name, function, rate):
+        self.name = name
+        self.function = function
+        self.period = 1.0 / rate
+        self.nextRun = None
+        self.stats = TaskStats()
+
+
+class Scheduler():
+
+    """ Fixed rate scheduler for the robot control loop
+
+    Every task is called at its own rate, e.g. motor updates at 50Hz,
+    distance polling at 20Hz and telemetry at 1Hz. Deadlines are
+    calculated from the start time with time.monotonic so they do not
+    drift, and the scheduler sleeps until the next task is due instead
+    of spinning.
+
+    When a task falls more than a full period behind, the runs it
+    missed are skipped rather than executed back to back.
+    """
+
+    def __init__(self, clock=monotonic, sleep=sleep):
+        """ Sets up an empty schedule
+
+        Args:
+            clock (callable): Returns the current time in seconds
+            sleep (callable): Sleeps for the given number of seconds
+        """
+
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+        self.__running = False
+
+    def addTask(self, function, rate, name=None):
+        """ Schedule a function
+
+        Args:
+            function (callable): Called without arguments
+            rate (float): Number of calls per second
+            name (str): Name used in the statistics, defaults to the
+                        function name
+
+        Returns:
+            The ScheduledTask
+        """
+
+        if rate <= 0:
+            raise ValueError("Task rate must be positive")
+
+        task = ScheduledTask(name or function.__name__, function, rate)
+        self.tasks.append(task)
+        return task
+
+    def runPending(self):
+        """ Run every task that is due
+
+        Returns:
+            The time at which the next task is due
+        """
+
+        now = self.clock()
+
+        for task in self.tasks:
+            if task.nextRun is None:
+                task.nextRun = now
+            if now < task.nextRun:
+                continue
+
+            stats = task.stats
+            jitter = now - task.nextRun
+            task.function()
+            finished = self.clock()
+            duration = finished - now
+
+            stats.runs += 1
+            stats.lastJitter = jitter
+            stats.totalJitter += jitter
+            stats.maxJitter = max(stats.maxJitter, jitter)
+            stats.lastDuration = duration
+            stats.totalDuration += duration
+            stats.maxDuration = max(stats.maxDuration, duration)
+
+            task.nextRun += task.period
+            late = finished - task.nextRun
+            if late > 0:
+                # The next run is already due, skip the runs we missed
+                # completely instead of executing them back to back
+                stats.overruns += 1
+                missed = int(late / task.period)
+                stats.skipped += missed
+                task.nextRun += missed * task.period
+                logging.debug("Task %s overran its deadline by %.1fms",
+                              task.name, late * 1000)
+
+            now = finished
+
+        return min(task.nextRun for task in self.tasks)
+
+    def run(self, duration=None):
+        """ Run the scheduled tasks until stop is called
+
+        Args:
+            duration (float): Stop after this many seconds
+        """
+
+        if not self.tasks:
+            return
+
+        self.__running = True
+        endTime = None if duration is None else self.clock() + duration
+
+        while self.__running:
+            nextRun = self.runPending()
+            if endTime is not None and nextRun >= endTime:
+                break
+            delay = nextRun - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+
+        self.__running = False
+
+    def stop(self):
+        """ Stop run() after the tasks currently running """
+        self.__running = False
+
+    def getStats(self):
+        """ Returns the statistics of every task keyed by task name """
+
+        return dict((task.name, task.stats.summary()) for task in self.tasks)
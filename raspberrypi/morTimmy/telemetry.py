@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import struct
+from array import array
+from zlib import crc32
+from protocol import TELEMETRY_MARKER, TELEMETRY_MAX_SAMPLES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Telemetry frame layout
+#
+# Once negotiated with CMD_ARDUINO_TELEMETRY the Arduino sends its
+# sensor readings in batches instead of a message per reading:
+#
+#  +--------+-------+---------------+--------+-----+--------+-------+
+#  | marker | count | baseTimestamp | SAMPLE | ... | SAMPLE | CRC32 |
+#  +--------+-------+---------------+--------+-----+--------+-------+
+#
+#  marker         (unsigned char, 1 byte, TELEMETRY_MARKER)
+#  count          (unsigned char, 1 byte, number of samples)
+#  baseTimestamp  (unsigned long, 4 bytes, Arduino millis() of the
+#                  first sample)
+#
+# and every sample:
+#
+#  module         (unsigned char, 1 byte, the sensor module)
+#  offset         (unsigned short, 2 bytes, ms after baseTimestamp)
+#  value          (unsigned short, 2 bytes, e.g. the distance)
+#
+# A batch of n samples takes 10 + 5n bytes which never equals the 18
+# bytes of a message, so both share the same framing.
+
+TELEMETRY_HEADER_STRUCT = struct.Struct('<BBL')
+TELEMETRY_SAMPLE_STRUCT = struct.Struct('<BHH')
+TELEMETRY_CHECKSUM_STRUCT = struct.Struct('<L')
+TELEMETRY_MAX_SIZE = TELEMETRY_HEADER_STRUCT.size + \
+    TELEMETRY_MAX_SAMPLES * TELEMETRY_SAMPLE_STRUCT.size + \
+    TELEMETRY_CHECKSUM_STRUCT.size
+
+if numpy is not None:
+    TELEMETRY_SAMPLE_DTYPE = numpy.dtype([('module', 'u1'),
+                                          ('offset', '<u2'),
+                                          ('value', '<u2')])
+
+
+def telemetrySize(count):
+    """ Returns the size of a telemetry frame holding count samples """
+
+    return TELEMETRY_HEADER_STRUCT.size + \
+        count * TELEMETRY_SAMPLE_STRUCT.size + TELEMETRY_CHECKSUM_STRUCT.size
+
+
+def isTelemetry(frame):
+    """ True if the unescaped frame looks like a telemetry batch """
+
+    return len(frame) >= telemetrySize(0) and \
+        frame[0] == TELEMETRY_MARKER and \
+        len(frame) == telemetrySize(frame[1])
+
+
+def packTelemetry(baseTimestamp, samples):
+    """ Creates a telemetry batch
+
+    Args:
+        baseTimestamp (int): Arduino time of the first sample in ms
+        samples (list): (module, offset, value) tuples
+
+    Returns:
+        The telemetry batch as bytes, ready for packFrame
+    """
+
+    if len(samples) > TELEMETRY_MAX_SAMPLES:
+        raise ValueError("At most %d samples fit in a telemetry frame" %
+                         TELEMETRY_MAX_SAMPLES)
+
+    batch = bytearray(telemetrySize(len(samples)))
+    TELEMETRY_HEADER_STRUCT.pack_into(batch, 0, TELEMETRY_MARKER,
+                                      len(samples), baseTimestamp)
+    offset = TELEMETRY_HEADER_STRUCT.size
+    for sample in samples:
+        TELEMETRY_SAMPLE_STRUCT.pack_into(batch, offset, *sample)
+        offset += TELEMETRY_SAMPLE_STRUCT.size
+    TELEMETRY_CHECKSUM_STRUCT.pack_into(batch, offset,
+                                        crc32(memoryview(batch)[:offset]))
+    return bytes(batch)
+
+
+def unpackTelemetry(frame):
+    """ Check and unpack the header of a telemetry batch
+
+    Returns:
+        (count, baseTimestamp) or None if the checksum failed
+    """
+
+    checksumOffset = len(frame) - TELEMETRY_CHECKSUM_STRUCT.size
+    checksum, = TELEMETRY_CHECKSUM_STRUCT.unpack_from(frame, checksumOffset)
+    if crc32(memoryview(frame)[:checksumOffset]) != checksum:
+        return None
+
+    marker, count, baseTimestamp = TELEMETRY_HEADER_STRUCT.unpack_from(frame)
+    return count, baseTimestamp
+
+
+class SampleBuffer():
+
+    """ Array backed ring buffer of timestamped sensor samples
+
+    The samples of all telemetry batches are kept in three preallocated
+    arrays holding the timestamp in ms, the module and the value. Once
+    the buffer is full the oldest samples are overwritten.
+
+    With NumPy installed a batch is decoded with a single frombuffer
+    call and the samples can be read as NumPy arrays, see arrays().
+    """
+
+    def __init__(self, capacity=1024):
+        if capacity < 1:
+            raise ValueError("SampleBuffer capacity must be at least 1")
+
+        self.capacity = capacity
+        self.timestamps = array('I', [0]) * capacity
+        self.modules = array('B', [0]) * capacity
+        self.values = array('H', [0]) * capacity
+        self.totalCount = 0         # samples added since the last clear
+        self.__index = 0            # position of the next sample
+
+    def __len__(self):
+        return min(self.totalCount, self.capacity)
+
+    def clear(self):
+        self.totalCount = 0
+        self.__index = 0
+
+    def append(self, timestamp, module, value):
+        """ Add a single sample """
+
+        index = self.__index
+        self.timestamps[index] = timestamp & 0xffffffff
+        self.modules[index] = module
+        self.values[index] = value
+        self.__index = (index + 1) % self.capacity
+        self.totalCount += 1
+
+    def extendFrame(self, frame):
+        """ Decode the samples of a checked telemetry batch
+
+        Args:
+            frame (bytes): A telemetry batch, see unpackTelemetry
+
+        Returns:
+            A list with the (timestamp, module, value) of the samples
+        """
+
+        marker, count, baseTimestamp = \
+            TELEMETRY_HEADER_STRUCT.unpack_from(frame)
+
+        if numpy is not None:
+            decoded = numpy.frombuffer(frame, TELEMETRY_SAMPLE_DTYPE, count,
+                                       TELEMETRY_HEADER_STRUCT.size)
+            timestamps = (decoded['offset'].astype('u4') + baseTimestamp) \
+                & 0xffffffff
+            samples = list(zip(timestamps.tolist(),
+                               decoded['module'].tolist(),
+                               decoded['value'].tolist()))
+        else:
+            samples = [((baseTimestamp + offset) & 0xffffffff, module, value)
+                       for module, offset, value
+                       in TELEMETRY_SAMPLE_STRUCT.iter_unpack(
+                           memoryview(frame)[TELEMETRY_HEADER_STRUCT.size:
+                                             -TELEMETRY_CHECKSUM_STRUCT.size])]
+
+        for timestamp, module, value in samples:
+            self.append(timestamp, module, value)
+        return samples
+
+    def __order(self, samples):
+        """ Returns the samples of an array from oldest to newest """
+
+        if self.totalCount < self.capacity:
+            return samples[:self.totalCount]
+        return samples[self.__index:] + samples[:self.__index]
+
+    def get(self, module=None):
+        """ Returns the buffered samples from oldest to newest
+
+        Args:
+            module (byte): Only return the samples of this module
+
+        Returns:
+            (timestamps, values) arrays
+        """
+
+        timestamps = self.__order(self.timestamps)
+        values = self.__order(self.values)
+        if module is None:
+            return timestamps, values
+
+        modules = self.__order(self.modules)
+        return (array('I', (timestamp for timestamp, sampleModule
+                            in zip(timestamps, modules)
+                            if sampleModule == module)),
+                array('H', (value for value, sampleModule
+                            in zip(values, modules)
+                            if sampleModule == module)))
+
+    def arrays(self, module=None):
+        """ Returns the buffered samples as NumPy arrays
+
+        Ordering the ring from oldest to newest copies the samples,
+        like get() does. NumPy wraps those copies without copying them
+        again, so the arrays do not change when samples are added.
+
+        Raises:
+            RuntimeError: NumPy is not installed
+        """
+
+        if numpy is None:
+            raise RuntimeError("NumPy is required for SampleBuffer.arrays")
+
+        if module is None:
+            timestamps, values = self.get()
+            return (numpy.frombuffer(timestamps, numpy.uint32),
+                    numpy.frombuffer(values, numpy.uint16))
+
+        timestamps = numpy.frombuffer(self.__order(self.timestamps),
+                                      numpy.uint32)
+        values = numpy.frombuffer(self.__order(self.values), numpy.uint16)
+        selected = numpy.frombuffer(self.__order(self.modules),
+                                    numpy.uint8) == module
+        return timestamps[selected], values[selected]
+
+    def latest(self, module):
+        """ Returns (timestamp, value) of the newest sample of module """
+
+        for offset in range(1, len(self) + 1):
+            index = (self.__index - offset) % self.capacity
+            if self.modules[index] == module:
+                return self.timestamps[index], self.values[index]
+        return None